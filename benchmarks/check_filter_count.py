@@ -0,0 +1,107 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Shows how the cost of check() grows with the number of filters.
+
+Compares cutting all sections in a single pass over each file against reading
+and cutting the files once per filter (which is what check() used to do), and
+reports the total time spent in check().
+
+Usage: python benchmarks/check_filter_count.py [number of blocks]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from runtest import get_filter
+from runtest.check import check
+from runtest.scissors import cut_sections, section_bounds, join_sections
+
+
+def _write_output(file_name, num_blocks, num_anchors):
+    with open(file_name, "w") as f:
+        for block in range(num_blocks):
+            anchor = block % num_anchors
+            f.write("@ section {0} begins\n".format(anchor))
+            for i in range(8):
+                f.write("   value {0}   {1:.10f}   {2:.6e}\n".format(i, 0.1 * i, 1.0e-3 * i))
+            f.write("@ section {0} ends\n".format(anchor))
+            f.write("some text without numbers to skip\n")
+
+
+def _filters(num_filters):
+    return [
+        get_filter(
+            from_string="@ section {0} begins".format(k),
+            to_string="@ section {0} ends".format(k),
+            rel_tolerance=1.0e-8,
+        )
+        for k in range(num_filters)
+    ]
+
+
+def _cut_once_per_filter(filter_list, out_name, ref_name):
+    for f in filter_list:
+        for file_name in (out_name, ref_name):
+            with open(file_name) as fh:
+                cut_sections(
+                    fh.readlines(),
+                    from_string=f.from_string,
+                    from_is_re=f.from_is_re,
+                    to_string=f.to_string,
+                    to_is_re=f.to_is_re,
+                    num_lines=f.num_lines,
+                )
+
+
+def _cut_single_pass(filter_list, out_name, ref_name):
+    for file_name in (out_name, ref_name):
+        with open(file_name) as fh:
+            text = fh.readlines()
+        for bounds in section_bounds(text, filter_list):
+            join_sections(text, bounds)
+
+
+def _timed(function, *args):
+    t0 = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - t0
+
+
+def main():
+    num_blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    filter_counts = [1, 2, 4, 8, 16, 32]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        out_name = os.path.join(work_dir, "out")
+        ref_name = os.path.join(work_dir, "ref")
+        _write_output(out_name, num_blocks, max(filter_counts))
+        _write_output(ref_name, num_blocks, max(filter_counts))
+        size = os.path.getsize(out_name) / 1.0e6
+
+        print("output size: {0:.1f} MB, {1} blocks".format(size, num_blocks))
+        print(
+            "{0:>8} {1:>20} {2:>18} {3:>13}".format(
+                "filters", "cut per filter [s]", "single pass [s]", "check() [s]"
+            )
+        )
+        for n in filter_counts:
+            filter_list = _filters(n)
+            t_cut = _timed(_cut_once_per_filter, filter_list, out_name, ref_name)
+            t_pass = _timed(_cut_single_pass, filter_list, out_name, ref_name)
+            t_check = _timed(check, filter_list, out_name, ref_name, work_dir)
+            print(
+                "{0:>8} {1:>20.3f} {2:>18.3f} {3:>13.3f}".format(
+                    n, t_cut, t_pass, t_check
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Compares the time of check() on decoded lines and on memory mapped files.
+
+Usage: python benchmarks/check_mmap.py [number of lines] [repetitions]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from runtest.check import check
+from runtest.filter_constructor import get_filter
+
+
+def _write(file_name, num_lines):
+    with open(file_name, "w") as f:
+        for i in range(num_lines):
+            if i % 100 == 0:
+                f.write("iteration {0} energy\n".format(i))
+            f.write(
+                "  {0:16.10f} {1:16.10f} {2:8d} {3:16.8e}\n".format(
+                    0.5 * i, -0.25 * i, i, 1.0e-3 * i
+                )
+            )
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    filter_lists = {
+        "whole file": [get_filter(rel_tolerance=1.0e-8)],
+        "sections": [get_filter(from_string="energy", num_lines=3, rel_tolerance=1.0e-8)],
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        out_name = os.path.join(work_dir, "out")
+        ref_name = os.path.join(work_dir, "ref")
+        _write(out_name, num_lines)
+        _write(ref_name, num_lines)
+        for name, filters in filter_lists.items():
+            for use_mmap in [False, True]:
+                t0 = time.perf_counter()
+                for _ in range(repetitions):
+                    check(filters, out_name, ref_name, work_dir, use_mmap=use_mmap)
+                elapsed = (time.perf_counter() - t0) / repetitions
+                print(
+                    "{0:12}  mmap={1!s:5}  {2:7.3f} s".format(name, use_mmap, elapsed)
+                )
+
+
+if __name__ == "__main__":
+    main()
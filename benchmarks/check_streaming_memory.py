@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Compares peak memory and time of check() in memory and in streaming mode.
+
+Usage: python benchmarks/check_streaming_memory.py [number of lines]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from runtest.check import check
+from runtest.filter_constructor import get_filter
+
+
+def _write(file_name, num_lines):
+    with open(file_name, "w") as f:
+        for i in range(num_lines):
+            f.write(
+                "  {0:16.10f} {1:16.10f} {2:8d} {3:16.8e}\n".format(
+                    0.5 * i, -0.25 * i, i, 1.0e-3 * i
+                )
+            )
+
+
+def _peak(streaming, work_dir):
+    filters = [get_filter(rel_tolerance=1.0e-8)]
+    out_name = os.path.join(work_dir, "out")
+    ref_name = os.path.join(work_dir, "ref")
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    check(filters, out_name, ref_name, work_dir, streaming=streaming)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        _write(os.path.join(work_dir, "out"), num_lines)
+        _write(os.path.join(work_dir, "ref"), num_lines)
+        size = os.path.getsize(os.path.join(work_dir, "out"))
+        print("output size: {0:8.1f} MB".format(size / 1.0e6))
+        for streaming in [False, True]:
+            peak, elapsed = _peak(streaming, work_dir)
+            print(
+                "streaming={0!s:5}  peak {1:8.1f} MB  {2:6.2f} s".format(
+                    streaming, peak / 1.0e6, elapsed
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Shows how cut_sections scales with the number of lines and anchor hits.
+
+The previous implementation scanned forward to the end anchor from every start
+anchor hit and matched regular expressions with a ".*" prefix. It is kept
+here for comparison and is only timed up to --max-legacy-lines because it is
+quadratic when start anchors repeat and the end anchor is far away.
+
+Usage: python benchmarks/cut_sections_scaling.py [--max-legacy-lines N]
+"""
+
+import os
+import re
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from runtest.scissors import cut_sections
+
+
+def _cut_sections_legacy(
+    text,
+    from_string=None,
+    from_is_re=False,
+    to_string=None,
+    to_is_re=False,
+    num_lines=0,
+):
+    output = []
+
+    for i, _ in enumerate(text):
+        start_line_matches = False
+        if from_is_re:
+            start_line_matches = re.match(r".*{0}".format(from_string), text[i])
+        else:
+            if from_string is None:
+                return text
+            else:
+                start_line_matches = from_string in text[i]
+
+        if start_line_matches:
+            if num_lines > 0:
+                for n in range(i, i + num_lines):
+                    output.append(text[n])
+            else:
+                for j in range(i, len(text)):
+                    end_line_matches = False
+                    if to_is_re:
+                        end_line_matches = re.match(r".*{0}".format(to_string), text[j])
+                    else:
+                        end_line_matches = to_string in text[j]
+
+                    if end_line_matches:
+                        for n in range(i, j + 1):
+                            output.append(text[n])
+                        break
+
+    return output
+
+
+def _text(num_lines, start_every, end_every):
+    text = []
+    for i in range(num_lines):
+        if i % start_every == 0:
+            text.append("  @ iteration {0} start\n".format(i))
+        elif end_every is not None and i % end_every == end_every - 1:
+            text.append("  @ iteration end\n")
+        else:
+            text.append("  {0:16.10f} {1:16.10f} {2:16.10f}\n".format(i, 0.5 * i, 0.25))
+    return text
+
+
+_cases = [
+    # name, start anchor every n lines, end anchor every n lines, anchors are regexes
+    ("closed sections, strings", 10, 10, False),
+    ("closed sections, regexes", 10, 10, True),
+    ("end anchor never found", 100, None, False),
+]
+
+
+def _timed(function, text, is_re):
+    if is_re:
+        kwargs = dict(from_string=r"@ iter\w+ \d+ start", from_is_re=True)
+        kwargs.update(to_string=r"@ iter\w+ end", to_is_re=True)
+    else:
+        kwargs = dict(from_string="start", to_string="@ iteration end")
+    t0 = time.perf_counter()
+    function(text, **kwargs)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--max-legacy-lines", type="int", default=100000)
+    (options, _args) = parser.parse_args()
+
+    print("{0:>28} {1:>9} {2:>12} {3:>12}".format("case", "lines", "new [s]", "legacy [s]"))
+    for name, start_every, end_every, is_re in _cases:
+        for num_lines in [10**4, 10**5, 10**6]:
+            text = _text(num_lines, start_every, end_every)
+            t_new = _timed(cut_sections, text, is_re)
+            if num_lines <= options.max_legacy_lines:
+                t_legacy = "{0:12.3f}".format(_timed(_cut_sections_legacy, text, is_re))
+            else:
+                t_legacy = "{0:>12}".format("skipped")
+            print("{0:>28} {1:>9} {2:12.3f} {3}".format(name, num_lines, t_new, t_legacy))
+
+
+if __name__ == "__main__":
+    main()
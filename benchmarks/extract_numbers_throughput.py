@@ -0,0 +1,119 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Compares numbers per second of extract_numbers against the previous
+implementation which recompiled its patterns on every call, matched every
+word separately and located numbers with line.index().
+
+Usage: python benchmarks/extract_numbers_throughput.py [number of lines]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from runtest.extract import extract_numbers
+
+
+def _extract_numbers_legacy(text, mask=None):
+    numeric_const_pattern = r"""
+    [-+]? # optional sign
+    (?:
+        (?: \d* \. \d+ ) # .1 .12 .123 etc 9.1 etc 98.1 etc
+        |
+        (?: \d+ \.? ) # 1. 12. 123. etc 1 12 123 etc
+    )
+    # followed by optional exponent part if desired
+    (?: [EeDd] [+-]? \d+ ) ?
+    """
+    pattern_number_and_separator = re.compile(r"^[0-9\.eEdD\+\-]+[,]?$", re.VERBOSE)
+    pattern_int = re.compile(r"-?[0-9]+", re.VERBOSE)
+    pattern_float = re.compile(numeric_const_pattern, re.VERBOSE)
+    pattern_d = re.compile(r"[dD]")
+
+    numbers = []
+    locations = []
+
+    for n, line in enumerate(text):
+        n_matches = 0
+        for w in line.split():
+            if not re.match(pattern_number_and_separator, w):
+                continue
+
+            n_matches += 1
+            if mask is not None and n_matches not in mask:
+                continue
+
+            is_integer = False
+            matched_floats = pattern_float.findall(w)
+
+            if len(matched_floats) > 0:
+                is_integer = matched_floats == pattern_int.findall(w)
+
+            for m in matched_floats:
+                index = line.index(m)
+                if is_integer:
+                    numbers.append(int(m))
+                else:
+                    m = pattern_d.sub("e", m)
+                    numbers.append(float(m))
+                locations.append((n, index, len(m)))
+
+    return numbers, locations
+
+
+_styles = {
+    "floats": "  {0:16.10f} {1:16.10f} {2:16.10f} {3:16.10f}\n",
+    "exponents": "  {0:16.8E} {1:16.8E} {2:16.8e} {3:16.8e}\n",
+    "integers": "  {0:8d} {1:8d} {2:8d} {3:8d}\n",
+    "text and numbers": "@ iteration {0:3d} energy: {1:16.10f} a.u. ({2:.2e}) {3:5.1f} s\n",
+}
+
+
+def _text(style, num_lines):
+    text = []
+    for i in range(num_lines):
+        values = (i, 0.5 * i, -0.25 * i, 1.0e-3 * i)
+        if style == "integers":
+            values = (i, -i, 2 * i, 7)
+        line = _styles[style].format(*values)
+        if style == "exponents":
+            # Fortran style exponent for the second number
+            line = line.replace("E", "D", 2).replace("D", "E", 1)
+        text.append(line)
+    return text
+
+
+def _numbers_per_second(function, text):
+    t0 = time.perf_counter()
+    numbers, _ = function(text)
+    return len(numbers) / (time.perf_counter() - t0)
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    print(
+        "{0:>18} {1:>16} {2:>16} {3:>9}".format(
+            "style", "new [num/s]", "legacy [num/s]", "speedup"
+        )
+    )
+    for style in _styles:
+        text = _text(style, num_lines)
+        assert extract_numbers(text)[0] == _extract_numbers_legacy(text)[0]
+        new = _numbers_per_second(extract_numbers, text)
+        legacy = _numbers_per_second(_extract_numbers_legacy, text)
+        print(
+            "{0:>18} {1:>16.3e} {2:>16.3e} {3:>9.2f}".format(
+                style, new, legacy, new / legacy
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Times number extraction from one large memory mapped file with an
+increasing number of processes.
+
+Usage: python benchmarks/extract_parallel.py [number of lines] [max processes]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from runtest.mapped import map_file
+
+
+def _write(file_name, num_lines):
+    with open(file_name, "w") as f:
+        for i in range(num_lines):
+            f.write(
+                "  {0:16.10f} {1:16.10f} {2:8d} {3:16.8e}\n".format(
+                    0.5 * i, -0.25 * i, i, 1.0e-3 * i
+                )
+            )
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    max_processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_name = os.path.join(work_dir, "out")
+        _write(file_name, num_lines)
+        mapped = map_file(file_name)
+        sections = mapped.join_sections([(0, len(mapped))])
+        print("size: {0:.1f} MB".format(sections.nbytes() / 1.0e6))
+
+        processes = 1
+        while processes <= max_processes:
+            t0 = time.perf_counter()
+            numbers = sections.extract_numbers(processes=processes, threshold=0)
+            elapsed = time.perf_counter() - t0
+            print(
+                "processes {0:3d}: {1:7.3f} s ({2} numbers)".format(
+                    processes, elapsed, len(numbers)
+                )
+            )
+            processes *= 2
+        mapped.close()
+
+
+if __name__ == "__main__":
+    main()
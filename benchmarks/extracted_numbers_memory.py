@@ -0,0 +1,59 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Compares the memory needed to hold extracted numbers and locations as Python
+lists against the array-backed ExtractedNumbers.
+
+Usage: python benchmarks/extracted_numbers_memory.py [number of lines]
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from runtest.extract import extract_numbers, extract_numbers_compact
+
+
+def _text(num_lines):
+    return [
+        "  {0:16.10f} {1:16.10f} {2:8d} {3:16.8e}\n".format(0.5 * i, -0.25 * i, i, 1.0e-3 * i)
+        for i in range(num_lines)
+    ]
+
+
+def _retained(function, text):
+    tracemalloc.start()
+    result = function(text)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 250000
+    text = _text(num_lines)
+
+    (numbers, _), list_size = _retained(extract_numbers, text)
+    extracted, compact_size = _retained(extract_numbers_compact, text)
+
+    n = len(numbers)
+    print("numbers: {0}".format(n))
+    print(
+        "lists:     {0:8.1f} MB ({1:5.1f} bytes per number)".format(
+            list_size / 1.0e6, list_size / n
+        )
+    )
+    print(
+        "compact:   {0:8.1f} MB ({1:5.1f} bytes per number)".format(
+            compact_size / 1.0e6, compact_size / n
+        )
+    )
+    print("nbytes():  {0:8.1f} MB".format(extracted.nbytes() / 1.0e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,8 @@ runtest: Numerically tolerant end-to-end test library for research software.
 """
 
 from .filter_constructor import get_filter
-from .run import run
+from .performance import get_performance_filter
+from .run import run, run_async, run_many
 from .version import version_info, __version__
 from .cli import cli
 
@@ -15,8 +16,11 @@ __author__ = "Radovan Bast <radovan.bast@uit.no>"
 
 __all__ = [
     "get_filter",
+    "get_performance_filter",
     "version_info",
     "run",
+    "run_async",
+    "run_many",
     "cli",
     __version__,
 ]
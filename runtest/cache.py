@@ -0,0 +1,600 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import hashlib
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from .copy import unshare
+from .extract import ExtractedNumbers
+from .report import Usage
+from .version import __version__
+
+
+# bump this when the layout of the entries changes
+_format_version = 1
+_magic = b"RTC%d" % _format_version
+# byte order, size of the "i" arrays, count of numbers, bytes of text,
+# bytes of the large integers
+_header = struct.Struct("<cBqqq")
+_byte_order = b"<" if sys.byteorder == "little" else b">"
+
+
+def default_cache_dir():
+    """
+    Returns:
+        directory - where cached data is kept unless told otherwise
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "runtest")
+
+
+def file_digest(file_name):
+    """
+    Returns:
+        digest - SHA-256 hex digest of the file content
+    """
+    h = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def filter_digest(f):
+    """
+    Hashes the parts of a filter which decide what is extracted, tolerances
+    and ignore_sign/ignore_order are applied later and are not part of it.
+
+    Returns:
+        digest - SHA-256 hex digest of the canonical filter spec
+    """
+    spec = {
+        "from_string": f.from_string,
+        "from_is_re": f.from_is_re,
+        "to_string": f.to_string,
+        "to_is_re": f.to_is_re,
+        "num_lines": f.num_lines,
+        "mask": None if f.mask is None else list(f.mask),
+    }
+    canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ReferenceCache:
+    """
+    Keeps the filtered text and the extracted numbers of reference files on
+    disk, one binary file per (reference content, filter, runtest version)
+    so that a new version never uses what an older one extracted.
+
+    Entries are evicted least recently used first once all of them together
+    take more than max_bytes.
+    """
+
+    suffix = ".rtc"
+
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = os.path.join(directory, "references")
+        self.max_bytes = max_bytes
+
+    def _path(self, digest, f):
+        key = hashlib.sha256(
+            (digest + filter_digest(f) + __version__).encode("ascii")
+        ).hexdigest()
+        return os.path.join(self.directory, key + self.suffix)
+
+    def digest(self, file_name):
+        """
+        Returns:
+            digest - the key under which the entries of file_name are kept
+        """
+        return file_digest(file_name)
+
+    def load(self, digest, f):
+        """
+        Returns:
+            entry - (filtered text, ExtractedNumbers) or None if not cached
+        """
+        path = self._path(digest, f)
+        try:
+            with open(path, "rb") as entry:
+                data = entry.read()
+            # reading counts as use for the eviction
+            os.utime(path)
+        except OSError:
+            return None
+        try:
+            return _decode(data)
+        except (ValueError, struct.error, UnicodeDecodeError):
+            # written by another version or truncated, it is replaced later
+            return None
+
+    def store(self, digest, f, text, numbers):
+        """
+        Stores an entry, write errors only mean that nothing is cached.
+        """
+        path = self._path(digest, f)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as entry:
+                entry.write(_encode(text, numbers))
+            # concurrent writers produce the same content
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        self.evict()
+
+    def entries(self):
+        """
+        Returns:
+            entries - list of (path, size, mtime), least recently used first
+        """
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime_ns))
+        entries.sort(key=lambda e: e[2])
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class MemoryReferenceCache:
+    """
+    Like ReferenceCache but keeps the entries in memory, for a process which
+    checks many times (runtest.daemon). Entries are kept encoded, so every
+    load returns numbers which the caller may modify.
+
+    A reference is hashed again when its size or modification time changed
+    and the entries of its old content are then dropped.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        # (size, mtime) and digest by file name
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, file_name):
+        st = os.stat(file_name)
+        file_name = os.path.abspath(file_name)
+        with self._lock:
+            known = self._digests.get(file_name)
+        if known is not None and known[0] == (st.st_size, st.st_mtime_ns):
+            return known[1]
+        digest = file_digest(file_name)
+        with self._lock:
+            self._digests[file_name] = ((st.st_size, st.st_mtime_ns), digest)
+            if known is not None and known[1] != digest:
+                for key in [k for k in self._entries if k[0] == known[1]]:
+                    self._size -= len(self._entries.pop(key))
+        return digest
+
+    def load(self, digest, f):
+        key = (digest, filter_digest(f))
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                return None
+            self._entries.move_to_end(key)
+        return _decode(data)
+
+    def store(self, digest, f, text, numbers):
+        key = (digest, filter_digest(f))
+        data = _encode(text, numbers)
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self):
+        """
+        Returns:
+            stats - number of entries, their size in bytes and known files
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "files": len(self._digests),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._digests.clear()
+            self._size = 0
+
+
+# digests of files which did not change since they were last hashed,
+# launchers are hashed for every test and can be large
+_digests = {}
+
+
+def cached_file_digest(file_name):
+    """
+    Like file_digest but only reads the file again if its size or
+    modification time changed.
+    """
+    st = os.stat(file_name)
+    key = (os.path.abspath(file_name), st.st_size, st.st_mtime_ns)
+    digest = _digests.get(key)
+    if digest is None:
+        digest = file_digest(file_name)
+        _digests[key] = digest
+    return digest
+
+
+def run_digest(launcher, command, run_dir, inputs):
+    """
+    Hashes everything which decides what a run produces: the launcher
+    binary, the command and the content of every file which the command or
+    the input files name.
+
+    Returns:
+        digest - SHA-256 hex digest
+    """
+    h = hashlib.sha256()
+    h.update(cached_file_digest(launcher).encode("ascii"))
+    if isinstance(command, str):
+        command = [command]
+    names = list(command) + _strings(inputs)
+    for name in names:
+        h.update(b"\0" + name.encode("utf-8", "surrogateescape"))
+        path = os.path.join(run_dir, name)
+        if os.path.isfile(path):
+            h.update(b"=" + cached_file_digest(path).encode("ascii"))
+    return h.hexdigest()
+
+
+class RunCache:
+    """
+    Keeps the outputs of runs on disk, one directory per run digest with
+    copies of the output files and a small JSON file with the resources the
+    run used.
+
+    Entries are evicted least recently used first once all of them together
+    take more than max_bytes.
+    """
+
+    def __init__(self, directory=None, max_bytes=1024 * 1024 * 1024):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = os.path.join(directory, "runs")
+        self.max_bytes = max_bytes
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def restore(self, digest, run_dir):
+        """
+        Copies the cached outputs into run_dir.
+
+        Returns:
+            usage - report.Usage of the cached run or None if not cached
+        """
+        path = self._path(digest)
+        try:
+            with open(os.path.join(path, "run.json")) as f:
+                entry = json.load(f)
+            for name in entry["files"]:
+                dst_file = os.path.join(run_dir, name)
+                unshare(dst_file)
+                shutil.copyfile(os.path.join(path, "files", name), dst_file)
+            # restoring counts as use for the eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return Usage(**entry["usage"])
+
+    def store(self, digest, run_dir, names, usage):
+        """
+        Stores the outputs names (relative to run_dir) of a run, write errors
+        only mean that nothing is cached.
+        """
+        path = self._path(digest)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = tempfile.mkdtemp(dir=self.directory, suffix=".tmp")
+            stored = []
+            for name in names:
+                src_file = os.path.join(run_dir, name)
+                if not os.path.isfile(src_file):
+                    continue
+                dst_file = os.path.join(tmp_path, "files", name)
+                os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+                shutil.copyfile(src_file, dst_file)
+                stored.append(name)
+            with open(os.path.join(tmp_path, "run.json"), "w") as f:
+                json.dump({"files": stored, "usage": usage._asdict()}, f)
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(tmp_path, path)
+        except OSError:
+            return
+        self.evict()
+
+    def entries(self):
+        """
+        Returns:
+            entries - list of (path, size, mtime), least recently used first
+        """
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp") or not os.path.isdir(path):
+                continue
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                size = sum(
+                    os.path.getsize(os.path.join(d, f))
+                    for d, _, files in os.walk(path)
+                    for f in files
+                )
+            except FileNotFoundError:
+                continue
+            entries.append((path, size, mtime))
+        entries.sort(key=lambda e: e[2])
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _strings(data):
+    # input files and extra arguments are whatever configure understands
+    if isinstance(data, str):
+        return [data]
+    if isinstance(data, dict):
+        return _strings(sorted(data.items(), key=str))
+    if isinstance(data, (list, tuple)):
+        return [s for d in data for s in _strings(d)]
+    if data is None:
+        return []
+    return [str(data)]
+
+
+def _arrays(numbers):
+    return [numbers.values, numbers.is_int, numbers.lines, numbers.starts, numbers.lengths]
+
+
+def _encode(text, numbers):
+    raw_text = text.encode("utf-8", "surrogatepass")
+    large_ints = json.dumps({str(i): str(n) for i, n in numbers.large_ints.items()})
+    raw_large_ints = large_ints.encode("ascii")
+    parts = [
+        _magic,
+        _header.pack(
+            _byte_order,
+            numbers.lines.itemsize,
+            len(numbers),
+            len(raw_text),
+            len(raw_large_ints),
+        ),
+        raw_text,
+    ]
+    parts.extend(a.tobytes() for a in _arrays(numbers))
+    parts.append(raw_large_ints)
+    return b"".join(parts)
+
+
+def _decode(data):
+    if data[: len(_magic)] != _magic:
+        raise ValueError("not a cache entry")
+    position = len(_magic)
+    byte_order, int_size, count, text_size, large_ints_size = _header.unpack_from(
+        data, position
+    )
+    position += _header.size
+
+    numbers = ExtractedNumbers()
+    if byte_order != _byte_order or int_size != numbers.lines.itemsize:
+        raise ValueError("cache entry written on a different platform")
+
+    text = data[position : position + text_size].decode("utf-8", "surrogatepass")
+    position += text_size
+    for a in _arrays(numbers):
+        size = a.itemsize * count
+        if position + size > len(data):
+            raise ValueError("truncated cache entry")
+        a.frombytes(data[position : position + size])
+        position += size
+    large_ints = json.loads(data[position : position + large_ints_size])
+    numbers.large_ints = {int(i): int(n) for i, n in large_ints.items()}
+    return text, numbers
+
+
+def test_reference_cache(tmpdir):
+    from .extract import extract_numbers_compact
+    from .filter_constructor import get_filter
+
+    reference = tmpdir.join("ref.txt")
+    reference.write("energy -1.5 2 12345678901234567890 é\n")
+    digest = file_digest(str(reference))
+    f = get_filter(string="energy", rel_tolerance=1.0e-8)
+
+    cache = ReferenceCache(str(tmpdir.join("cache")), max_bytes=1000)
+    assert cache.load(digest, f) is None
+
+    text = reference.read()
+    numbers = extract_numbers_compact([text])
+    cache.store(digest, f, text, numbers)
+    cached_text, cached_numbers = cache.load(digest, f)
+    assert cached_text == text
+    assert list(cached_numbers) == list(numbers)
+    assert cached_numbers.locations() == numbers.locations()
+
+    # tolerances do not change what is extracted, anchors and masks do
+    assert cache.load(digest, get_filter(string="energy", abs_tolerance=0.1))
+    assert cache.load(digest, get_filter(string="energy", mask=[1])) is None
+    assert cache.load(file_digest(__file__), f) is None
+
+    # least recently used entries go first
+    for k, mask in enumerate([[1], [2], [3]]):
+        g = get_filter(string="energy", mask=mask)
+        cache.store(digest, g, text, numbers)
+        os.utime(cache._path(digest, g), ns=(k, k))
+    cache.load(digest, get_filter(string="energy", mask=[1]))
+    cache.max_bytes = 400
+    cache.evict()
+    kept = [path for path, _, _ in cache.entries()]
+    assert len(kept) == 2
+    assert cache._path(digest, get_filter(string="energy", mask=[1])) in kept
+    assert cache._path(digest, get_filter(string="energy", mask=[2])) not in kept
+
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_reference_cache_version(tmpdir, monkeypatch):
+    from . import cache as module
+    from .extract import extract_numbers_compact
+    from .filter_constructor import get_filter
+
+    f = get_filter()
+    cache = ReferenceCache(str(tmpdir))
+    cache.store("0", f, "1 2 3\n", extract_numbers_compact(["1 2 3\n"]))
+    assert cache.load("0", f) is not None
+    # another version may extract differently
+    monkeypatch.setattr(module, "__version__", "0.0.0")
+    assert cache.load("0", f) is None
+
+
+def test_reference_cache_corrupt_entry(tmpdir):
+    from .extract import extract_numbers_compact
+    from .filter_constructor import get_filter
+
+    f = get_filter()
+    cache = ReferenceCache(str(tmpdir))
+    cache.store("0", f, "1 2 3\n", extract_numbers_compact(["1 2 3\n"]))
+    (path, _, _) = cache.entries()[0]
+    with open(path, "r+b") as entry:
+        entry.truncate(20)
+    assert cache.load("0", f) is None
+
+
+def test_memory_reference_cache(tmpdir):
+    from .extract import extract_numbers_compact
+    from .filter_constructor import get_filter
+
+    reference = tmpdir.join("ref.txt")
+    reference.write("energy -1.5 2\n")
+    f = get_filter(string="energy", rel_tolerance=1.0e-8)
+    cache = MemoryReferenceCache()
+    digest = cache.digest(str(reference))
+    assert digest == file_digest(str(reference))
+
+    text = reference.read()
+    cache.store(digest, f, text, extract_numbers_compact([text]))
+    cached_text, cached_numbers = cache.load(digest, f)
+    assert (cached_text, list(cached_numbers)) == (text, [-1.5, 2])
+    cached_numbers.apply_abs()
+    assert list(cache.load(digest, f)[1]) == [-1.5, 2]
+
+    # a changed reference is hashed again and its old entries go
+    reference.write("energy -2.5 2\n")
+    os.utime(str(reference), ns=(1, 1))
+    assert cache.digest(str(reference)) != digest
+    assert cache.load(digest, f) is None
+    assert cache.stats()["entries"] == 0
+
+    # least recently used entries go first
+    cache.max_bytes = 2 * len(_encode(text, extract_numbers_compact([text])))
+    for mask in [[1], [2], [1], [3]]:
+        g = get_filter(string="energy", mask=mask)
+        if cache.load(digest, g) is None:
+            cache.store(digest, g, text, extract_numbers_compact([text]))
+    assert cache.load(digest, get_filter(string="energy", mask=[1])) is not None
+    assert cache.load(digest, get_filter(string="energy", mask=[2])) is None
+    assert cache.stats()["entries"] == 2
+
+
+def test_run_cache(tmpdir):
+    run_dir = tmpdir.mkdir("run")
+    run_dir.join("launcher").write("binary")
+    run_dir.join("a.inp").write("a")
+    launcher = str(run_dir.join("launcher"))
+    inputs = [["a.inp", "b.mol"], None]
+    digest = run_digest(launcher, ["launcher", "a.inp"], str(run_dir), inputs)
+
+    assert run_digest(launcher, "launcher a.inp", str(run_dir), inputs) != digest
+    run_dir.join("a.inp").write("bb")
+    assert run_digest(launcher, ["launcher", "a.inp"], str(run_dir), inputs) != digest
+
+    cache = RunCache(str(tmpdir.join("cache")))
+    assert cache.restore(digest, str(run_dir)) is None
+    run_dir.join("a.stdout").write("energy 1.0\n")
+    usage = Usage(1.5, 1.0, 0.5, 2**20)
+    cache.store(digest, str(run_dir), ["a.stdout", "a.out"], usage)
+
+    other = tmpdir.mkdir("other")
+    assert cache.restore(digest, str(other)) == usage
+    assert other.join("a.stdout").read() == "energy 1.0\n"
+    assert other.listdir() == [other.join("a.stdout")]
+
+    # least recently used entries go first
+    cache.store("0", str(run_dir), ["a.stdout"], usage)
+    os.utime(cache._path("0"), ns=(0, 0))
+    cache.max_bytes = max(size for _, size, _ in cache.entries())
+    cache.evict()
+    assert [os.path.basename(path) for path, _, _ in cache.entries()] == [digest]
+
+    cache.clear()
+    assert cache.entries() == []
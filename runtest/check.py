@@ -2,16 +2,34 @@
 #
 # SPDX-License-Identifier: MPL-2.0
 
+from .copy import unshare
 from .exceptions import FilterKeywordError, FailedTestError, BadFilterError
-from .extract import extract_numbers
+from .extract import extract_numbers_compact, ExtractedNumbers
 from .filter_api import recognized_kw
 from .filter_constructor import get_filter
-from .scissors import cut_sections
-from .tuple_comparison import tuple_matches
+from .mapped import map_file, MappedFile, MappedSections, default_parallel_threshold
+from .scissors import section_bounds, join_sections, stream_sections, SectionCutter
+from .tuple_comparison import find_mismatches
+import codecs
+import io
+import locale
 import os
-
-
-def check(filter_list, out_name, ref_name, log_dir, verbose=False):
+import shutil
+import tempfile
+
+
+def check(
+    filter_list,
+    out_name,
+    ref_name,
+    log_dir,
+    verbose=False,
+    streaming=False,
+    use_mmap=False,
+    processes=1,
+    parallel_threshold=default_parallel_threshold,
+    reference_cache=None,
+):
     """
     Compares output with reference applying all filters tasks from the list of
     filters.
@@ -22,6 +40,15 @@ def check(filter_list, out_name, ref_name, log_dir, verbose=False):
         - ref_name -- reference output file name
         - log_dir -- directory which will hold logs
         - verbose  -- give verbose output upon failure
+        - streaming -- compare section by section with bounded memory
+        - use_mmap -- find sections and numbers on memory mapped files
+        - processes -- extract numbers from large files in a process pool,
+                       this implies use_mmap
+        - parallel_threshold -- files with fewer bytes in the filtered
+                                sections are parsed in this process
+        - reference_cache -- cache.ReferenceCache (or MemoryReferenceCache)
+                             for filtered and parsed references, not used
+                             when streaming
 
     Returns:
         - nothing
@@ -35,140 +62,123 @@ def check(filter_list, out_name, ref_name, log_dir, verbose=False):
         - FailedTestError
     """
 
-    def _tuple_matches(t):
-        if f.tolerance_is_relative:
-            error_definition = "relative"
-        else:
-            error_definition = "absolute"
-        return tuple_matches(
-            t,
-            tolerance=f.tolerance,
-            error_definition=error_definition,
-            ignore_sign=f.ignore_sign,
-            skip_below=f.skip_below,
-            skip_above=f.skip_above,
-        )
+    if streaming:
+        _check_streaming(filter_list, out_name, ref_name, log_dir)
+        _raise_if_failed(out_name, verbose)
+        return
 
     name_out = os.path.join(log_dir, out_name + ".filtered")
     name_ref = os.path.join(log_dir, out_name + ".reference")
     name_diff = os.path.join(log_dir, out_name + ".diff")
-
-    with open(name_out, "w") as log_out:
-        with open(name_ref, "w") as log_ref:
-            with open(name_diff, "w") as log_diff:
-                for f in filter_list:
-                    out_filtered = cut_sections(
-                        open(out_name).readlines(),
-                        from_string=f.from_string,
-                        from_is_re=f.from_is_re,
-                        to_string=f.to_string,
-                        to_is_re=f.to_is_re,
-                        num_lines=f.num_lines,
-                    )
-                    if out_filtered == []:
-                        if f.num_lines > 0:
-                            r = '[%i lines from "%s"]' % (f.num_lines, f.from_string)
-                        else:
-                            r = '["%s" ... "%s"]' % (f.from_string, f.to_string)
-                        message = (
-                            "ERROR: filter %s did not extract anything from file %s\n"
-                            % (r, out_name)
+    for name in [name_out, name_ref, name_diff]:
+        unshare(name)
+
+    # each file is read once and all filters are applied in one pass over it,
+    # the reference is only read once the first filter needs it
+    use_mmap = use_mmap or processes > 1
+    out_text, out_sections = _read_sections(out_name, filter_list, use_mmap)
+    ref_text = None
+    ref_sections = None
+    ref_digest = None
+
+    # mappings are closed here and not left to the garbage collector, an
+    # open mapping keeps the file locked on Windows
+    try:
+        with open(name_out, "w") as log_out:
+            with open(name_ref, "w") as log_ref:
+                with open(name_diff, "w") as log_diff:
+                    for k, f in enumerate(filter_list):
+                        out_filtered = _join_sections(out_text, out_sections[k])
+                        _check_filtered(out_filtered, f, out_name)
+
+                        log_out.write(_joined(out_filtered))
+                        out_numbers = _extract(
+                            out_filtered, f.mask, processes, parallel_threshold
                         )
-                        raise BadFilterError(message)
+                        if f.mask is not None and len(out_numbers) == 0:
+                            raise FilterKeywordError(
+                                "ERROR: mask %s did not extract any numbers\n" % f.mask
+                            )
 
-                    log_out.write("".join(out_filtered))
-                    out_numbers, out_locations = extract_numbers(out_filtered, f.mask)
-                    if f.mask is not None and out_numbers == []:
-                        raise FilterKeywordError(
-                            "ERROR: mask %s did not extract any numbers\n" % f.mask
-                        )
+                        cached = None
+                        if reference_cache is not None:
+                            if ref_digest is None:
+                                ref_digest = reference_cache.digest(ref_name)
+                            cached = reference_cache.load(ref_digest, f)
 
-                    ref_filtered = cut_sections(
-                        open(ref_name).readlines(),
-                        from_string=f.from_string,
-                        from_is_re=f.from_is_re,
-                        to_string=f.to_string,
-                        to_is_re=f.to_is_re,
-                        num_lines=f.num_lines,
-                    )
-                    if ref_filtered == []:
-                        if f.num_lines > 0:
-                            r = '[%i lines from "%s"]' % (f.num_lines, f.from_string)
+                        if cached is not None:
+                            ref_joined, ref_numbers = cached
+                            ref_filtered = _split_lines(ref_joined)
+                            log_ref.write(ref_joined)
                         else:
-                            r = '["%s" ... "%s"]' % (f.from_string, f.to_string)
-                        message = (
-                            "ERROR: filter %s did not extract anything from file %s\n"
-                            % (r, ref_name)
-                        )
-                        raise BadFilterError(message)
+                            if ref_text is None:
+                                ref_text, ref_sections = _read_sections(
+                                    ref_name, filter_list, use_mmap
+                                )
+                            ref_filtered = _join_sections(ref_text, ref_sections[k])
+                            _check_filtered(ref_filtered, f, ref_name)
+
+                            ref_joined = _joined(ref_filtered)
+                            log_ref.write(ref_joined)
+                            ref_numbers = _extract(
+                                ref_filtered, f.mask, processes, parallel_threshold
+                            )
+                            if f.mask is not None and len(ref_numbers) == 0:
+                                raise FilterKeywordError(
+                                    "ERROR: mask %s did not extract any numbers\n" % f.mask
+                                )
+                            if reference_cache is not None:
+                                reference_cache.store(ref_digest, f, ref_joined, ref_numbers)
+
+                        if f.ignore_sign:
+                            out_numbers.apply_abs()
+                            ref_numbers.apply_abs()
+
+                        if f.ignore_order:
+                            out_numbers.sort()
+                            ref_numbers.sort()
+
+                        if len(out_numbers) == 0 and len(ref_numbers) == 0:
+                            # no numbers are extracted
+                            if out_filtered != ref_filtered:
+                                log_diff.write("ERROR: extracted strings do not match\n")
+                                log_diff.write("own gave:\n")
+                                log_diff.write(_joined(out_filtered) + "\n")
+                                log_diff.write("reference gave:\n")
+                                log_diff.write(ref_joined + "\n")
+
+                        # we need to check for len(out_numbers) > 0
+                        # for pure strings len(out_numbers) is 0
+                        # TODO need to consider what to do with pure strings in future versions
+                        if len(out_numbers) == len(ref_numbers) and len(out_numbers) > 0:
+                            if not f.tolerance_is_set and (
+                                out_numbers.has_floats() or ref_numbers.has_floats()
+                            ):
+                                raise FilterKeywordError(
+                                    "ERROR: for floats you have to specify either rel_tolerance or abs_tolerance\n"
+                                )
+                            mismatches = _find_mismatches(f, out_numbers, ref_numbers)
+                            if mismatches:
+                                _write_mismatches(
+                                    log_diff, out_filtered, out_numbers, mismatches
+                                )
+
+                        if len(out_numbers) != len(ref_numbers):
+                            log_diff.write("ERROR: extracted sizes do not match\n")
+                            log_diff.write("own gave %i numbers:\n" % len(out_numbers))
+                            log_diff.write(_joined(out_filtered) + "\n")
+                            log_diff.write(
+                                "reference gave %i numbers:\n" % len(ref_numbers)
+                            )
+                            log_diff.write(ref_joined + "\n")
 
-                    log_ref.write("".join(ref_filtered))
-                    ref_numbers, _ = extract_numbers(ref_filtered, f.mask)
-                    if f.mask is not None and ref_numbers == []:
-                        raise FilterKeywordError(
-                            "ERROR: mask %s did not extract any numbers\n" % f.mask
-                        )
+    finally:
+        _close(out_text)
+        _close(ref_text)
+    _raise_if_failed(out_name, verbose)
 
-                    if f.ignore_sign:
-                        out_numbers = list(map(abs, out_numbers))
-                        ref_numbers = list(map(abs, ref_numbers))
-
-                    if f.ignore_order:
-                        out_numbers = sorted(out_numbers)
-                        ref_numbers = sorted(ref_numbers)
-
-                    if out_numbers == [] and ref_numbers == []:
-                        # no numbers are extracted
-                        if out_filtered != ref_filtered:
-                            log_diff.write("ERROR: extracted strings do not match\n")
-                            log_diff.write("own gave:\n")
-                            log_diff.write("".join(out_filtered) + "\n")
-                            log_diff.write("reference gave:\n")
-                            log_diff.write("".join(ref_filtered) + "\n")
-
-                    # we need to check for len(out_numbers) > 0
-                    # for pure strings len(out_numbers) is 0
-                    # TODO need to consider what to do with pure strings in future versions
-                    if len(out_numbers) == len(ref_numbers) and len(out_numbers) > 0:
-                        if not f.tolerance_is_set and (
-                            any(map(lambda x: isinstance(x, float), out_numbers))
-                            or any(map(lambda x: isinstance(x, float), ref_numbers))
-                        ):
-                            raise FilterKeywordError(
-                                "ERROR: for floats you have to specify either rel_tolerance or abs_tolerance\n"
-                            )
-                        list_of_tuples = map(
-                            _tuple_matches, zip(out_numbers, ref_numbers)
-                        )
-                        matching, errors = zip(
-                            *list_of_tuples
-                        )  # unzip tuples to two lists
-                        if not all(matching):
-                            log_diff.write("\n")
-                            for k, line in enumerate(out_filtered):
-                                log_diff.write(".       %s" % line)
-                                for i, _ in enumerate(out_numbers):
-                                    (line_num, start_char, length) = out_locations[i]
-                                    if line_num == k:
-                                        if errors[i]:
-                                            log_diff.write(
-                                                "ERROR   %s%s %s\n"
-                                                % (
-                                                    " " * start_char,
-                                                    "#" * length,
-                                                    errors[i],
-                                                )
-                                            )
-
-                    if len(out_numbers) != len(ref_numbers):
-                        log_diff.write("ERROR: extracted sizes do not match\n")
-                        log_diff.write("own gave %i numbers:\n" % len(out_numbers))
-                        log_diff.write("".join(out_filtered) + "\n")
-                        log_diff.write(
-                            "reference gave %i numbers:\n" % len(ref_numbers)
-                        )
-                        log_diff.write("".join(ref_filtered) + "\n")
 
+def _raise_if_failed(out_name, verbose):
     if os.path.getsize("%s.diff" % out_name) > 0:
         log_diff = open("%s.diff" % out_name, "r")
         diff = ""
@@ -181,6 +191,503 @@ def check(filter_list, out_name, ref_name, log_dir, verbose=False):
         raise FailedTestError(message)
 
 
+def _find_mismatches(f, out_numbers, ref_numbers):
+    if f.tolerance_is_relative:
+        error_definition = "relative"
+    else:
+        error_definition = "absolute"
+    return find_mismatches(
+        out_numbers,
+        ref_numbers,
+        tolerance=f.tolerance,
+        error_definition=error_definition,
+        ignore_sign=f.ignore_sign,
+        skip_below=f.skip_below,
+        skip_above=f.skip_above,
+    )
+
+
+def _read_sections(file_name, filter_list, use_mmap):
+    if use_mmap:
+        mapped = map_file(file_name)
+        if mapped is not None:
+            bounds = mapped.section_bounds(filter_list)
+            if bounds is not None:
+                # check() closes it
+                return mapped, bounds
+            mapped.close()
+    text = _read_lines(file_name)
+    return text, section_bounds(text, filter_list)
+
+
+def _close(text):
+    if isinstance(text, MappedFile):
+        text.close()
+
+
+def _join_sections(text, bounds):
+    if isinstance(text, MappedFile):
+        return text.join_sections(bounds)
+    return join_sections(text, bounds)
+
+
+def _joined(filtered):
+    if isinstance(filtered, MappedSections):
+        return filtered.text()
+    return "".join(filtered)
+
+
+def _extract(filtered, mask, processes, parallel_threshold):
+    if isinstance(filtered, MappedSections):
+        return filtered.extract_numbers(mask, processes, parallel_threshold)
+    return extract_numbers_compact(filtered, mask)
+
+
+def _split_lines(text):
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last != "":
+        lines.append(last)
+    return lines
+
+
+def _read_lines(file_name):
+    with open(file_name) as f:
+        return f.readlines()
+
+
+class LiveCheck:
+    """
+    Compares the sections of the filters marked as early with the reference
+    while the output file is still being written. A section is compared
+    once it is complete: when its end anchor or all of its num_lines lines
+    have appeared.
+
+    Filters which compare the whole file or ignore the order of numbers
+    across sections can only be verified once the output is complete and
+    are left to check().
+    """
+
+    def __init__(self, filter_list, out_name, ref_name):
+        self.filter_list = [
+            f
+            for f in filter_list
+            if getattr(f, "early", False)
+            and f.from_string is not None
+            and not f.ignore_order
+        ]
+        self.out_name = out_name
+        self.ref_name = ref_name
+        self.failure = None
+        # the output is not kept, only the lines of sections still open
+        self._cutters = [
+            SectionCutter(
+                f.from_string, f.from_is_re, f.to_string, f.to_is_re, f.num_lines
+            )
+            for f in self.filter_list
+        ]
+        self._tail = ""
+        self._offset = 0
+        self._decoder = codecs.getincrementaldecoder(
+            locale.getpreferredencoding(False)
+        )(errors="replace")
+        self._checked = [0] * len(self.filter_list)
+        self._ref_text = None
+        self._ref_bounds = None
+
+    def poll(self):
+        """
+        Reads what was appended to the output and compares the sections
+        which were completed since the last call.
+
+        Returns:
+            failed - True once a section did not match, the error message
+                     is then in failure
+        """
+        if self.failure is not None:
+            return True
+        if self.filter_list == []:
+            return False
+        lines = self._read()
+        if lines == []:
+            return False
+        if self._ref_text is None:
+            try:
+                self._ref_text = _read_lines(self.ref_name)
+            except OSError:
+                # check() reports the missing reference
+                self.filter_list = []
+                return False
+            self._ref_bounds = section_bounds(self._ref_text, self.filter_list)
+
+        for k, f in enumerate(self.filter_list):
+            for section in self._cutters[k].feed(lines):
+                i = self._checked[k]
+                self._checked[k] += 1
+                self.failure = self._compare(f, i, section, self._ref_bounds[k])
+                if self.failure is not None:
+                    return True
+        return False
+
+    def _read(self):
+        """
+        Returns:
+            lines - complete lines appended since the last call, the rest
+                    waits for the next call
+        """
+        try:
+            with open(self.out_name, "rb") as f:
+                if os.fstat(f.fileno()).st_size < self._offset:
+                    # the file was written anew
+                    return []
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        if data == b"":
+            return []
+        self._offset += len(data)
+        lines = (self._tail + self._decoder.decode(data)).split("\n")
+        self._tail = lines.pop()
+        return [line + "\n" for line in lines]
+
+    def _compare(self, f, i, out_filtered, ref_bounds):
+        location = "section %i of %s" % (i + 1, self.out_name)
+        if i >= len(ref_bounds):
+            return "ERROR: %s has no counterpart in the reference\n" % location
+        if ref_bounds[i][1] > len(self._ref_text):
+            # check() reports the reference which ends too early
+            return None
+        ref_filtered = join_sections(self._ref_text, [ref_bounds[i]])
+        out_numbers = extract_numbers_compact(out_filtered, f.mask)
+        ref_numbers = extract_numbers_compact(ref_filtered, f.mask)
+
+        if len(out_numbers) != len(ref_numbers):
+            return "ERROR: %s gave %i numbers, the reference %i\n%s" % (
+                location,
+                len(out_numbers),
+                len(ref_numbers),
+                "".join(out_filtered),
+            )
+        if len(out_numbers) == 0:
+            if out_filtered != ref_filtered:
+                return "ERROR: strings in %s do not match the reference\n%s" % (
+                    location,
+                    "".join(out_filtered),
+                )
+            return None
+        if not f.tolerance_is_set and (
+            out_numbers.has_floats() or ref_numbers.has_floats()
+        ):
+            # check() reports the missing tolerance
+            return None
+
+        if f.ignore_sign:
+            out_numbers.apply_abs()
+            ref_numbers.apply_abs()
+        mismatches = _find_mismatches(f, out_numbers, ref_numbers)
+        if not mismatches:
+            return None
+        diff = io.StringIO()
+        _write_marked_lines(diff, out_filtered, out_numbers, mismatches)
+        return "ERROR: %s does not match the reference\n%s" % (location, diff.getvalue())
+
+
+def _write_mismatches(log_diff, out_filtered, out_numbers, mismatches):
+    log_diff.write("\n")
+    _write_marked_lines(log_diff, out_filtered, out_numbers, mismatches)
+
+
+def _write_marked_lines(log_diff, out_filtered, out_numbers, mismatches):
+    errors_by_line = {}
+    for i, error in mismatches:
+        errors_by_line.setdefault(out_numbers.lines[i], []).append((i, error))
+
+    for k, line in enumerate(out_filtered):
+        log_diff.write(".       %s" % line)
+        for i, error in errors_by_line.get(k, []):
+            log_diff.write(
+                "ERROR   %s%s %s\n"
+                % (" " * out_numbers.starts[i], "#" * out_numbers.lengths[i], error)
+            )
+
+
+def _check_filtered(filtered, f, file_name):
+    if filtered == []:
+        _raise_bad_filter(f, file_name)
+
+
+def _raise_bad_filter(f, file_name):
+    if f.num_lines > 0:
+        r = '[%i lines from "%s"]' % (f.num_lines, f.from_string)
+    else:
+        r = '["%s" ... "%s"]' % (f.from_string, f.to_string)
+    message = "ERROR: filter %s did not extract anything from file %s\n" % (
+        r,
+        file_name,
+    )
+    raise BadFilterError(message)
+
+
+def _check_streaming(filter_list, out_name, ref_name, log_dir, chunk_lines=10000):
+    # output and reference are walked in lockstep, chunk_lines lines of
+    # filtered output at a time, and everything which has to be looked at
+    # again once the sizes are known is kept in temporary files
+    name_out = os.path.join(log_dir, out_name + ".filtered")
+    name_ref = os.path.join(log_dir, out_name + ".reference")
+    name_diff = os.path.join(log_dir, out_name + ".diff")
+    for name in [name_out, name_ref, name_diff]:
+        unshare(name)
+
+    with open(name_out, "w") as log_out:
+        with open(name_ref, "w") as log_ref:
+            with open(name_diff, "w") as log_diff:
+                for f in filter_list:
+                    with _LineSpool() as out_spool, _LineSpool() as ref_spool:
+                        with tempfile.TemporaryFile("w+") as marked:
+                            _stream_filter(
+                                f,
+                                out_name,
+                                ref_name,
+                                log_out,
+                                log_ref,
+                                log_diff,
+                                out_spool,
+                                ref_spool,
+                                marked,
+                                chunk_lines,
+                            )
+
+
+def _stream_filter(
+    f,
+    out_name,
+    ref_name,
+    log_out,
+    log_ref,
+    log_diff,
+    out_spool,
+    ref_spool,
+    marked,
+    chunk_lines,
+):
+    def _sections(lines):
+        return stream_sections(
+            lines,
+            from_string=f.from_string,
+            from_is_re=f.from_is_re,
+            to_string=f.to_string,
+            to_is_re=f.to_is_re,
+            num_lines=f.num_lines,
+        )
+
+    def _ref_chunks():
+        with open(ref_name) as ref_file:
+            for chunk in _chunks(_sections(ref_file), chunk_lines):
+                log_ref.write("".join(chunk))
+                ref_spool.extend(chunk)
+                yield extract_numbers_compact(chunk, f.mask)
+
+    # with ignore_order all numbers are needed before anything can be
+    # compared, then only the numbers are kept but not the text
+    out_all = ExtractedNumbers()
+    ref = None
+    num_out = 0
+    out_has_floats = False
+    comparable = True
+    comparison_error = None
+    mismatched = False
+
+    with open(out_name) as out_file:
+        for chunk in _chunks(_sections(out_file), chunk_lines):
+            log_out.write("".join(chunk))
+            line_offset = out_spool.count
+            out_spool.extend(chunk)
+            out_numbers = extract_numbers_compact(chunk, f.mask)
+            num_out += len(out_numbers)
+            out_has_floats = out_has_floats or out_numbers.has_floats()
+
+            if f.ignore_order:
+                out_all.extend(out_numbers, line_offset)
+                continue
+
+            mismatches = []
+            if len(out_numbers) > 0:
+                if ref is None:
+                    ref = _NumberQueue(_ref_chunks())
+                ref_numbers = ref.take(len(out_numbers))
+                if len(ref_numbers) < len(out_numbers):
+                    comparable = False
+                if comparable:
+                    if f.ignore_sign:
+                        out_numbers.apply_abs()
+                        ref_numbers = [abs(x) for x in ref_numbers]
+                    try:
+                        mismatches = _find_mismatches(f, out_numbers, ref_numbers)
+                    except TypeError as e:
+                        # without a tolerance the comparison fails, this is
+                        # reported like in check() once the sizes are known
+                        if f.tolerance_is_set:
+                            raise
+                        comparison_error = e
+                        comparable = False
+                    mismatched = mismatched or mismatches != []
+            _write_marked_lines(marked, chunk, out_numbers, mismatches)
+
+    if out_spool.count == 0:
+        _raise_bad_filter(f, out_name)
+    if f.mask is not None and num_out == 0:
+        raise FilterKeywordError("ERROR: mask %s did not extract any numbers\n" % f.mask)
+
+    if ref is None:
+        ref = _NumberQueue(_ref_chunks())
+    ref_all = ref.drain(keep=f.ignore_order)
+
+    if ref_spool.count == 0:
+        _raise_bad_filter(f, ref_name)
+    if f.mask is not None and ref.count == 0:
+        raise FilterKeywordError("ERROR: mask %s did not extract any numbers\n" % f.mask)
+
+    if num_out == 0 and ref.count == 0:
+        # no numbers are extracted
+        if not out_spool.same_lines(ref_spool):
+            log_diff.write("ERROR: extracted strings do not match\n")
+            log_diff.write("own gave:\n")
+            out_spool.copy_to(log_diff)
+            log_diff.write("\n")
+            log_diff.write("reference gave:\n")
+            ref_spool.copy_to(log_diff)
+            log_diff.write("\n")
+
+    if num_out == ref.count and num_out > 0:
+        if not f.tolerance_is_set and (out_has_floats or ref.has_floats):
+            raise FilterKeywordError(
+                "ERROR: for floats you have to specify either rel_tolerance or abs_tolerance\n"
+            )
+        if comparison_error is not None:
+            raise comparison_error
+        if f.ignore_order:
+            if f.ignore_sign:
+                out_all.apply_abs()
+                ref_all.apply_abs()
+            out_all.sort()
+            ref_all.sort()
+            mismatches = _find_mismatches(f, out_all, ref_all)
+            if mismatches:
+                _write_mismatches(log_diff, out_spool, out_all, mismatches)
+        elif mismatched:
+            log_diff.write("\n")
+            marked.seek(0)
+            shutil.copyfileobj(marked, log_diff)
+
+    if num_out != ref.count:
+        log_diff.write("ERROR: extracted sizes do not match\n")
+        log_diff.write("own gave %i numbers:\n" % num_out)
+        out_spool.copy_to(log_diff)
+        log_diff.write("\n")
+        log_diff.write("reference gave %i numbers:\n" % ref.count)
+        ref_spool.copy_to(log_diff)
+        log_diff.write("\n")
+
+
+def _chunks(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class _NumberQueue:
+    """
+    Hands out reference numbers in the amounts in which output numbers come.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._current = []
+        self._position = 0
+        self.count = 0
+        self.has_floats = False
+
+    def _next_chunk(self):
+        for chunk in self._chunks:
+            self.count += len(chunk)
+            self.has_floats = self.has_floats or chunk.has_floats()
+            return chunk
+        return None
+
+    def take(self, n):
+        taken = []
+        while len(taken) < n:
+            if self._position == len(self._current):
+                chunk = self._next_chunk()
+                if chunk is None:
+                    break
+                self._current = list(chunk)
+                self._position = 0
+                continue
+            end = self._position + n - len(taken)
+            taken.extend(self._current[self._position : end])
+            self._position = min(end, len(self._current))
+        return taken
+
+    def drain(self, keep=False):
+        kept = ExtractedNumbers()
+        while True:
+            chunk = self._next_chunk()
+            if chunk is None:
+                return kept
+            if keep:
+                kept.extend(chunk)
+
+
+class _LineSpool:
+    """
+    Keeps lines in a temporary file so that they can be read again.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile("w+")
+        # the last line of a file may lack the newline
+        self._unterminated = set()
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+    def extend(self, lines):
+        for line in lines:
+            if not line.endswith("\n"):
+                self._unterminated.add(self.count)
+                line += "\n"
+            self._file.write(line)
+            self.count += 1
+
+    def __iter__(self):
+        self._file.seek(0)
+        for i, line in enumerate(self._file):
+            if i in self._unterminated:
+                line = line[:-1]
+            yield line
+
+    def copy_to(self, f):
+        for line in self:
+            f.write(line)
+
+    def same_lines(self, other):
+        if self.count != other.count:
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+
 def _test_setup(folder, filters):
     _here = os.path.abspath(os.path.dirname(__file__))
     test_dir = os.path.join(_here, "test", folder)
@@ -388,3 +895,210 @@ def test_check_integers():
     assert "ERROR: test %s failed\n" % out_name in str(e.value)
 
     _test_setup(folder="integers", filters=[get_filter(rel_tolerance=1.0)])
+
+
+def test_check_multiple_filters():
+    _here = os.path.abspath(os.path.dirname(__file__))
+    test_dir = os.path.join(_here, "test", "generic")
+
+    _test_setup(
+        folder="generic",
+        filters=[
+            get_filter(abs_tolerance=0.1),
+            get_filter(string="2.0", abs_tolerance=0.1),
+        ],
+    )
+    with open(os.path.join(test_dir, "out.txt.filtered"), "r") as f:
+        assert f.read() == "1.0 2.0 3.0\n1.0 2.0 3.0\n"
+    with open(os.path.join(test_dir, "out.txt.reference"), "r") as f:
+        assert f.read() == "1.0 2.0 3.05\n1.0 2.0 3.05\n"
+
+
+def test_check_streaming(tmpdir):
+    import random
+
+    def _outcome(filters, streaming, chunk_lines):
+        try:
+            if streaming:
+                _check_streaming(filters, "out", "ref", ".", chunk_lines=chunk_lines)
+                _raise_if_failed("out", verbose=True)
+            else:
+                check(filters, "out", "ref", ".", verbose=True)
+            verdict = None
+        except (FailedTestError, FilterKeywordError, BadFilterError, TypeError) as e:
+            verdict = str(e)
+        logs = []
+        for suffix in [".filtered", ".reference", ".diff"]:
+            with open("out" + suffix, "r") as f:
+                logs.append(f.read())
+        return verdict, logs
+
+    words = ["x", "START", "END", "1", "-3", "2.5", "1.0e5", "7,", "-0.0"]
+    filter_kwargs = [
+        dict(rel_tolerance=1.0e-3),
+        dict(from_string="START", to_string="END", abs_tolerance=0.1),
+        dict(from_string="START", num_lines=2, rel_tolerance=1.0e-3),
+        dict(ignore_order=True, ignore_sign=True, rel_tolerance=1.0e-3),
+        dict(string="x", mask=[1], rel_tolerance=1.0e-3),
+        dict(),
+    ]
+    rng = random.Random(0)
+
+    with tmpdir.as_cwd():
+        for _ in range(200):
+            out = []
+            for _ in range(rng.randint(1, 20)):
+                out.append(" ".join(rng.choice(words) for _ in range(3)) + "\n")
+            ref = [line.replace("2.5", rng.choice(["2.5", "2.6"])) for line in out]
+            if rng.random() < 0.2:
+                ref = ref[1:]
+            with open("out", "w") as f:
+                f.write("".join(out))
+            with open("ref", "w") as f:
+                f.write("".join(ref))
+
+            filters = [get_filter(**rng.choice(filter_kwargs))]
+            try:
+                expected = _outcome(filters, False, None)
+            except IndexError:
+                continue
+            assert _outcome(filters, True, rng.choice([1, 2, 100])) == expected
+
+
+def test_check_mmap(tmpdir):
+    def _outcome(filters, use_mmap):
+        try:
+            check(filters, "out", "ref", ".", verbose=True, use_mmap=use_mmap)
+            verdict = None
+        except (FailedTestError, FilterKeywordError, BadFilterError) as e:
+            verdict = str(e)
+        logs = []
+        for suffix in [".filtered", ".reference", ".diff"]:
+            with open("out" + suffix, "r") as f:
+                logs.append(f.read())
+        return verdict, logs
+
+    out = "START\n1.0 2.0 3.0\nEND\nx 4.0 é 5\nSTART x 2\nEND 0.5\n"
+    ref = "START\n1.0 2.0 3.05\nEND\r\nx 4.0 é 5\nSTART x 2\nEND 0.5"
+    filters = [
+        [get_filter(abs_tolerance=0.1)],
+        [get_filter(rel_tolerance=1.0e-3)],
+        [get_filter(from_string="START", to_string="END", rel_tolerance=1.0e-3)],
+        [get_filter(string="x", abs_tolerance=0.1, mask=[2])],
+        [get_filter(from_re="ST.RT", num_lines=2, abs_tolerance=0.1)],
+        [get_filter(string="END", ignore_order=True, rel_tolerance=1.0e-3)],
+        [get_filter(string="END"), get_filter(string="é", abs_tolerance=0.1)],
+    ]
+
+    with tmpdir.as_cwd():
+        with open("out", "w") as f:
+            f.write(out)
+        with open("ref", "wb") as f:
+            f.write(ref.encode("utf-8"))
+        for filter_list in filters:
+            assert _outcome(filter_list, True) == _outcome(filter_list, False)
+
+    # no mapping of the files is left behind
+    if os.path.exists("/proc/self/maps"):
+        with open("/proc/self/maps") as f:
+            assert str(tmpdir.join("out")) not in f.read()
+
+
+def test_check_parallel(tmpdir):
+    import pytest
+
+    with tmpdir.as_cwd():
+        with open("out", "w") as f:
+            for i in range(1000):
+                f.write("step {0} energy {1}.25 x\n".format(i, i % 13))
+        with open("ref", "w") as f:
+            for i in range(1000):
+                f.write("step {0} energy {1}.25 x\n".format(i, i % 13 + (i == 700)))
+
+        diffs = []
+        for processes in [1, 3]:
+            with pytest.raises(FailedTestError):
+                check(
+                    [get_filter(string="energy", rel_tolerance=1.0e-8)],
+                    "out",
+                    "ref",
+                    ".",
+                    processes=processes,
+                    parallel_threshold=0,
+                )
+            with open("out.diff") as f:
+                diffs.append(f.read())
+        assert diffs[0] == diffs[1]
+        assert diffs[0].count("ERROR") == 1
+
+
+def test_check_reference_cache(tmpdir):
+    import pytest
+    from .cache import ReferenceCache
+
+    class _CountingCache(ReferenceCache):
+        hits = 0
+
+        def load(self, digest, f):
+            entry = super().load(digest, f)
+            if entry is not None:
+                self.hits += 1
+            return entry
+
+    cache = _CountingCache(str(tmpdir.join("cache")))
+    filters = [
+        get_filter(string="energy", rel_tolerance=1.0e-3),
+        get_filter(from_string="START", to_string="END", abs_tolerance=0.1),
+        get_filter(string="name"),
+    ]
+
+    with tmpdir.as_cwd():
+        with open("out", "w") as f:
+            f.write("START\nenergy -1.0\nname x\nEND 3\n")
+        with open("ref", "w") as f:
+            f.write("START\nenergy -1.1\nname y\nEND 3\n")
+
+        logs = []
+        for _ in range(2):
+            with pytest.raises(FailedTestError):
+                check(filters, "out", "ref", ".", reference_cache=cache)
+            logs.append([open("out" + s).read() for s in [".reference", ".diff"]])
+        assert cache.hits == len(filters)
+        assert logs[0] == logs[1]
+
+        with open("ref", "w") as f:
+            f.write("START\nenergy -1.0\nname x\nEND 3\n")
+        check(filters, "out", "ref", ".", reference_cache=cache)
+        assert cache.hits == len(filters)
+
+
+def test_live_check(tmpdir):
+    out = tmpdir.join("out")
+    ref = tmpdir.join("ref")
+    ref.write("iter 1\nenergy -1.0\niter 2\nenergy -2.0\nfinal 3.0\ndone\n")
+    filters = [
+        get_filter(string="energy", rel_tolerance=1.0e-8, early=True),
+        get_filter(from_string="final", num_lines=2, abs_tolerance=0.1, early=True),
+        get_filter(rel_tolerance=1.0e-8, early=True),
+    ]
+    live = LiveCheck(filters, str(out), str(ref))
+    # the whole file can only be compared at the end
+    assert len(live.filter_list) == 2
+
+    assert not live.poll()
+    out.write("iter 1\nenergy -1.0")
+    assert not live.poll()
+    out.write("\niter 2\nener", mode="a")
+    assert not live.poll()
+    out.write("gy -2.5\nfinal 3.0\n", mode="a")
+    assert live.poll()
+    assert live.failure.startswith("ERROR: section 2 of %s does not match" % out)
+    assert "ERROR   " in live.failure
+
+    # incomplete sections are not compared
+    out.write("energy -1.0\nfinal 9.0\n")
+    live = LiveCheck(filters, str(out), str(ref))
+    assert not live.poll()
+    out.write("done\n", mode="a")
+    assert live.poll()
+    assert "section 1 of %s" % out in live.failure
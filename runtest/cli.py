@@ -5,15 +5,16 @@
 from optparse import OptionParser
 import sys
 import os
-import inspect
 from .version import __version__
+from .mapped import default_parallel_threshold
+from .cache import ReferenceCache, RunCache, default_cache_dir
+from .copy import stage_modes
+from .run import default_scratch_keep, _caller_dir
+from .shard import parse_shard
 
 
 def cli():
-    frame = inspect.stack()[-1]
-    module = inspect.getmodule(frame[0])
-    caller_file = module.__file__
-    caller_dir = os.path.dirname(os.path.realpath(caller_file))
+    caller_dir = _caller_dir()
 
     parser = OptionParser(
         description="runtest {0} - Numerically tolerant end-to-end test library for research software.".format(
@@ -63,7 +64,202 @@ def cli():
         default=False,
         help="run calculation(s) but do not verify results [default: %default]",
     )
+    parser.add_option(
+        "--jobs",
+        "-j",
+        action="store",
+        type="int",
+        default=1,
+        help="number of tests which run_many() runs at the same time [default: %default]",
+    )
+    parser.add_option(
+        "--cores",
+        action="store",
+        type="int",
+        default=None,
+        help="cores which run_many() may use, tests only start while the cores they need are free [default: all]",
+    )
+    parser.add_option(
+        "--pin",
+        action="store_true",
+        default=False,
+        help="pin tests started by run_many() to their own cores (Linux) [default: %default]",
+    )
+    parser.add_option(
+        "--timeout",
+        action="store",
+        type="float",
+        default=None,
+        help="kill a test and all processes it started after this many seconds [default: %default]",
+    )
+    parser.add_option(
+        "--report",
+        action="store",
+        default=None,
+        help="write status, run time and memory use of all tests to this JSON file [default: %default]",
+    )
+    parser.add_option(
+        "--streaming",
+        action="store_true",
+        default=False,
+        help="verify outputs section by section with bounded memory [default: %default]",
+    )
+    parser.add_option(
+        "--mmap",
+        action="store_true",
+        default=False,
+        help="verify outputs on memory mapped files [default: %default]",
+    )
+    parser.add_option(
+        "--parse-processes",
+        action="store",
+        type="int",
+        default=1,
+        help="extract numbers from large outputs with this many processes [default: %default]",
+    )
+    parser.add_option(
+        "--parse-threshold",
+        action="store",
+        type="int",
+        default=default_parallel_threshold,
+        help="outputs smaller than this many bytes are parsed by one process [default: %default]",
+    )
+    parser.add_option(
+        "--no-reference-cache",
+        action="store_true",
+        default=False,
+        help="always parse references instead of using cached results [default: %default]",
+    )
+    parser.add_option(
+        "--clear-reference-cache",
+        action="store_true",
+        default=False,
+        help="remove all cached references and runs before running [default: %default]",
+    )
+    parser.add_option(
+        "--reference-cache-dir",
+        action="store",
+        default=default_cache_dir(),
+        help="directory for cached references [default: %default]",
+    )
+    parser.add_option(
+        "--reference-cache-size",
+        action="store",
+        type="int",
+        default=256,
+        help="maximum size of cached references in MiB [default: %default]",
+    )
+    parser.add_option(
+        "--stage-mode",
+        action="store",
+        type="choice",
+        choices=stage_modes,
+        default="reflink",
+        help="how files are staged in a separate work dir: copy, reflink (clone where possible, else copy) or link (hard link where possible) [default: %default]",
+    )
+    parser.add_option(
+        "--live-verification",
+        action="store_true",
+        default=False,
+        help="compare filters marked as early while the code runs and stop it on the first mismatch [default: %default]",
+    )
+    parser.add_option(
+        "--run-cache",
+        action="store_true",
+        default=False,
+        help="restore the outputs of runs whose launcher, command and input files did not change instead of running again [default: %default]",
+    )
+    parser.add_option(
+        "--force-run",
+        action="store_true",
+        default=False,
+        help="run even if the outputs are in the run cache and replace them [default: %default]",
+    )
+    parser.add_option(
+        "--run-cache-size",
+        action="store",
+        type="int",
+        default=1024,
+        help="maximum size of cached runs in MiB [default: %default]",
+    )
+    parser.add_option(
+        "--scratch-dir",
+        action="store",
+        default=None,
+        help="run each test in its own directory below this one, e.g. /dev/shm [default: %default]",
+    )
+    parser.add_option(
+        "--scratch-keep",
+        action="store",
+        default=",".join(default_scratch_keep),
+        help="comma separated file name patterns which are copied back from the scratch directory [default: %default]",
+    )
+    parser.add_option(
+        "--no-timing-history",
+        action="store_true",
+        default=False,
+        help="neither record run times in the work dir nor start the longest tests first [default: %default]",
+    )
+    parser.add_option(
+        "--shard",
+        action="store",
+        default=None,
+        help="only run the tests of shard INDEX/COUNT, e.g. 2/4 [default: %default]",
+    )
+    parser.add_option(
+        "--shard-durations",
+        action="store",
+        default=None,
+        help="balance shards by the run times in this report instead of by hashing [default: %default]",
+    )
+    parser.add_option(
+        "--select",
+        action="append",
+        default=None,
+        help="only run the test with this key, can be given several times (used by runtest.distributed) [default: all]",
+    )
+    parser.add_option(
+        "--list-tests",
+        action="store",
+        default=None,
+        help="append the keys of all tests to this file instead of running them [default: %default]",
+    )
+    parser.add_option(
+        "--check-server",
+        action="store",
+        default=None,
+        help="let the runtest.daemon listening on this Unix socket verify the outputs [default: %default]",
+    )
+    parser.add_option(
+        "--plan",
+        action="store",
+        default=None,
+        help="write the resolved commands, filters and references of all tests as JSON plan to this file instead of running them (see runtest.plan) [default: %default]",
+    )
+    parser.add_option(
+        "--record-baselines",
+        action="store_true",
+        default=False,
+        help="record run time and memory use as new performance baselines [default: %default]",
+    )
 
     (options, _args) = parser.parse_args(args=sys.argv[1:])
 
+    options.scratch_keep = [p for p in options.scratch_keep.split(",") if p != ""]
+
+    if options.shard is not None:
+        try:
+            options.shard = parse_shard(options.shard)
+        except ValueError as e:
+            parser.error("--shard: {0}".format(e))
+        if options.report is None:
+            # every shard writes its results for the merge step
+            options.report = os.path.join(
+                options.work_dir, "runtest-shard-{0}-of-{1}.json".format(*options.shard)
+            )
+
+    if options.clear_reference_cache:
+        ReferenceCache(options.reference_cache_dir).clear()
+        RunCache(options.reference_cache_dir).clear()
+
     return options
@@ -2,8 +2,20 @@
 #
 # SPDX-License-Identifier: MPL-2.0
 
-from shutil import copy
+from collections import namedtuple
+from fnmatch import fnmatch
+from shutil import copy, copy2
 import os
+import sys
+
+
+stage_modes = ["copy", "reflink", "link", "symlink"]
+
+# lists of file names relative to the staged directory
+Staged = namedtuple("Staged", ["copied", "cloned", "linked", "unchanged"])
+
+# Linux ioctl which shares the blocks of one file with another (btrfs, xfs)
+_FICLONE = 0x40049409
 
 
 def copy_path(root_src_dir, root_dst_dir):
@@ -15,3 +27,193 @@ def copy_path(root_src_dir, root_dst_dir):
             src_file = os.path.join(src_dir, f)
             dst_file = os.path.join(dst_dir, f)
             copy(src_file, dst_file)
+
+
+def stage_path(root_src_dir, root_dst_dir, mode="reflink", exclude=None):
+    """
+    Brings root_dst_dir up to date with root_src_dir. Files which have the
+    same size and modification time in both places are left alone, files
+    directly in root_src_dir whose name matches one of the exclude patterns
+    are not staged.
+
+    With mode "reflink" files are cloned where the file system supports it
+    and copied otherwise, with "link" they are hard linked where possible
+    and with "symlink" symbolic links point to them. Linked files are the
+    same file in both places: whatever modifies them in root_dst_dir
+    modifies the original.
+
+    Returns:
+        staged - Staged with the files which were copied, cloned, linked
+                 and left unchanged
+    """
+    if mode not in stage_modes:
+        raise ValueError("unknown stage mode {0}".format(mode))
+    staged = Staged([], [], [], [])
+    root_src_dir = os.path.abspath(root_src_dir)
+    root_dst_dir = os.path.abspath(root_dst_dir)
+    for src_dir, dirs, files in os.walk(root_src_dir):
+        relative_dir = os.path.relpath(src_dir, root_src_dir)
+        dst_dir = os.path.normpath(os.path.join(root_dst_dir, relative_dir))
+        # the destination may sit below the source, it is not staged into itself
+        dirs[:] = [d for d in dirs if not _contains(os.path.join(src_dir, d), root_dst_dir)]
+        os.makedirs(dst_dir, exist_ok=True)
+        if exclude is not None and src_dir == root_src_dir:
+            files = [f for f in files if not any(fnmatch(f, p) for p in exclude)]
+        for f in files:
+            src_file = os.path.join(src_dir, f)
+            dst_file = os.path.join(dst_dir, f)
+            name = os.path.normpath(os.path.join(relative_dir, f))
+            src_stat = os.stat(src_file)
+            if _unchanged(src_stat, dst_file):
+                staged.unchanged.append(name)
+                continue
+            if os.path.lexists(dst_file):
+                os.remove(dst_file)
+            if mode == "symlink":
+                os.symlink(src_file, dst_file)
+                staged.linked.append(name)
+            elif mode == "link" and _link(src_file, dst_file):
+                staged.linked.append(name)
+            elif mode != "copy" and _clone(src_file, dst_file):
+                staged.cloned.append(name)
+            else:
+                copy2(src_file, dst_file)
+                staged.copied.append(name)
+    return staged
+
+
+def unshare(file_name):
+    """
+    Removes file_name if it is a link so that writing it does not modify
+    the file it is linked to.
+    """
+    try:
+        if os.path.islink(file_name) or os.stat(file_name).st_nlink > 1:
+            os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
+
+def collect_files(root_src_dir, root_dst_dir, patterns):
+    """
+    Copies the files under root_src_dir whose name matches one of the
+    patterns to root_dst_dir, links are skipped.
+
+    Returns:
+        names - files which were copied, relative to root_src_dir
+    """
+    names = []
+    for src_dir, _dirs, files in os.walk(root_src_dir):
+        relative_dir = os.path.relpath(src_dir, root_src_dir)
+        for f in files:
+            src_file = os.path.join(src_dir, f)
+            if os.path.islink(src_file) or not any(fnmatch(f, p) for p in patterns):
+                continue
+            dst_dir = os.path.normpath(os.path.join(root_dst_dir, relative_dir))
+            os.makedirs(dst_dir, exist_ok=True)
+            dst_file = os.path.join(dst_dir, f)
+            unshare(dst_file)
+            copy2(src_file, dst_file)
+            names.append(os.path.normpath(os.path.join(relative_dir, f)))
+    return names
+
+
+def _contains(directory, path):
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def _unchanged(src_stat, dst_file):
+    try:
+        dst_stat = os.stat(dst_file)
+    except FileNotFoundError:
+        return False
+    if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+        return True
+    return (
+        dst_stat.st_size == src_stat.st_size
+        and dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+    )
+
+
+def _link(src_file, dst_file):
+    try:
+        os.link(src_file, dst_file)
+    except OSError:
+        # other file system or not supported
+        return False
+    return True
+
+
+def _clone(src_file, dst_file):
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+
+    try:
+        with open(src_file, "rb") as src, open(dst_file, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    except OSError:
+        if os.path.exists(dst_file):
+            os.remove(dst_file)
+        return False
+    # like copy2 so that the next staging sees the file as unchanged
+    src_stat = os.stat(src_file)
+    os.utime(dst_file, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return True
+
+
+def test_stage_path(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.join("a.inp").write("a")
+    src.mkdir("reference").join("a.out").write("energy 1.0\n")
+
+    for mode in stage_modes:
+        dst = tmpdir.join(mode)
+        staged = stage_path(str(src), str(dst), mode)
+        assert sorted(staged.copied + staged.cloned + staged.linked) == [
+            "a.inp",
+            os.path.join("reference", "a.out"),
+        ]
+        assert staged.unchanged == []
+        assert dst.join("reference", "a.out").read() == "energy 1.0\n"
+
+        assert len(stage_path(str(src), str(dst), mode).unchanged) == 2
+
+    if staged.linked:
+        # writing a staged output does not write through to the original
+        unshare(str(tmpdir.join("link", "a.inp")))
+        tmpdir.join("link", "a.inp").write("b")
+        assert src.join("a.inp").read() == "a"
+
+    src.join("a.inp").write("changed")
+    staged = stage_path(str(src), str(tmpdir.join("copy")), "copy")
+    assert staged.copied == ["a.inp"]
+    assert tmpdir.join("copy", "a.inp").read() == "changed"
+
+
+def test_stage_path_into_subdir(tmpdir):
+    tmpdir.join("a.inp").write("a")
+    staged = stage_path(str(tmpdir), str(tmpdir.join("work")), "copy")
+    assert staged.copied == ["a.inp"]
+    assert stage_path(str(tmpdir), str(tmpdir.join("work")), "copy").unchanged == [
+        "a.inp"
+    ]
+
+
+def test_collect_files(tmpdir):
+    work = tmpdir.mkdir("work")
+    work.join("a.inp").write("a")
+    work.join("a.stdout").write("old")
+    work.mkdir("reference").join("a.stdout").write("ref")
+    scratch = tmpdir.join("scratch")
+    staged = stage_path(str(work), str(scratch), "symlink", exclude=["*.stdout"])
+    assert sorted(staged.linked) == ["a.inp", os.path.join("reference", "a.stdout")]
+    assert not scratch.join("a.stdout").check()
+
+    scratch.join("a.stdout").write("new")
+    scratch.join("a.log").write("log")
+    assert collect_files(str(scratch), str(work), ["*.stdout", "*.inp"]) == [
+        "a.stdout"
+    ]
+    assert work.join("a.stdout").read() == "new"
+    assert not work.join("a.log").check()
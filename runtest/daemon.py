@@ -0,0 +1,284 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Verifies outputs for test scripts which run with --check-server, keeping
+the filters and the parsed references in memory between checks.
+
+Usage: python -m runtest.daemon [--max-size MB] {serve,stop,stats} SOCKET
+
+The server listens on a Unix socket which only its user can use and runs
+check() like a test script would. A reference is parsed again when its size,
+modification time or content changed.
+"""
+
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from multiprocessing.connection import Listener, Client
+from optparse import OptionParser
+from .cache import MemoryReferenceCache
+from .check import check
+from .exceptions import FilterKeywordError, FailedTestError, BadFilterError
+from .filter_constructor import filter_to_dict, filter_from_dict
+
+
+# errors which check() raises and the client raises again
+_errors = {
+    "FailedTestError": FailedTestError,
+    "FilterKeywordError": FilterKeywordError,
+    "BadFilterError": BadFilterError,
+}
+
+
+class CheckServer:
+    """
+    Answers check requests, one thread per connection.
+    """
+
+    def __init__(self, address, max_bytes=256 * 1024 * 1024, max_filters=1024):
+        self.address = address
+        self.reference_cache = MemoryReferenceCache(max_bytes)
+        self.max_filters = max_filters
+        self._filters = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopping = False
+        if os.path.exists(address):
+            # left over by a server which did not stop cleanly
+            os.remove(address)
+        old_umask = os.umask(0o177)
+        try:
+            self._listener = Listener(address, family="AF_UNIX")
+        finally:
+            os.umask(old_umask)
+
+    def serve(self):
+        try:
+            while not self._stopping:
+                connection = self._listener.accept()
+                threading.Thread(
+                    target=self._serve_client, args=(connection,), daemon=True
+                ).start()
+        finally:
+            self._listener.close()
+
+    def _serve_client(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = _receive(connection)
+                except (EOFError, OSError):
+                    return
+                _send(connection, self.handle(request))
+                if request["type"] == "stop":
+                    self._stop()
+                    return
+
+    def _stop(self):
+        self._stopping = True
+        # wakes up the accept() in serve()
+        try:
+            Client(self.address, family="AF_UNIX").close()
+        except OSError:
+            pass
+
+    def handle(self, request):
+        """
+        Returns:
+            response - dictionary with the outcome of the request
+        """
+        if request["type"] == "check":
+            return self._check(request)
+        if request["type"] == "stats":
+            with self._lock:
+                filters = len(self._filters)
+            return dict(self.reference_cache.stats(), filters=filters)
+        if request["type"] == "stop":
+            return {}
+        return {"error": "ValueError", "message": "unknown request {0}\n".format(request)}
+
+    def _filter_list(self, filter_dicts):
+        filter_list = []
+        for d in filter_dicts:
+            key = json.dumps(d, sort_keys=True)
+            with self._lock:
+                f = self._filters.get(key)
+                if f is not None:
+                    self._filters.move_to_end(key)
+            if f is None:
+                f = filter_from_dict(d)
+                with self._lock:
+                    self._filters[key] = f
+                    while len(self._filters) > self.max_filters:
+                        self._filters.popitem(last=False)
+            filter_list.append(f)
+        return filter_list
+
+    def _check(self, request):
+        try:
+            check(
+                filter_list=self._filter_list(request["filters"]),
+                out_name=request["out_name"],
+                ref_name=request["ref_name"],
+                log_dir=request["log_dir"],
+                verbose=request["verbose"],
+                reference_cache=self.reference_cache,
+            )
+        except (FailedTestError, FilterKeywordError, BadFilterError) as e:
+            return {"error": type(e).__name__, "message": str(e)}
+        except IOError as e:
+            return {
+                "error": "IOError",
+                "errno": e.errno,
+                "message": e.strerror,
+                "filename": e.filename,
+            }
+        return {}
+
+
+def remote_check(address, filter_list, out_name, ref_name, log_dir, verbose=False):
+    """
+    Like check() but lets the server at address do it.
+
+    Raises:
+        - FailedTestError
+        - FilterKeywordError
+        - BadFilterError
+        - IOError
+    """
+    response = request(
+        address,
+        {
+            "type": "check",
+            "filters": [filter_to_dict(f) for f in filter_list],
+            "out_name": os.path.abspath(out_name),
+            "ref_name": os.path.abspath(ref_name),
+            "log_dir": os.path.abspath(log_dir),
+            "verbose": verbose,
+        },
+    )
+    error = response.get("error")
+    if error == "IOError":
+        raise IOError(response["errno"], response["message"], response["filename"])
+    if error is not None:
+        raise _errors.get(error, RuntimeError)(response["message"])
+
+
+def request(address, message):
+    """
+    Returns:
+        response - the answer of the server at address to message
+    """
+    with Client(address, family="AF_UNIX") as connection:
+        _send(connection, message)
+        return _receive(connection)
+
+
+def _send(connection, message):
+    connection.send_bytes(json.dumps(message).encode("utf-8"))
+
+
+def _receive(connection):
+    return json.loads(connection.recv_bytes().decode("utf-8"))
+
+
+def main(args=None):
+    parser = OptionParser(
+        usage="%prog [options] {serve,stop,stats} SOCKET",
+        description="Keeps parsed references in memory and verifies outputs for --check-server.",
+    )
+    parser.add_option(
+        "--max-size",
+        action="store",
+        type="int",
+        default=256,
+        help="memory for parsed references in MiB [default: %default]",
+    )
+    (options, args) = parser.parse_args(args=args)
+    if len(args) != 2 or args[0] not in ["serve", "stop", "stats"]:
+        parser.error("expected serve, stop or stats and a socket")
+    command, address = args
+
+    if command == "serve":
+        server = CheckServer(address, options.max_size * 1024 * 1024)
+        sys.stdout.write("serving checks on {0}\n".format(address))
+        sys.stdout.flush()
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if os.path.exists(address):
+                os.remove(address)
+        return 0
+
+    try:
+        response = request(address, {"type": command})
+    except OSError as e:
+        sys.stderr.write("ERROR: no server on {0}: {1}\n".format(address, e))
+        return 1
+    if command == "stats":
+        sys.stdout.write(
+            "{0} references in {1:.1f} MiB, {2} files, {3} filters\n".format(
+                response["entries"],
+                response["bytes"] / 1024.0 / 1024.0,
+                response["files"],
+                response["filters"],
+            )
+        )
+    return 0
+
+
+def _test_address():
+    # socket paths are limited to about 100 bytes and the temporary
+    # directories of pytest (e.g. below $TMPDIR on macOS) can be longer
+    import tempfile
+
+    directory = tempfile.mkdtemp(
+        prefix="rt", dir="/tmp" if os.path.isdir("/tmp") else None
+    )
+    return os.path.join(directory, "s")
+
+
+def test_check_server(tmpdir):
+    import pytest
+    import shutil
+    import socket
+    from .filter_constructor import get_filter
+
+    if not hasattr(socket, "AF_UNIX"):
+        pytest.skip("no Unix sockets")
+    address = _test_address()
+    server = CheckServer(address)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    try:
+        tmpdir.join("out").write("energy 1.0\n")
+        tmpdir.join("ref").write("energy 1.0\n")
+        filter_list = [get_filter(string="energy", abs_tolerance=1.0e-6)]
+        out, ref = str(tmpdir.join("out")), str(tmpdir.join("ref"))
+        for _ in range(2):
+            remote_check(address, filter_list, out, ref, str(tmpdir))
+        assert request(address, {"type": "stats"})["entries"] == 1
+
+        # a changed reference is parsed again
+        tmpdir.join("ref").write("energy 2.0\n")
+        os.utime(str(tmpdir.join("ref")), ns=(1, 1))
+        with pytest.raises(FailedTestError):
+            remote_check(address, filter_list, out, ref, str(tmpdir))
+        with pytest.raises(IOError):
+            remote_check(address, filter_list, out, ref + ".missing", str(tmpdir))
+        stats = request(address, {"type": "stats"})
+        assert (stats["entries"], stats["filters"]) == (1, 1)
+    finally:
+        assert main(["stop", address]) == 0
+        thread.join(10.0)
+        shutil.rmtree(os.path.dirname(address))
+    assert not thread.is_alive()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,564 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Runs the tests of several test scripts on workers which pull them one at a
+time from a coordinator, so that no worker idles while others still have
+long tests queued.
+
+Usage:
+    RUNTEST_AUTHKEY=secret python -m runtest.distributed coordinator \\
+        --bind HOST:PORT [--report FILE] [--script-args ARGS] SCRIPT [SCRIPT ...]
+    RUNTEST_AUTHKEY=secret python -m runtest.distributed worker --connect HOST:PORT
+
+The coordinator lists the tests of every script (--list-tests), workers run
+one test at a time (--select) in a private work dir and send back the
+results and the artifacts, which are written next to the script. Tests of
+workers which die or stop sending heartbeats are given to other workers.
+Tests of one script must not depend on each other.
+"""
+
+import base64
+import json
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from fnmatch import fnmatch
+from multiprocessing.connection import Listener, Client
+from optparse import OptionParser
+from .report import Result, add_result, result_from_dict, result_to_dict, write_reports
+from .run import default_scratch_keep
+
+
+def list_tasks(scripts, script_args=None):
+    """
+    Returns:
+        tasks - list of task dictionaries (id, script, key, input_files,
+                extra_args, args), one per test of each script
+    """
+    if script_args is None:
+        script_args = []
+    tasks = []
+    for script in scripts:
+        script = os.path.abspath(script)
+        fd, list_file = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+        try:
+            subprocess.run(
+                [sys.executable, script, "--list-tests", list_file] + script_args,
+                check=True,
+                stdout=subprocess.DEVNULL,
+                cwd=os.path.dirname(script),
+            )
+            with open(list_file) as f:
+                entries = [json.loads(line) for line in f]
+        finally:
+            os.remove(list_file)
+        seen = set()
+        for entry in entries:
+            # a test which is run twice is selected once and runs twice
+            if entry["key"] in seen:
+                continue
+            seen.add(entry["key"])
+            entry.update(id=len(tasks), script=script, args=script_args)
+            tasks.append(entry)
+    return tasks
+
+
+class Coordinator:
+    """
+    Hands out tasks to workers which connect to address. A task is given
+    to another worker if its worker disconnects or sends nothing for lease
+    seconds, after max_attempts the test counts as crashed.
+    """
+
+    def __init__(
+        self,
+        tasks,
+        address=("127.0.0.1", 0),
+        authkey=b"",
+        lease=60.0,
+        max_attempts=3,
+    ):
+        self.tasks = list(tasks)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self._queue = deque(t["id"] for t in self.tasks)
+        self._outstanding = set()
+        self._attempts = {}
+        self._results = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    def serve(self, on_result=None):
+        """
+        Returns once all tasks are done, on_result(task, result) is called
+        for each task as it finishes.
+
+        Returns:
+            results - result messages in the order of the tasks
+        """
+        self._on_result = on_result
+        acceptor = threading.Thread(target=self._accept, daemon=True)
+        acceptor.start()
+        with self._condition:
+            while len(self._results) < len(self.tasks):
+                self._condition.wait()
+        self._stopping = True
+        # accept() only returns once somebody connects
+        try:
+            socket.create_connection(self.address, timeout=1.0).close()
+        except OSError:
+            pass
+        acceptor.join()
+        self._listener.close()
+        return [self._results[t["id"]] for t in self.tasks]
+
+    def _accept(self):
+        while not self._stopping:
+            try:
+                connection = self._listener.accept()
+            except Exception:
+                # failed handshakes, also our own wake up call
+                continue
+            threading.Thread(
+                target=self._serve_worker, args=(connection,), daemon=True
+            ).start()
+
+    def _serve_worker(self, connection):
+        task_id = None
+        try:
+            while True:
+                if not connection.poll(self.lease):
+                    # the worker or its node is gone
+                    break
+                message = _receive(connection)
+                if message["type"] == "alive":
+                    continue
+                if message["type"] == "result":
+                    self._finish(task_id, message)
+                    task_id = None
+                task_id, reply = self._next()
+                _send(connection, reply)
+                if reply["type"] == "done":
+                    break
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            if task_id is not None:
+                self._requeue(task_id)
+            connection.close()
+
+    def _next(self):
+        with self._condition:
+            if self._queue:
+                task_id = self._queue.popleft()
+                self._outstanding.add(task_id)
+                return task_id, {
+                    "type": "task",
+                    "task": self.tasks[task_id],
+                    # the worker derives its heartbeat from it
+                    "lease": self.lease,
+                }
+            if self._outstanding:
+                # tasks of dead workers may come back
+                return None, {"type": "wait"}
+            return None, {"type": "done"}
+
+    def _finish(self, task_id, message):
+        with self._condition:
+            if task_id not in self._outstanding:
+                return
+            self._outstanding.remove(task_id)
+        # before serve() can return
+        if self._on_result is not None:
+            self._on_result(self.tasks[task_id], message)
+        with self._condition:
+            self._results[task_id] = message
+            self._condition.notify_all()
+
+    def _requeue(self, task_id):
+        with self._condition:
+            if task_id not in self._outstanding:
+                return
+            self._outstanding.remove(task_id)
+            attempts = self._attempts.get(task_id, 0) + 1
+            self._attempts[task_id] = attempts
+            if attempts < self.max_attempts:
+                self._queue.appendleft(task_id)
+                return
+        task = self.tasks[task_id]
+        result = Result(
+            task["input_files"],
+            task["extra_args"],
+            "crashed",
+            None,
+            os.path.basename(os.path.dirname(task["script"])),
+        )
+        message = {
+            "type": "result",
+            "ierr": 1,
+            "results": [result_to_dict(result)],
+            "artifacts": {},
+            "log": "ERROR: {0} workers died while running this test\n".format(
+                attempts
+            ),
+        }
+        self._outstanding.add(task_id)
+        self._finish(task_id, message)
+
+
+def execute(task, patterns=None):
+    """
+    Runs one test of a script in a private work dir.
+
+    Returns:
+        result - message with the exit code, the results, the artifacts
+                 and the console output
+    """
+    if patterns is None:
+        patterns = default_scratch_keep
+    work_dir = tempfile.mkdtemp(prefix="runtest-worker-")
+    try:
+        report_file = os.path.join(work_dir, "report.json")
+        command = [
+            sys.executable,
+            task["script"],
+            "--select",
+            task["key"],
+            "--work-dir",
+            work_dir,
+            "--report",
+            report_file,
+        ] + task["args"]
+        process = subprocess.run(
+            command,
+            cwd=os.path.dirname(task["script"]),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        results = []
+        if os.path.exists(report_file):
+            with open(report_file) as f:
+                results = json.load(f)["results"]
+        artifacts = {}
+        # only what the test wrote, not the staged references below
+        for name in os.listdir(work_dir):
+            path = os.path.join(work_dir, name)
+            if os.path.isfile(path) and any(fnmatch(name, p) for p in patterns):
+                with open(path, "rb") as f:
+                    artifacts[name] = base64.b64encode(f.read()).decode("ascii")
+        return {
+            "type": "result",
+            "ierr": process.returncode,
+            "results": results,
+            "artifacts": artifacts,
+            "log": process.stdout.decode("utf-8", "replace"),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def work(address, authkey=b"", heartbeat=None, retry=1.0, execute=execute):
+    """
+    Takes tasks from the coordinator at address and runs them until there
+    are none left. Without heartbeat, a heartbeat is sent three times per
+    lease of the coordinator.
+
+    Returns:
+        count - number of tasks this worker ran
+    """
+    connection = Client(address, authkey=authkey)
+    lock = threading.Lock()
+    count = 0
+    try:
+        _send(connection, {"type": "get"}, lock)
+        while True:
+            message = _receive(connection)
+            if message["type"] == "done":
+                return count
+            if message["type"] == "wait":
+                time.sleep(retry)
+                _send(connection, {"type": "get"}, lock)
+                continue
+            interval = heartbeat
+            if interval is None:
+                interval = message.get("lease", 60.0) / 3.0
+            stop = threading.Event()
+            beats = threading.Thread(
+                target=_beat, args=(connection, lock, stop, interval), daemon=True
+            )
+            beats.start()
+            try:
+                result = execute(message["task"])
+            finally:
+                stop.set()
+                beats.join()
+            _send(connection, result, lock)
+            count += 1
+    except EOFError:
+        # the coordinator is gone
+        return count
+    finally:
+        connection.close()
+
+
+def coordinate(scripts, address, authkey, script_args=None, report_file=None, lease=60.0):
+    """
+    Lists the tests of the scripts and serves them to workers.
+
+    Returns:
+        ierr - sum of the exit codes of all tests
+    """
+    tasks = list_tasks(scripts, script_args)
+    coordinator = Coordinator(tasks, address, authkey, lease=lease)
+    sys.stdout.write(
+        "serving {0} tests on {1}:{2}\n".format(len(tasks), *coordinator.address)
+    )
+    lock = threading.Lock()
+
+    def _on_result(task, result):
+        script_dir = os.path.dirname(task["script"])
+        with lock:
+            for name, data in result["artifacts"].items():
+                path = _artifact_path(script_dir, name)
+                if path is None:
+                    sys.stdout.write(
+                        "WARNING: ignored artifact {0!r} of {1}\n".format(
+                            name, task["script"]
+                        )
+                    )
+                    continue
+                with open(path, "wb") as f:
+                    f.write(base64.b64decode(data))
+            sys.stdout.write("\n{0}:\n{1}".format(task["script"], result["log"]))
+            for r in result["results"]:
+                add_result(result_from_dict(r), report_file)
+
+    results = coordinator.serve(_on_result)
+    write_reports()
+    return sum(1 if r["ierr"] != 0 else 0 for r in results)
+
+
+def _artifact_path(script_dir, name):
+    """
+    Returns:
+        path - where the artifact name goes in script_dir, None if name is
+               not a plain file name (e.g. contains .. or is absolute)
+    """
+    if name != os.path.basename(name) or name in ["", ".", ".."]:
+        return None
+    if os.path.altsep is not None and os.path.altsep in name:
+        return None
+    return os.path.join(script_dir, name)
+
+
+def _send(connection, message, lock=None):
+    data = json.dumps(message).encode("utf-8")
+    if lock is None:
+        connection.send_bytes(data)
+    else:
+        with lock:
+            connection.send_bytes(data)
+
+
+def _receive(connection):
+    return json.loads(connection.recv_bytes().decode("utf-8"))
+
+
+def _beat(connection, lock, stop, heartbeat):
+    while not stop.wait(heartbeat):
+        try:
+            _send(connection, {"type": "alive"}, lock)
+        except OSError:
+            return
+
+
+def _address(text):
+    host, _, port = text.rpartition(":")
+    return (host or "0.0.0.0", int(port))
+
+
+def main(args=None):
+    parser = OptionParser(
+        usage="%prog coordinator|worker [options] [SCRIPT ...]",
+        description="Distributes tests to workers which pull them from a coordinator.",
+    )
+    parser.add_option("--bind", default=":0", help="coordinator address HOST:PORT")
+    parser.add_option("--connect", default=None, help="worker: coordinator HOST:PORT")
+    parser.add_option("--report", default=None, help="coordinator: JSON report")
+    parser.add_option(
+        "--script-args", default="", help="coordinator: options for every script"
+    )
+    parser.add_option(
+        "--lease",
+        type="float",
+        default=60.0,
+        help="coordinator: seconds after which a silent worker counts as dead [default: %default]",
+    )
+    (options, args) = parser.parse_args(args=args)
+    authkey = os.environ.get("RUNTEST_AUTHKEY")
+    if authkey is None:
+        parser.error("set RUNTEST_AUTHKEY to the same secret for coordinator and workers")
+    authkey = authkey.encode("utf-8")
+
+    if args[:1] == ["coordinator"] and len(args) > 1:
+        return coordinate(
+            args[1:],
+            _address(options.bind),
+            authkey,
+            shlex.split(options.script_args),
+            options.report,
+            options.lease,
+        )
+    if args == ["worker"] and options.connect is not None:
+        work(_address(options.connect), authkey)
+        return 0
+    parser.error("give either coordinator and scripts or worker and --connect")
+
+
+def _write_script(directory, inputs):
+    directory.join("code.py").write(
+        "import sys, time\n"
+        "time.sleep(0.1)\n"
+        "print('result', sys.argv[1])\n"
+    )
+    reference = directory.mkdir("reference")
+    for x in inputs:
+        # the reference of test 3 is wrong
+        reference.join("%i.stdout" % x).write("result %i\n" % (x if x != 3 else 7))
+    directory.join("test").write(
+        "import os, sys\n"
+        "sys.path.insert(0, %r)\n"
+        "from runtest import cli, run, get_filter\n"
+        "def configure(options, input_files, extra_args):\n"
+        "    (x,) = input_files\n"
+        "    command = '{0} code.py {1}'.format(sys.executable, x)\n"
+        "    return os.path.basename(sys.executable), command, str(x), 'reference'\n"
+        "options = cli()\n"
+        "options.binary_dir = os.path.dirname(sys.executable)\n"
+        "ierr = 0\n"
+        "for x in %r:\n"
+        "    ierr += run(options, configure, [x], filters={'stdout': [get_filter(abs_tolerance=0.1)]})\n"
+        "sys.exit(ierr)\n"
+        % (os.path.dirname(os.path.dirname(os.path.abspath(__file__))), inputs)
+    )
+
+
+def test_distributed(tmpdir):
+    _write_script(tmpdir.mkdir("a"), [0, 1, 2])
+    _write_script(tmpdir.mkdir("b"), [3])
+    scripts = [str(tmpdir.join("a", "test")), str(tmpdir.join("b", "test"))]
+    tasks = list_tasks(scripts, ["--no-timing-history"])
+    assert [t["input_files"] for t in tasks] == [[0], [1], [2], [3]]
+
+    coordinator = Coordinator(tasks, authkey=b"key", lease=5.0)
+    finished = []
+
+    def _dead_worker():
+        connection = Client(coordinator.address, authkey=b"key")
+        _send(connection, {"type": "get"})
+        _receive(connection)
+        connection.close()
+
+    workers = [
+        threading.Thread(
+            target=lambda: finished.append(work(coordinator.address, b"key", retry=0.1))
+        )
+        for _ in range(2)
+    ]
+
+    def _workers():
+        _dead_worker()
+        for w in workers:
+            w.start()
+
+    starter = threading.Thread(target=_workers)
+    starter.start()
+    results = coordinator.serve()
+    starter.join()
+    for w in workers:
+        w.join()
+
+    # the first test went to the dead worker first
+    assert coordinator._attempts == {0: 1}
+    assert sum(finished) == 4
+    assert [r["ierr"] for r in results] == [0, 0, 0, 1]
+    assert [result_from_dict(r["results"][0]).status for r in results] == [
+        "passed",
+        "passed",
+        "passed",
+        "failed",
+    ]
+    assert "3.stdout.diff" in results[3]["artifacts"]
+    assert "ERROR: test" in results[3]["log"]
+
+
+def test_coordinator_gives_up(tmpdir):
+    script = str(tmpdir.join("t", "test"))
+    tasks = [{"id": 0, "script": script, "input_files": [0], "extra_args": None}]
+    coordinator = Coordinator(tasks, authkey=b"key", lease=0.2, max_attempts=2)
+
+    def _silent_worker():
+        # never finishes and never sends heartbeats
+        connection = Client(coordinator.address, authkey=b"key")
+        _send(connection, {"type": "get"})
+        _receive(connection)
+        time.sleep(0.5)
+        connection.close()
+
+    def _silent_workers():
+        # one after the other so that each of them gets the task
+        for _ in range(2):
+            _silent_worker()
+
+    workers = [threading.Thread(target=_silent_workers)]
+    for w in workers:
+        w.start()
+    (result,) = coordinator.serve()
+    for w in workers:
+        w.join()
+    assert result["ierr"] == 1
+    assert result_from_dict(result["results"][0]).status == "crashed"
+    assert result_from_dict(result["results"][0]).script == "t"
+
+
+def test_artifact_path():
+    assert _artifact_path("/t", "3.stdout.diff") == os.path.join("/t", "3.stdout.diff")
+    for name in ["", "..", "../x", "/etc/passwd", os.path.join("sub", "x")]:
+        assert _artifact_path("/t", name) is None
+
+
+def test_heartbeat_from_lease():
+    coordinator = Coordinator([{"id": 0}], authkey=b"key", lease=0.3)
+    received = []
+
+    def _execute(task):
+        # silent for several leases, only the heartbeats keep the task
+        time.sleep(1.0)
+        return {"type": "result", "ierr": 0, "results": [], "artifacts": {}, "log": ""}
+
+    worker = threading.Thread(
+        target=lambda: received.append(work(coordinator.address, b"key", execute=_execute))
+    )
+    worker.start()
+    (result,) = coordinator.serve()
+    worker.join()
+    assert received == [1]
+    assert coordinator._attempts == {}
+    assert result["ierr"] == 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,149 @@
 # SPDX-License-Identifier: MPL-2.0
 
 import re
+import sys
+from array import array
+from bisect import bisect_right
+
+
+_numeric_const_pattern = r"""
+[-+]? # optional sign
+(?:
+    (?: \d* \. \d+ ) # .1 .12 .123 etc 9.1 etc 98.1 etc
+    |
+    (?: \d+ \.? ) # 1. 12. 123. etc 1 12 123 etc
+)
+# followed by optional exponent part if desired
+(?: [EeDd] [+-]? \d+ ) ?
+"""
+
+_pattern_int = re.compile(r"-?[0-9]+")
+_pattern_float = re.compile(_numeric_const_pattern, re.VERBOSE)
+
+_numeric_chars = "0123456789.eEdD+-"
+_d_to_e = str.maketrans("dD", "ee")
+
+# the same words as above but found with one bytes regex over a whole buffer,
+# the separators are the ASCII characters which str.split() splits on
+_separators = rb"\t\n\x0b\x0c\r\x1c-\x1f "
+_pattern_word = re.compile(
+    rb"(?<![^"
+    + _separators
+    + rb"])(?:(-?[0-9]{1,15})|([0-9.eEdD+-]+)),?(?![^"
+    + _separators
+    + rb"])"
+)
+_pattern_non_ascii = re.compile(rb"[\x80-\xff]")
+_d_to_e_bytes = bytes.maketrans(b"dD", b"ee")
+
+
+# integers up to this size are stored exactly as doubles
+_max_exact_int = 2**53
+
+
+class ExtractedNumbers:
+    """
+    Numbers extracted from text and their locations, kept in typed arrays.
+
+    All numbers are stored as doubles with a type mask telling which of them
+    are integers. The few integers which do not fit into a double exactly are
+    kept separately. Locations are stored as three arrays (line, start
+    position, length) instead of a list of tuples.
+    """
+
+    def __init__(self):
+        self.values = array("d")
+        self.is_int = array("b")
+        self.lines = array("i")
+        self.starts = array("i")
+        self.lengths = array("i")
+        self.large_ints = {}
+
+    def append(self, number, line, start, length):
+        if isinstance(number, int):
+            if -_max_exact_int <= number <= _max_exact_int:
+                self.values.append(number)
+            else:
+                self.large_ints[len(self.values)] = number
+                self.values.append(_approximate(number))
+            self.is_int.append(1)
+        else:
+            self.values.append(number)
+            self.is_int.append(0)
+        self.lines.append(line)
+        self.starts.append(start)
+        self.lengths.append(length)
+
+    def extend(self, other, line_offset=0):
+        for i, number in other.large_ints.items():
+            self.large_ints[len(self.values) + i] = number
+        self.values.extend(other.values)
+        self.is_int.extend(other.is_int)
+        if line_offset == 0:
+            self.lines.extend(other.lines)
+        else:
+            self.lines.extend(line + line_offset for line in other.lines)
+        self.starts.extend(other.starts)
+        self.lengths.extend(other.lengths)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if self.is_int[i]:
+            if i in self.large_ints:
+                return self.large_ints[i]
+            return int(self.values[i])
+        return self.values[i]
+
+    def __iter__(self):
+        if self.large_ints:
+            return map(self.__getitem__, range(len(self)))
+        return (int(x) if t else x for x, t in zip(self.values, self.is_int))
+
+    def location(self, i):
+        return (self.lines[i], self.starts[i], self.lengths[i])
+
+    def locations(self):
+        return list(zip(self.lines, self.starts, self.lengths))
+
+    def has_floats(self):
+        return 0 in self.is_int
+
+    def apply_abs(self):
+        """
+        Replaces all numbers by their absolute values.
+        """
+        self.values = array("d", map(abs, self.values))
+        for i, number in self.large_ints.items():
+            self.large_ints[i] = abs(number)
+
+    def sort(self):
+        """
+        Sorts the numbers, the locations stay where they are.
+        """
+        order = sorted(range(len(self)), key=self.__getitem__)
+        self.values = array("d", [self.values[i] for i in order])
+        self.is_int = array("b", [self.is_int[i] for i in order])
+        if self.large_ints:
+            position = {i: k for k, i in enumerate(order) if i in self.large_ints}
+            self.large_ints = {position[i]: n for i, n in self.large_ints.items()}
+
+    def nbytes(self):
+        """
+        Returns the number of bytes used to hold numbers and locations.
+        """
+        arrays = [self.values, self.is_int, self.lines, self.starts, self.lengths]
+        size = sum(a.itemsize * len(a) for a in arrays)
+        size += sum(sys.getsizeof(n) for n in self.large_ints.values())
+        return size
+
+
+def _approximate(number):
+    try:
+        return float(number)
+    except OverflowError:
+        return float("inf") if number > 0 else float("-inf")
 
 
 def extract_numbers(text, mask=None):
@@ -13,53 +156,176 @@ def extract_numbers(text, mask=None):
         numbers - list of numbers
         locations - locations of each number as list of triples (line, start position, length)
     """
-    numeric_const_pattern = r"""
-    [-+]? # optional sign
-    (?:
-        (?: \d* \. \d+ ) # .1 .12 .123 etc 9.1 etc 98.1 etc
-        |
-        (?: \d+ \.? ) # 1. 12. 123. etc 1 12 123 etc
-    )
-    # followed by optional exponent part if desired
-    (?: [EeDd] [+-]? \d+ ) ?
+    extracted = extract_numbers_compact(text, mask)
+    return list(extracted), extracted.locations()
+
+
+def extract_numbers_compact(text, mask=None):
+    """
+    Extracts floats and integers from string text.
+
+    Returns:
+        extracted - ExtractedNumbers holding numbers and their locations
     """
-    pattern_number_and_separator = re.compile(r"^[0-9\.eEdD\+\-]+[,]?$", re.VERBOSE)
-    pattern_int = re.compile(r"-?[0-9]+", re.VERBOSE)
-    pattern_float = re.compile(numeric_const_pattern, re.VERBOSE)
-    pattern_d = re.compile(r"[dD]")
+    extracted = ExtractedNumbers()
+    add = extracted.append
 
-    numbers = []
-    locations = []
+    # the common cases append to the arrays directly
+    add_value = extracted.values.append
+    add_is_int = extracted.is_int.append
+    add_line = extracted.lines.append
+    add_start = extracted.starts.append
+    add_length = extracted.lengths.append
 
     for n, line in enumerate(text):
         n_matches = 0
+        end = 0
         for w in line.split():
+            # words are found in order so this is the exact position
+            start = line.find(w, end)
+            end = start + len(w)
+
             # do not consider words like TzB1g
-            if not re.match(pattern_number_and_separator, w):
+            if w[-1] == ",":
+                w = w[:-1]
+            if w == "" or w.strip(_numeric_chars) != "":
                 continue
 
             n_matches += 1
             if mask is not None and n_matches not in mask:
                 continue
 
-            is_integer = False
-            matched_floats = pattern_float.findall(w)
-
-            if len(matched_floats) > 0:
-                is_integer = matched_floats == pattern_int.findall(w)
+            if w.isdigit() or w[0] == "-" and w[1:].isdigit():
+                if len(w) > 15:
+                    # may not fit into a double exactly
+                    add(int(w), n, start, len(w))
+                    continue
+                add_value(int(w))
+                add_is_int(1)
+            else:
+                try:
+                    # substitute dD by e
+                    add_value(float(w.translate(_d_to_e)))
+                    add_is_int(0)
+                except ValueError:
+                    _add_numbers(add, w, n, start)
+                    continue
+            add_line(n)
+            add_start(start)
+            add_length(len(w))
+
+    return extracted
+
+
+def extract_numbers_mapped(buffer, line_starts, sections, mask=None, encoding="utf-8"):
+    """
+    Extracts floats and integers from sections of a bytes buffer (typically
+    a mmap of the file) without decoding it line by line. line_starts holds
+    the offset of each line and one past the end of the buffer. Line numbers
+    count the lines of all sections one after the other like the lines which
+    join_sections returns.
 
-            # apply floating point regex
-            for m in matched_floats:
-                index = line.index(m)
-                # substitute dD by e
-                if is_integer:
-                    numbers.append(int(m))
+    Returns:
+        extracted - ExtractedNumbers holding numbers and their locations
+    """
+    extracted = ExtractedNumbers()
+    add = extracted.append
+
+    add_value = extracted.values.append
+    add_is_int = extracted.is_int.append
+    add_line = extracted.lines.append
+    add_start = extracted.starts.append
+    add_length = extracted.lengths.append
+
+    def _add_decoded(i, n):
+        # columns count characters and not bytes, such lines are decoded
+        line = buffer[line_starts[i] : line_starts[i + 1]].decode(encoding)
+        line = line.replace("\r\n", "\n")
+        extracted.extend(extract_numbers_compact([line], mask), n)
+
+    offset = 0
+    for first, last in sections:
+        begin = line_starts[first]
+        end = line_starts[last]
+        decoded = _non_ascii_lines(buffer, line_starts, begin, end)
+        k = 0
+        i = first - 1
+        next_start = begin
+        n_matches = 0
+        for m in _pattern_word.finditer(buffer, begin, end):
+            start = m.start()
+            if start >= next_start:
+                # first number on this line
+                i = bisect_right(line_starts, start) - 1
+                next_start = line_starts[i + 1]
+                n_matches = 0
+                while k < len(decoded) and decoded[k] < i:
+                    _add_decoded(decoded[k], decoded[k] - first + offset)
+                    k += 1
+                if k < len(decoded) and decoded[k] == i:
+                    skip = True
                 else:
-                    m = pattern_d.sub("e", m)
-                    numbers.append(float(m))
-                locations.append((n, index, len(m)))
+                    skip = False
+                    n = i - first + offset
+                    line_start = line_starts[i]
+            if skip:
+                continue
+
+            n_matches += 1
+            if mask is not None and n_matches not in mask:
+                continue
 
-    return numbers, locations
+            start -= line_start
+            w = m.group(m.lastindex)
+            if m.lastindex == 1:
+                # integers with up to 15 digits are exact as doubles
+                add_value(int(w))
+                add_is_int(1)
+            elif w.isdigit() or w[:1] == b"-" and w[1:].isdigit():
+                add(int(w), n, start, len(w))
+                continue
+            else:
+                try:
+                    add_value(float(w))
+                except ValueError:
+                    try:
+                        # substitute dD by e
+                        add_value(float(w.translate(_d_to_e_bytes)))
+                    except ValueError:
+                        _add_numbers(add, w.decode("ascii"), n, start)
+                        continue
+                add_is_int(0)
+            add_line(n)
+            add_start(start)
+            add_length(len(w))
+
+        for i in decoded[k:]:
+            _add_decoded(i, i - first + offset)
+        offset += last - first
+
+    return extracted
+
+
+def _non_ascii_lines(buffer, line_starts, begin, end):
+    lines = []
+    m = _pattern_non_ascii.search(buffer, begin, end)
+    while m is not None:
+        i = bisect_right(line_starts, m.start()) - 1
+        lines.append(i)
+        m = _pattern_non_ascii.search(buffer, line_starts[i + 1], end)
+    return lines
+
+
+def _add_numbers(add, w, n, start):
+    # words like 1.0-2.0 may contain several numbers
+    matched_floats = list(_pattern_float.finditer(w))
+    is_integer = [m.group() for m in matched_floats] == _pattern_int.findall(w)
+    for m in matched_floats:
+        if is_integer:
+            number = int(m.group())
+        else:
+            number = float(m.group().translate(_d_to_e))
+        add(number, n, start + m.start(), len(m.group()))
 
 
 def test_extract_numbers():
@@ -201,3 +467,54 @@ def test_extract_separated_numbers_mask():
         (4, 0, 2),
         (4, 8, 2),
     ]
+
+
+def test_extract_repeated_numbers():
+    text = """1.0 2.0 1.0 1.0
+ 7 7   7
+1.0-1.0 +1 1d-3 1.0,"""
+
+    numbers, locations = extract_numbers(text.splitlines())
+
+    assert numbers == [1.0, 2.0, 1.0, 1.0, 7, 7, 7, 1.0, -1.0, 1.0, 1.0e-3, 1.0]
+    assert locations == [
+        (0, 0, 3),
+        (0, 4, 3),
+        (0, 8, 3),
+        (0, 12, 3),
+        (1, 1, 1),
+        (1, 3, 1),
+        (1, 7, 1),
+        (2, 0, 3),
+        (2, 3, 4),
+        (2, 8, 2),
+        (2, 11, 4),
+        (2, 16, 3),
+    ]
+
+
+def test_extracted_numbers():
+    text = """-3 2.5 123456789012345678901234567890
+-1.0 7"""
+
+    extracted = extract_numbers_compact(text.splitlines())
+
+    assert len(extracted) == 5
+    assert list(extracted) == [-3, 2.5, 123456789012345678901234567890, -1.0, 7]
+    assert [type(x) for x in extracted] == [int, float, int, float, int]
+    assert extracted.location(2) == (0, 7, 30)
+    assert extracted.has_floats()
+    assert extracted.nbytes() < 200
+
+    extracted.apply_abs()
+    extracted.sort()
+    assert list(extracted) == [1.0, 2.5, 3, 7, 123456789012345678901234567890]
+    assert [type(x) for x in extracted] == [float, float, int, int, int]
+    # locations are not reordered
+    assert extracted.locations() == [
+        (0, 0, 2),
+        (0, 3, 3),
+        (0, 7, 30),
+        (1, 0, 4),
+        (1, 5, 1),
+    ]
@@ -17,6 +17,7 @@ recognized_kw = [
     "num_lines",
     "rel_tolerance",
     "abs_tolerance",
+    "early",
 ]
 
 incompatible_pairs = [
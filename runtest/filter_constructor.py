@@ -25,6 +25,7 @@ def get_filter(**kwargs):
             "tolerance",
             "tolerance_is_relative",
             "tolerance_is_set",
+            "early",
         ],
     )
 
@@ -54,6 +55,7 @@ def get_filter(**kwargs):
     _filter.skip_below = kwargs.get("skip_below", sys.float_info.min)
     _filter.skip_above = kwargs.get("skip_above", sys.float_info.max)
     _filter.num_lines = kwargs.get("num_lines", 0)
+    _filter.early = kwargs.get("early", False)
 
     if "rel_tolerance" in kwargs.keys():
         _filter.tolerance = kwargs.get("rel_tolerance")
@@ -92,3 +94,69 @@ def get_filter(**kwargs):
         _filter.from_is_re = True
 
     return _filter
+
+
+def filter_to_dict(f):
+    """
+    Returns:
+        d - the filter as JSON compatible dictionary, filter_from_dict turns
+            it back into a filter
+    """
+    d = {
+        "from_string": f.from_string,
+        "from_is_re": f.from_is_re,
+        "to_string": f.to_string,
+        "to_is_re": f.to_is_re,
+        "num_lines": f.num_lines,
+        "mask": None if f.mask is None else list(f.mask),
+        "ignore_sign": f.ignore_sign,
+        "ignore_order": f.ignore_order,
+        "skip_below": f.skip_below,
+        "skip_above": f.skip_above,
+        "early": f.early,
+    }
+    if f.tolerance_is_set:
+        if f.tolerance_is_relative:
+            d["rel_tolerance"] = f.tolerance
+        else:
+            d["abs_tolerance"] = f.tolerance
+    return d
+
+
+def filter_from_dict(d):
+    kwargs = {
+        k: d[k]
+        for k in [
+            "mask",
+            "ignore_sign",
+            "ignore_order",
+            "skip_below",
+            "skip_above",
+            "early",
+            "rel_tolerance",
+            "abs_tolerance",
+        ]
+        if k in d
+    }
+    if d["from_string"] is not None:
+        kwargs["from_re" if d["from_is_re"] else "from_string"] = d["from_string"]
+    if d["to_string"] is not None:
+        kwargs["to_re" if d["to_is_re"] else "to_string"] = d["to_string"]
+    elif d["num_lines"] != 0:
+        kwargs["num_lines"] = d["num_lines"]
+    return get_filter(**kwargs)
+
+
+def test_filter_to_dict():
+    import json
+
+    filters = [
+        get_filter(),
+        get_filter(string="energy", abs_tolerance=1.0e-6, mask=[1]),
+        get_filter(re=r"^\s+E", rel_tolerance=1.0e-8, ignore_sign=True),
+        get_filter(from_string="a", to_re="b$", ignore_order=True, early=True),
+        get_filter(from_re="a", num_lines=3, skip_below=1.0e-4, skip_above=1.0e4),
+    ]
+    for f in filters:
+        d = json.loads(json.dumps(filter_to_dict(f)))
+        assert filter_to_dict(filter_from_dict(d)) == d
@@ -0,0 +1,144 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import os
+import sqlite3
+import time
+from contextlib import closing
+from .cache import default_cache_dir
+
+
+default_history_name = "history.sqlite"
+
+
+def history_file(cache_dir=None):
+    """
+    Returns:
+        file_name - the timing history in cache_dir (by default the cache
+                    directory of runtest), outside of the test sources
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    return os.path.join(cache_dir, default_history_name)
+
+
+class TimingHistory:
+    """
+    Wall times of earlier runs, kept in a small SQLite file. Only the
+    latest keep runs of each test are kept, older ones are removed when
+    new ones are recorded, and compact() removes tests which no longer run.
+
+    The history only helps with scheduling: if the file cannot be read or
+    written nothing is recorded and all estimates are equal.
+    """
+
+    def __init__(self, file_name, keep=5):
+        self.file_name = file_name
+        self.keep = keep
+
+    def _connect(self):
+        # one connection per call so that threads and processes can share
+        # the file
+        os.makedirs(os.path.dirname(os.path.abspath(self.file_name)), exist_ok=True)
+        connection = sqlite3.connect(self.file_name, timeout=10.0)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS runs "
+            "(key TEXT NOT NULL, wall_time REAL NOT NULL, recorded REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS runs_key ON runs (key)")
+        return connection
+
+    def record(self, key, wall_time):
+        try:
+            with closing(self._connect()) as connection, connection:
+                connection.execute(
+                    "INSERT INTO runs VALUES (?, ?, ?)", (key, wall_time, time.time())
+                )
+                connection.execute(
+                    "DELETE FROM runs WHERE key = ? AND rowid NOT IN "
+                    "(SELECT rowid FROM runs WHERE key = ? "
+                    "ORDER BY rowid DESC LIMIT ?)",
+                    (key, key, self.keep),
+                )
+        except (sqlite3.Error, OSError):
+            pass
+
+    def estimates(self):
+        """
+        Returns:
+            estimates - mean wall time of the kept runs by test key
+        """
+        if not os.path.exists(self.file_name):
+            return {}
+        try:
+            with closing(self._connect()) as connection:
+                rows = connection.execute(
+                    "SELECT key, AVG(wall_time) FROM runs GROUP BY key"
+                ).fetchall()
+        except (sqlite3.Error, OSError):
+            return {}
+        return dict(rows)
+
+    def compact(self, older_than=90 * 24 * 3600.0):
+        """
+        Removes the runs of tests which did not run in the last older_than
+        seconds, e.g. tests which were renamed or removed, and gives the
+        space back.
+        """
+        try:
+            with closing(self._connect()) as connection, connection:
+                connection.execute(
+                    "DELETE FROM runs WHERE key IN (SELECT key FROM runs "
+                    "GROUP BY key HAVING MAX(recorded) < ?)",
+                    (time.time() - older_than,),
+                )
+            with closing(self._connect()) as connection:
+                connection.execute("VACUUM")
+        except (sqlite3.Error, OSError):
+            pass
+
+
+def longest_first(keys, estimates):
+    """
+    Orders tests by their expected wall time, longest first. Tests without
+    history are expected to take as long as the median known test.
+
+    Returns:
+        order - indices into keys, ties keep their order
+    """
+    known = sorted(estimates[key] for key in keys if key in estimates)
+    if known == []:
+        return list(range(len(keys)))
+    median = known[len(known) // 2]
+    return sorted(range(len(keys)), key=lambda i: -estimates.get(keys[i], median))
+
+
+def test_timing_history(tmpdir):
+    history = TimingHistory(str(tmpdir.join("history.sqlite")), keep=2)
+    assert history.estimates() == {}
+
+    for wall_time in [100.0, 2.0, 4.0]:
+        history.record("a", wall_time)
+    history.record("b", 10.0)
+    assert history.estimates() == {"a": 3.0, "b": 10.0}
+
+    history.compact(older_than=3600.0)
+    assert len(history.estimates()) == 2
+    history.compact(older_than=-1.0)
+    assert history.estimates() == {}
+
+
+def test_timing_history_unusable(tmpdir):
+    tmpdir.join("file").write("")
+    history = TimingHistory(str(tmpdir.join("file", "history.sqlite")))
+    history.record("a", 1.0)
+    assert history.estimates() == {}
+
+
+def test_longest_first():
+    estimates = {"a": 1.0, "b": 30.0, "c": 5.0}
+    assert longest_first(["a", "b", "c"], estimates) == [1, 2, 0]
+    # unknown tests go in the middle
+    assert longest_first(["x", "a", "b", "c"], estimates) == [2, 0, 3, 1]
+    assert longest_first(["x", "y"], estimates) == [0, 1]
@@ -0,0 +1,434 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import codecs
+import locale
+import mmap
+import re
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context, shared_memory
+from .extract import extract_numbers_mapped, ExtractedNumbers
+from .scissors import plain_anchors, section_bounds_from_hits, anchor_lines
+
+
+_pattern_newline = re.compile(b"\n")
+_pattern_lone_cr = re.compile(b"\r(?!\n)")
+
+# below this many bytes of sections numbers are extracted in this process
+default_parallel_threshold = 64 * 1024 * 1024
+
+
+def map_file(file_name):
+    """
+    Maps a file into memory so that sections and numbers can be found on
+    the bytes without decoding the file line by line.
+
+    Returns:
+        mapped - MappedFile or None if the file cannot be handled this way
+                 (empty file, encoding which is not UTF-8 or ASCII,
+                 old Mac line endings)
+    """
+    encoding = locale.getpreferredencoding(False)
+    if codecs.lookup(encoding).name not in ("utf-8", "ascii"):
+        return None
+
+    with open(file_name, "rb") as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            return None
+
+    if _pattern_lone_cr.search(buffer) is not None:
+        # text mode would split lines here as well
+        buffer.close()
+        return None
+
+    return MappedFile(buffer, encoding, file_name)
+
+
+class MappedFile:
+    """
+    A memory mapped file together with the offsets of its lines.
+
+    The newline index holds the offset of each line and, as last element,
+    the size of the file. This is one integer per line instead of one string
+    per line.
+    """
+
+    def __init__(self, buffer, encoding="utf-8", file_name=None):
+        self.buffer = buffer
+        self.encoding = encoding
+        self.file_name = file_name
+        self.line_starts = array("q", [0])
+        self.line_starts.extend(m.end() for m in _pattern_newline.finditer(buffer))
+        if self.line_starts[-1] != len(buffer):
+            # last line without newline
+            self.line_starts.append(len(buffer))
+
+    def __len__(self):
+        return len(self.line_starts) - 1
+
+    def close(self):
+        self.buffer.close()
+
+    def section_bounds(self, filter_list):
+        """
+        Finds the sections of all filters like scissors.section_bounds.
+
+        Returns:
+            bounds - for each filter a list of (first line, last line + 1)
+                     pairs or None if an anchor can only be handled on
+                     decoded lines (regular expressions, line breaks)
+        """
+        for f in filter_list:
+            if f.from_string is None:
+                continue
+            if f.from_is_re or f.num_lines == 0 and (f.to_is_re or f.to_string is None):
+                return None
+
+        line_ends = memoryview(self.line_starts)[1:]
+        hits = {}
+        for anchor in plain_anchors(filter_list):
+            if "\n" in anchor or "\r" in anchor:
+                return None
+            if anchor == "":
+                hits[anchor] = list(range(len(self)))
+            else:
+                hits[anchor] = anchor_lines(
+                    self.buffer, line_ends, anchor.encode(self.encoding)
+                )
+
+        return section_bounds_from_hits(
+            filter_list, len(self), lambda anchor, is_re: hits[anchor]
+        )
+
+    def join_sections(self, bounds):
+        """
+        Concatenates sections like scissors.join_sections but without copying
+        them out of the buffer.
+
+        Returns:
+            sections - MappedSections
+        """
+        for _, stop in bounds:
+            if stop > len(self):
+                raise IndexError("list index out of range")
+        return MappedSections(self, bounds)
+
+
+class MappedSections:
+    """
+    Sections of a mapped file which behave like the list of their lines.
+    """
+
+    def __init__(self, mapped, bounds):
+        self.mapped = mapped
+        self.bounds = bounds
+
+    def __len__(self):
+        return sum(stop - start for start, stop in self.bounds)
+
+    def __iter__(self):
+        for start, stop in self.bounds:
+            yield from self._decode(start, stop).splitlines(keepends=True)
+
+    def __eq__(self, other):
+        if len(self) != len(other):
+            return False
+        if isinstance(other, MappedSections):
+            return self.text() == other.text()
+        return self.text() == "".join(other)
+
+    def _decode(self, start, stop):
+        line_starts = self.mapped.line_starts
+        raw = self.mapped.buffer[line_starts[start] : line_starts[stop]]
+        return raw.decode(self.mapped.encoding).replace("\r\n", "\n")
+
+    def text(self):
+        return "".join(self._decode(start, stop) for start, stop in self.bounds)
+
+    def nbytes(self):
+        line_starts = self.mapped.line_starts
+        return sum(line_starts[stop] - line_starts[start] for start, stop in self.bounds)
+
+    def extract_numbers(
+        self, mask=None, processes=1, threshold=default_parallel_threshold
+    ):
+        """
+        Extracts numbers from all sections, with processes > 1 sections of
+        at least threshold bytes are split into chunks which are parsed in
+        a process pool.
+
+        Returns:
+            extracted - ExtractedNumbers holding numbers and their locations
+        """
+        if (
+            processes > 1
+            and self.mapped.file_name is not None
+            and self.nbytes() >= threshold
+        ):
+            return _extract_parallel(self.mapped, self.bounds, mask, processes)
+        return extract_numbers_mapped(
+            self.mapped.buffer,
+            self.mapped.line_starts,
+            self.bounds,
+            mask,
+            self.mapped.encoding,
+        )
+
+
+def _extract_parallel(mapped, bounds, mask, processes):
+    # sections are found on the whole file before it is split so anchors
+    # cannot cross chunk boundaries, chunks always end at a line break and
+    # the mask only counts numbers within one line
+    line_starts = mapped.line_starts
+    chunks = _split_sections(line_starts, bounds, 4 * processes)
+
+    # workers map the file themselves and share the newline index
+    index = shared_memory.SharedMemory(
+        create=True, size=line_starts.itemsize * len(line_starts)
+    )
+    futures = []
+    results = []
+    try:
+        with memoryview(line_starts).cast("B") as raw:
+            index.buf[: len(raw)] = raw
+        with ProcessPoolExecutor(
+            max_workers=processes, mp_context=_pool_context()
+        ) as pool:
+            futures = [
+                pool.submit(
+                    _extract_chunk,
+                    mapped.file_name,
+                    mapped.encoding,
+                    index.name,
+                    len(line_starts),
+                    sections,
+                    mask,
+                )
+                for sections, _ in chunks
+            ]
+        # leaving the pool waited for all chunks, also for those after one
+        # which failed, so that the segments of all of them are known
+        for future in futures:
+            results.append(future.result())
+    except BaseException:
+        for future in futures:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                _unlink(future.result()[0])
+        raise
+    finally:
+        index.close()
+        index.unlink()
+
+    extracted = ExtractedNumbers()
+    for k, ((_, line_offset), result) in enumerate(zip(chunks, results)):
+        try:
+            _collect(extracted, result, line_offset)
+        except BaseException:
+            for name, _, _ in results[k + 1 :]:
+                _unlink(name)
+            raise
+    return extracted
+
+
+def _pool_context():
+    # run_many() verifies from threads and a forked child can inherit a
+    # lock which one of them holds
+    if "forkserver" in get_all_start_methods():
+        return get_context("forkserver")
+    return None
+
+
+def _split_sections(line_starts, bounds, num_chunks):
+    # returns chunks of about equal size in bytes as lists of line ranges
+    # together with the number of lines before the chunk
+    total = sum(line_starts[stop] - line_starts[start] for start, stop in bounds)
+    target = max(1, total // num_chunks)
+
+    chunks = []
+    current = []
+    size = 0
+    lines_before = 0
+    num_lines = 0
+    for start, stop in bounds:
+        while start < stop:
+            limit = line_starts[start] + target - size
+            cut = bisect_left(line_starts, limit, start + 1, stop)
+            current.append((start, cut))
+            size += line_starts[cut] - line_starts[start]
+            num_lines += cut - start
+            if size >= target:
+                chunks.append((current, lines_before))
+                lines_before += num_lines
+                current = []
+                size = 0
+                num_lines = 0
+            start = cut
+    if current:
+        chunks.append((current, lines_before))
+    return chunks
+
+
+def _extract_chunk(file_name, encoding, index_name, num_starts, sections, mask):
+    index = shared_memory.SharedMemory(name=index_name)
+    try:
+        with index.buf.cast("q") as starts, starts[:num_starts] as line_starts:
+            with open(file_name, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                numbers = extract_numbers_mapped(
+                    buffer, line_starts, sections, mask, encoding
+                )
+            finally:
+                buffer.close()
+    finally:
+        index.close()
+
+    # the arrays are handed back through shared memory and only the
+    # few integers which do not fit into doubles are pickled
+    arrays = _arrays(numbers)
+    size = sum(a.itemsize * len(a) for a in arrays)
+    result = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    position = 0
+    for a in arrays:
+        with memoryview(a).cast("B") as raw:
+            result.buf[position : position + len(raw)] = raw
+            position += len(raw)
+    result.close()
+    return result.name, len(numbers), numbers.large_ints
+
+
+def _collect(extracted, result, line_offset):
+    name, count, large_ints = result
+    part = ExtractedNumbers()
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        position = 0
+        for a in _arrays(part):
+            size = a.itemsize * count
+            with shm.buf[position : position + size] as raw:
+                a.frombytes(raw)
+            position += size
+    finally:
+        shm.close()
+        shm.unlink()
+    part.large_ints = large_ints
+    extracted.extend(part, line_offset)
+
+
+def _arrays(numbers):
+    return [numbers.values, numbers.is_int, numbers.lines, numbers.starts, numbers.lengths]
+
+
+def _unlink(name):
+    shm = shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
+
+
+def test_mapped_file(tmpdir):
+    import pytest
+    from .extract import extract_numbers
+    from .filter_constructor import get_filter
+    from .scissors import section_bounds, join_sections
+
+    text = [
+        "START 1.0 2,\r\n",
+        "x 1.0e-3 -7 1.0D+2 1.0-2.0 12345678901234567890\n",
+        "grüß 3.5 -4 é 5\n",
+        "\n",
+        "a END 1. .5 x1 2.0, 3,,\n",
+        "START 42",
+    ]
+    file_name = str(tmpdir.join("out"))
+    with open(file_name, "wb") as f:
+        f.write("".join(text).encode("utf-8"))
+    with open(file_name, "r") as f:
+        lines = f.readlines()
+
+    mapped = map_file(file_name)
+    assert len(mapped) == len(lines)
+
+    filters = [
+        get_filter(),
+        get_filter(from_string="START", to_string="END"),
+        get_filter(from_string="1.0e-3", num_lines=3),
+        get_filter(string="-"),
+        get_filter(string="5", mask=[2, 3]),
+    ]
+    bounds = mapped.section_bounds(filters)
+    assert bounds == section_bounds(lines, filters)
+
+    for f, b in zip(filters, bounds):
+        filtered = join_sections(lines, b)
+        sections = mapped.join_sections(b)
+        assert sections == filtered
+        assert list(sections) == filtered
+        assert sections.text() == "".join(filtered)
+        numbers = sections.extract_numbers(f.mask)
+        assert (list(numbers), numbers.locations()) == extract_numbers(
+            filtered, f.mask
+        )
+
+    (bounds,) = mapped.section_bounds([get_filter(from_string="START", num_lines=2)])
+    with pytest.raises(IndexError):
+        mapped.join_sections(bounds)
+
+    assert mapped.section_bounds([get_filter(from_re="S.A", to_string="END")]) is None
+    mapped.close()
+
+
+def test_extract_parallel(tmpdir):
+    from .extract import extract_numbers
+    from .filter_constructor import get_filter
+    from .scissors import join_sections
+
+    lines = []
+    for i in range(300):
+        if i % 50 == 0:
+            lines.append("START é {0}\n".format(i))
+        lines.append("{0} {1}.5 -{2} 1.0D-{3}, x{0}\n".format(i, i % 7, i % 3, i % 4))
+        if i % 50 == 25:
+            lines.append("END 12345678901234567890\n")
+    file_name = str(tmpdir.join("out"))
+    with open(file_name, "w") as f:
+        f.write("".join(lines))
+
+    filters = [
+        get_filter(),
+        get_filter(from_string="START", to_string="END"),
+        get_filter(from_string="START", num_lines=40),
+        get_filter(from_string="START", num_lines=40, mask=[1, 3]),
+    ]
+    mapped = map_file(file_name)
+    for f, bounds in zip(filters, mapped.section_bounds(filters)):
+        sections = mapped.join_sections(bounds)
+        numbers = sections.extract_numbers(f.mask, processes=2, threshold=0)
+        expected = extract_numbers(join_sections(lines, bounds), f.mask)
+        assert (list(numbers), numbers.locations()) == expected
+    mapped.close()
+
+    bounds = [(0, 10), (5, 30), (30, 31), (100, 250)]
+    line_starts = array("q", range(0, 3000, 10))
+    chunks = _split_sections(line_starts, bounds, 8)
+    assert [r for sections, _ in chunks for r in sections][0] == (0, 10)
+    assert sum(stop - start for sections, _ in chunks for start, stop in sections) == 186
+    lines_before = 0
+    for sections, offset in chunks:
+        assert offset == lines_before
+        lines_before += sum(stop - start for start, stop in sections)
+
+
+def test_map_file_fallback(tmpdir):
+    empty = tmpdir.join("empty")
+    empty.write("")
+    assert map_file(str(empty)) is None
+
+    old_mac = tmpdir.join("old_mac")
+    old_mac.write_binary(b"1.0\r2.0\r")
+    assert map_file(str(old_mac)) is None
@@ -0,0 +1,241 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import json
+import os
+from collections import namedtuple
+from .exceptions import FilterKeywordError, FailedTestError
+
+
+recognized_kw = ["rel_tolerance", "abs_tolerance", "metrics", "warn_only"]
+
+# fields of report.Usage which can be compared against a baseline
+known_metrics = ["wall_time", "user_time", "system_time", "max_rss"]
+
+_units = {"wall_time": "s", "user_time": "s", "system_time": "s", "max_rss": "bytes"}
+
+
+def get_performance_filter(**kwargs):
+    """
+    Like get_filter but for the resources a test uses. Only regressions
+    count: a test may always be faster or smaller than its baseline.
+
+    Keywords:
+        - rel_tolerance or abs_tolerance -- allowed increase, absolute
+          tolerances are in seconds and bytes
+        - metrics -- list of report.Usage fields to compare
+                     [default: wall_time and max_rss]
+        - warn_only -- only print a warning instead of failing the test
+    """
+    _performance = namedtuple(
+        "_performance",
+        ["metrics", "tolerance", "tolerance_is_relative", "warn_only"],
+    )
+
+    unrecognized_kw = [kw for kw in kwargs.keys() if kw not in recognized_kw]
+    if unrecognized_kw != []:
+        error = """ERROR: keyword(s) ({unrecognized}) not recognized
+       available keywords: ({available})\n""".format(
+            unrecognized=(", ").join(sorted(unrecognized_kw)),
+            available=(", ").join(recognized_kw),
+        )
+        raise FilterKeywordError(error)
+
+    if "rel_tolerance" in kwargs.keys() and "abs_tolerance" in kwargs.keys():
+        error = "ERROR: incompatible keyword pairs: {0}\n".format(
+            [("rel_tolerance", "abs_tolerance")]
+        )
+        raise FilterKeywordError(error)
+
+    if "rel_tolerance" in kwargs.keys():
+        _performance.tolerance = kwargs.get("rel_tolerance")
+        _performance.tolerance_is_relative = True
+    elif "abs_tolerance" in kwargs.keys():
+        _performance.tolerance = kwargs.get("abs_tolerance")
+        _performance.tolerance_is_relative = False
+    else:
+        raise FilterKeywordError(
+            "ERROR: for performance you have to specify either rel_tolerance or abs_tolerance\n"
+        )
+
+    _performance.metrics = list(kwargs.get("metrics", ["wall_time", "max_rss"]))
+    unknown_metrics = [m for m in _performance.metrics if m not in known_metrics]
+    if unknown_metrics != []:
+        error = """ERROR: metric(s) ({unknown}) not recognized
+       available metrics: ({available})\n""".format(
+            unknown=(", ").join(unknown_metrics),
+            available=(", ").join(known_metrics),
+        )
+        raise FilterKeywordError(error)
+
+    _performance.warn_only = kwargs.get("warn_only", False)
+
+    return _performance
+
+
+def performance_to_dict(performance):
+    """
+    Returns:
+        d - keyword arguments of get_performance_filter which recreate it
+    """
+    tolerance = "rel_tolerance" if performance.tolerance_is_relative else "abs_tolerance"
+    return {
+        tolerance: performance.tolerance,
+        "metrics": list(performance.metrics),
+        "warn_only": performance.warn_only,
+    }
+
+
+def baseline_name(reference_dir, output_prefix):
+    """
+    Returns:
+        file_name - where the baseline of a test is kept, next to its
+                    reference outputs
+    """
+    if output_prefix is None:
+        return os.path.join(reference_dir, "baseline.json")
+    return os.path.join(reference_dir, output_prefix + ".baseline.json")
+
+
+def record_baseline(file_name, usage):
+    baseline = {m: getattr(usage, m) for m in known_metrics}
+    with open(file_name, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def find_regressions(performance, usage, baseline):
+    """
+    Returns:
+        regressions - list of error messages, one per metric which grew
+                      by more than the tolerance
+    """
+    regressions = []
+    for metric in performance.metrics:
+        value = getattr(usage, metric)
+        reference = baseline.get(metric)
+        if value is None or reference is None:
+            # not measured on this platform or not recorded
+            continue
+        difference = value - reference
+        if performance.tolerance_is_relative:
+            if reference == 0.0:
+                error = 0.0 if difference <= 0.0 else float("inf")
+            else:
+                error = difference / reference
+            definition = "rel"
+        else:
+            error = difference
+            definition = "abs"
+        if error > performance.tolerance:
+            regressions.append(
+                "%s: %s %s ### baseline: %s (%s diff: %6.2e)\n"
+                % (metric, _format(value), _units[metric], _format(reference), definition, error)
+            )
+    return regressions
+
+
+def check_performance(performance, usage, file_name, record=False, out=None):
+    """
+    Compares the resources used by a test against its baseline or records
+    them as new baseline.
+
+    Raises:
+        - FailedTestError
+    """
+    if record:
+        record_baseline(file_name, usage)
+        if out is not None:
+            out.write("recorded performance baseline {0}\n".format(file_name))
+        return
+
+    if not os.path.exists(file_name):
+        if out is not None:
+            out.write(
+                "WARNING: no performance baseline {0}, record one with --record-baselines\n".format(
+                    file_name
+                )
+            )
+        return
+
+    with open(file_name) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(performance, usage, baseline)
+    if regressions == []:
+        return
+
+    if performance.warn_only:
+        if out is not None:
+            out.write("WARNING: performance regression\n")
+            for r in regressions:
+                out.write("WARNING " + r)
+        return
+
+    message = "ERROR: performance regression against %s\n" % file_name
+    message += "".join("ERROR   " + r for r in regressions)
+    raise FailedTestError(message)
+
+
+def _format(value):
+    if isinstance(value, int):
+        return "%i" % value
+    return "%.3f" % value
+
+
+def test_get_performance_filter():
+    import pytest
+
+    p = get_performance_filter(rel_tolerance=0.2)
+    assert p.metrics == ["wall_time", "max_rss"]
+    assert p.tolerance_is_relative
+    assert not p.warn_only
+    q = get_performance_filter(**performance_to_dict(p))
+    assert performance_to_dict(q) == performance_to_dict(p)
+
+    with pytest.raises(FilterKeywordError) as e:
+        get_performance_filter(metrics=["wall_time"])
+    assert "you have to specify either rel_tolerance or abs_tolerance" in str(e.value)
+
+    with pytest.raises(FilterKeywordError) as e:
+        get_performance_filter(rel_tolerance=0.1, abs_tolerance=1.0)
+    assert "incompatible keyword pairs" in str(e.value)
+
+    with pytest.raises(FilterKeywordError) as e:
+        get_performance_filter(rel_tolerance=0.1, metrics=["speed"])
+    assert "metric(s) (speed) not recognized" in str(e.value)
+
+    with pytest.raises(FilterKeywordError) as e:
+        get_performance_filter(tolerance=0.1)
+    assert "keyword(s) (tolerance) not recognized" in str(e.value)
+
+
+def test_check_performance(tmpdir):
+    import pytest
+    from .report import Usage
+
+    file_name = str(tmpdir.join("baseline.json"))
+    baseline = Usage(10.0, 9.0, 0.5, 100 * 2**20)
+    p = get_performance_filter(rel_tolerance=0.2)
+
+    # without baseline there is nothing to compare
+    check_performance(p, baseline, file_name)
+
+    check_performance(p, baseline, file_name, record=True)
+    check_performance(p, Usage(11.9, 20.0, 9.0, 50 * 2**20), file_name)
+
+    with pytest.raises(FailedTestError) as e:
+        check_performance(p, Usage(12.5, 9.0, 0.5, 130 * 2**20), file_name)
+    message = str(e.value)
+    assert "ERROR   wall_time: 12.500 s ### baseline: 10.000 (rel diff: 2.50e-01)\n" in message
+    assert "ERROR   max_rss: 136314880 bytes" in message
+
+    # metrics which are not measured are skipped
+    check_performance(p, Usage(9.0, None, None, None), file_name)
+
+    p = get_performance_filter(abs_tolerance=1.0, metrics=["user_time"])
+    with pytest.raises(FailedTestError):
+        check_performance(p, Usage(10.0, 10.5, 0.5, 0), file_name)
+
+    p = get_performance_filter(abs_tolerance=1.0, metrics=["user_time"], warn_only=True)
+    check_performance(p, Usage(10.0, 10.5, 0.5, 0), file_name)
@@ -0,0 +1,407 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Runs the entries of a plan written by a test script with --plan, one per
+batch job (e.g. one per element of a job array).
+
+Usage: python -m runtest.plan [--execute-only|--verify-only] [--report FILE]
+                              PLAN [INDEX]
+
+Without INDEX the index is taken from SLURM_ARRAY_TASK_ID, PBS_ARRAY_INDEX
+or PBS_ARRAYID.
+"""
+
+import atexit
+import json
+import os
+import shlex
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+from types import SimpleNamespace
+from .filter_constructor import filter_to_dict, filter_from_dict
+from .performance import get_performance_filter, performance_to_dict
+from .report import write_reports
+from .shard import case_key
+
+
+# environment variables which hold the index of a job array element
+array_index_variables = ["SLURM_ARRAY_TASK_ID", "PBS_ARRAY_INDEX", "PBS_ARRAYID"]
+
+# entries planned by this process by plan file name, the entries of a test
+# script (by caller_dir) replace those of its earlier sessions in the file
+# and other entries are kept
+_plans = {}
+_lock = threading.Lock()
+
+# plan files which write_plans() still has to write
+_unwritten = set()
+
+
+def plan_entry(test):
+    """
+    Returns:
+        entry - everything which is needed to run and verify test (what
+                run() was called with) later, with the command resolved by
+                configure
+    """
+    options, configure, input_files, extra_args = test[:4]
+    filters, accepted_errors, timeout, performance, caller_dir = test[4:9]
+    launcher, command, output_prefix, relative_reference_path = configure(
+        options, input_files, extra_args
+    )
+    resolved_command = command
+    if options.launch_agent is not None:
+        resolved_command = "{0} {1}".format(options.launch_agent, command)
+    if sys.platform != "win32":
+        resolved_command = shlex.split(resolved_command)
+
+    work_dir = os.path.abspath(options.work_dir)
+    if output_prefix is None:
+        _output_prefix = os.path.join(work_dir, "")
+    else:
+        _output_prefix = os.path.join(work_dir, output_prefix) + "."
+
+    outputs = {}
+    for suffix in filters or []:
+        if output_prefix is None:
+            output = suffix
+        else:
+            output = "{0}.{1}".format(output_prefix, suffix)
+        outputs[suffix] = {
+            "output": os.path.join(work_dir, output),
+            "reference": os.path.join(work_dir, relative_reference_path, output),
+        }
+
+    if timeout is None:
+        timeout = getattr(options, "timeout", None)
+
+    return {
+        "key": case_key(input_files, extra_args),
+        "input_files": input_files,
+        "extra_args": extra_args,
+        "caller_dir": caller_dir,
+        "work_dir": work_dir,
+        "binary_dir": os.path.abspath(options.binary_dir),
+        "launcher": launcher,
+        "launch_agent": options.launch_agent,
+        "command": command,
+        "resolved_command": resolved_command,
+        "output_prefix": output_prefix,
+        "relative_reference_path": relative_reference_path,
+        "stdout": _output_prefix + "stdout",
+        "stderr": _output_prefix + "stderr",
+        "outputs": outputs,
+        "filters": None
+        if filters is None
+        else {suffix: [filter_to_dict(f) for f in filters[suffix]] for suffix in filters},
+        "accepted_errors": accepted_errors,
+        "timeout": timeout,
+        "performance": None
+        if performance is None
+        else performance_to_dict(performance),
+    }
+
+
+def add_entry(file_name, entry):
+    """
+    Appends entry to the plan of this process. The plan file is written by
+    write_plans(), at the latest when the process exits.
+    """
+    with _lock:
+        _plans.setdefault(file_name, []).append(entry)
+        _unwritten.add(file_name)
+
+
+def write_plans(out=None):
+    """
+    Merges the plans of this process which changed since they were last
+    written into their files.
+    """
+    if out is None:
+        out = sys.stdout
+    with _lock:
+        for file_name in sorted(_unwritten):
+            count = merge_plan(file_name, _plans[file_name])
+            out.write("wrote plan {0} with {1} entries\n".format(file_name, count))
+        _unwritten.clear()
+
+
+atexit.register(write_plans)
+
+
+def merge_plan(file_name, entries):
+    """
+    Replaces the entries of the test scripts of entries in the plan file
+    and keeps those of other scripts, processes which write the same plan
+    take turns.
+
+    Returns:
+        count - number of entries in the plan
+    """
+    scripts = set(e["caller_dir"] for e in entries)
+    with _FileLock(file_name):
+        try:
+            kept = [e for e in read_plan(file_name) if e["caller_dir"] not in scripts]
+        except (OSError, ValueError, KeyError):
+            kept = []
+        merged = [dict(e, index=i) for i, e in enumerate(kept + entries)]
+        write_plan(file_name, merged)
+    return len(merged)
+
+
+class _FileLock:
+    """
+    Holds file_name.lock while the block runs. Creating the lock file is
+    atomic on every platform, a lock older than stale seconds was left by
+    a process which died.
+    """
+
+    def __init__(self, file_name, stale=60.0, interval=0.05):
+        self.path = file_name + ".lock"
+        self.stale = stale
+        self.interval = interval
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(self.path).st_mtime > self.stale:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(self.interval)
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def write_plan(file_name, entries):
+    # replaced in one step like reports
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"entries": entries}, f, indent=2, default=str)
+        f.write("\n")
+    os.replace(tmp_path, file_name)
+
+
+def read_plan(file_name):
+    """
+    Returns:
+        entries - list of plan entries, ordered by index
+    """
+    with open(file_name) as f:
+        return json.load(f)["entries"]
+
+
+def array_index(environment=None):
+    """
+    Returns:
+        index - index of this job array element or None outside of job arrays
+    """
+    if environment is None:
+        environment = os.environ
+    for name in array_index_variables:
+        if environment.get(name, "") != "":
+            return int(environment[name])
+    return None
+
+
+def run_entry(
+    entry, execute=True, verify=True, report_file=None, verbose=False, out=None, err=None
+):
+    """
+    Runs and/or verifies one plan entry like run() would have.
+
+    Returns:
+        ierr - 0 if the test passed, 1 otherwise
+    """
+    # run imports the plan
+    from .run import _run, _Test
+
+    if out is None:
+        out = sys.stdout
+    if err is None:
+        err = sys.stderr
+
+    options = SimpleNamespace(
+        work_dir=entry["work_dir"],
+        binary_dir=entry["binary_dir"],
+        launch_agent=entry["launch_agent"],
+        skip_run=not execute,
+        no_verification=not verify,
+        verbose=verbose,
+        report=report_file,
+    )
+
+    def configure(options, input_files, extra_args):
+        return (
+            entry["launcher"],
+            entry["command"],
+            entry["output_prefix"],
+            entry["relative_reference_path"],
+        )
+
+    filters = entry["filters"]
+    if filters is not None:
+        filters = {
+            suffix: [filter_from_dict(d) for d in filters[suffix]] for suffix in filters
+        }
+    performance = entry["performance"]
+    if performance is not None:
+        performance = get_performance_filter(**performance)
+
+    return _run(
+        _Test(
+            options,
+            configure,
+            entry["input_files"],
+            entry["extra_args"],
+            filters,
+            entry["accepted_errors"],
+            entry["timeout"],
+            performance,
+            entry["caller_dir"],
+            out,
+            err,
+        )
+    )
+
+
+def main(args=None):
+    parser = OptionParser(
+        usage="%prog [options] PLAN [INDEX]",
+        description="Runs and verifies one entry of a plan written with --plan.",
+    )
+    parser.add_option(
+        "--execute-only",
+        action="store_true",
+        default=False,
+        help="only run the test, do not verify it [default: %default]",
+    )
+    parser.add_option(
+        "--verify-only",
+        action="store_true",
+        default=False,
+        help="only verify the outputs of an earlier run [default: %default]",
+    )
+    parser.add_option(
+        "--report",
+        action="store",
+        default=None,
+        help="write the result to this JSON file [default: %default]",
+    )
+    parser.add_option(
+        "--verbose",
+        "-v",
+        action="store_true",
+        default=False,
+        help="give more verbose output upon test failure [default: %default]",
+    )
+    (options, args) = parser.parse_args(args=args)
+    if options.execute_only and options.verify_only:
+        parser.error("--execute-only and --verify-only exclude each other")
+    if len(args) == 1:
+        index = array_index()
+        if index is None:
+            parser.error(
+                "no INDEX given and none of {0} set".format(
+                    ", ".join(array_index_variables)
+                )
+            )
+    elif len(args) == 2:
+        index = int(args[1])
+    else:
+        parser.error("expected PLAN [INDEX]")
+
+    entries = read_plan(args[0])
+    if not 0 <= index < len(entries):
+        parser.error("index {0} not in plan of {1} entries".format(index, len(entries)))
+    ierr = run_entry(
+        entries[index],
+        execute=not options.verify_only,
+        verify=not options.execute_only,
+        report_file=options.report,
+        verbose=options.verbose,
+    )
+    write_reports()
+    return ierr
+
+
+def test_array_index():
+    assert array_index({}) is None
+    assert array_index({"SLURM_ARRAY_TASK_ID": "3"}) == 3
+    assert array_index({"PBS_ARRAY_INDEX": "", "PBS_ARRAYID": "7"}) == 7
+
+
+def test_plan(tmpdir, monkeypatch, capsys):
+    from io import StringIO
+    from . import report
+    from .filter_constructor import get_filter
+    from .run import run, _test_setup
+
+    monkeypatch.setattr(report, "results", [])
+    monkeypatch.setattr(sys.modules[__name__], "_plans", {})
+    options, configure = _test_setup(
+        tmpdir, monkeypatch, "import sys\nprint('energy', sys.argv[1])\n"
+    )
+    options.plan = str(tmpdir.join("plan.json"))
+    for x in ["1.0", "2.0"]:
+        tmpdir.ensure_dir("reference").join(x + ".stdout").write("energy 1.0\n")
+    filters = {"stdout": [get_filter(string="energy", abs_tolerance=1.0e-6)]}
+    for x in ["1.0", "2.0"]:
+        assert run(options, configure, [x], filters=filters, timeout=60.0) == 0
+    assert not tmpdir.join("1.0.stdout").check()
+
+    # written once, not after every entry
+    assert not tmpdir.join("plan.json").check()
+    write_plans()
+    assert "with 2 entries\n" in capsys.readouterr().out
+    entries = read_plan(options.plan)
+    assert [e["index"] for e in entries] == [0, 1]
+    assert entries[0]["resolved_command"][1:] == ["code.py", "1.0"]
+    assert entries[0]["outputs"]["stdout"]["reference"] == str(
+        tmpdir.join("reference", "1.0.stdout")
+    )
+    assert entries[0]["timeout"] == 60.0
+
+    out, err = StringIO(), StringIO()
+    assert run_entry(entries[0], verify=False, out=out, err=err) == 0
+    assert tmpdir.join("1.0.stdout").read() == "energy 1.0\n"
+    assert run_entry(entries[0], execute=False, out=out, err=err) == 0
+    assert "passed\n" in out.getvalue()
+
+    report_file = str(tmpdir.join("report.json"))
+    monkeypatch.setattr(report, "results", [])
+    monkeypatch.setenv("SLURM_ARRAY_TASK_ID", "1")
+    assert main(["--report", report_file, options.plan]) == 1
+    assert [r.status for r in report.read_report(report_file)] == ["failed"]
+
+
+def test_merge_plan(tmpdir):
+    file_name = str(tmpdir.join("plan.json"))
+    a = [{"caller_dir": "a", "key": "1"}, {"caller_dir": "a", "key": "2"}]
+    b = [{"caller_dir": "b", "key": "1"}]
+    assert merge_plan(file_name, a) == 2
+    # other scripts are kept, an earlier session of the same one is replaced
+    assert merge_plan(file_name, b) == 3
+    assert merge_plan(file_name, a[:1]) == 2
+    entries = read_plan(file_name)
+    assert [(e["caller_dir"], e["index"]) for e in entries] == [("b", 0), ("a", 1)]
+    assert not tmpdir.join("plan.json.lock").check()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import atexit
+import json
+import os
+import tempfile
+import threading
+from collections import namedtuple
+
+
+# times in seconds, max_rss in bytes, None where the platform cannot tell
+Usage = namedtuple("Usage", ["wall_time", "user_time", "system_time", "max_rss"])
+
+# status is one of "passed", "failed", "crashed", "accepted error",
+# "timeout", "too slow", "not verified", script is the name of the directory
+# of the test script (None in reports of older versions)
+Result = namedtuple(
+    "Result", ["input_files", "extra_args", "status", "usage", "script"], defaults=[None]
+)
+
+# results of all tests run by this process in the order in which they finished
+results = []
+_lock = threading.Lock()
+
+# shard by report file which write_reports() still has to write
+_reports = {}
+
+
+def add_result(result, report_file=None, shard=None):
+    """
+    Records the result of one test. The report file, if one is given, is
+    written by write_reports(), at the latest when the process exits, so
+    that it is not rewritten for every test.
+    """
+    with _lock:
+        results.append(result)
+        if report_file is not None:
+            _reports[report_file] = shard
+
+
+def write_reports():
+    """
+    Writes all results recorded so far to the report files given to
+    add_result().
+    """
+    with _lock:
+        for file_name, shard in _reports.items():
+            write_report(file_name, results, shard)
+        _reports.clear()
+
+
+atexit.register(write_reports)
+
+
+def format_usage(usage):
+    """
+    Returns:
+        text - one line summary of the resources a test used
+    """
+    parts = ["wall %.2f s" % usage.wall_time]
+    if usage.user_time is not None:
+        parts.append("user %.2f s" % usage.user_time)
+        parts.append("sys %.2f s" % usage.system_time)
+    if usage.max_rss is not None:
+        parts.append("max rss %.1f MiB" % (usage.max_rss / 1024.0 / 1024.0))
+    return ", ".join(parts)
+
+
+def result_to_dict(result):
+    return {
+        "input_files": result.input_files,
+        "extra_args": result.extra_args,
+        "status": result.status,
+        "usage": None if result.usage is None else result.usage._asdict(),
+        "script": result.script,
+    }
+
+
+def result_from_dict(d):
+    usage = d["usage"]
+    if usage is not None:
+        usage = Usage(**usage)
+    return Result(d["input_files"], d["extra_args"], d["status"], usage, d.get("script"))
+
+
+def write_report(file_name, results, shard=None):
+    """
+    Writes results as JSON, the file is replaced in one step so that
+    readers never see half of it. The reports of shards say which
+    (index, count) they are.
+    """
+    report = {"results": [result_to_dict(r) for r in results]}
+    if shard is not None:
+        report["shard"] = list(shard)
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        # input files are whatever configure understands, anything which is
+        # not JSON is written as a string
+        json.dump(report, f, indent=2, default=str)
+        f.write("\n")
+    os.replace(tmp_path, file_name)
+
+
+def read_report(file_name):
+    """
+    Returns:
+        results - list of Result
+    """
+    with open(file_name) as f:
+        report = json.load(f)
+    return [result_from_dict(d) for d in report["results"]]
+
+
+def test_report(tmpdir):
+    file_name = str(tmpdir.join("report.json"))
+    first = Result(["a.inp", "b.mol"], None, "passed", Usage(1.5, 1.25, 0.125, 2**20))
+    second = Result(["c.inp"], "--fast", "timeout", Usage(60.0, None, None, None))
+    write_report(file_name, [first, second])
+    assert read_report(file_name) == [first, second]
+
+    assert format_usage(first.usage) == "wall 1.50 s, user 1.25 s, sys 0.12 s, max rss 1.0 MiB"
+    assert format_usage(second.usage) == "wall 60.00 s"
+
+
+def test_write_reports(tmpdir, monkeypatch):
+    from . import report
+
+    monkeypatch.setattr(report, "results", [])
+    monkeypatch.setattr(report, "_reports", {})
+    file_name = str(tmpdir.join("report.json"))
+    first = Result(["a.inp"], None, "passed", None)
+    second = Result(["b.inp"], None, "failed", None)
+    add_result(first, file_name)
+    add_result(second, file_name, shard=(1, 2))
+    assert not os.path.exists(file_name)
+    write_reports()
+    assert read_report(file_name) == [first, second]
+    with open(file_name) as f:
+        assert json.load(f)["shard"] == [1, 2]
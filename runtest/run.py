@@ -2,32 +2,555 @@
 #
 # SPDX-License-Identifier: MPL-2.0
 
+import asyncio
 import os
+import re
 import sys
 import inspect
+import json
 import shlex
+import shutil
+import signal
 import subprocess
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from .exceptions import FailedTestError, BadFilterError, FilterKeywordError
-from .copy import copy_path
-from .check import check
+from .copy import stage_path, unshare, collect_files
+from .check import check, LiveCheck
+from .mapped import default_parallel_threshold
+from .cache import ReferenceCache, RunCache, run_digest
+from .report import Result, Usage, add_result, format_usage, write_reports
+from .performance import check_performance, baseline_name
+from .shard import in_shard, case_key, script_key
+from .history import TimingHistory, history_file, longest_first
+from .slots import CoreSlots, available_cores, cores_needed, pinned, taskset_prefix
+from .plan import plan_entry, add_entry, write_plans
+from .daemon import remote_check
 
 
 def run(
-    options, configure, input_files, extra_args=None, filters=None, accepted_errors=None
+    options,
+    configure,
+    input_files,
+    extra_args=None,
+    filters=None,
+    accepted_errors=None,
+    timeout=None,
+    performance=None,
 ):
-    # here we find out where the test script sits
-    frame = inspect.stack()[-1]
-    module = inspect.getmodule(frame[0])
-    caller_file = module.__file__
-    caller_dir = os.path.dirname(os.path.realpath(caller_file))
+    caller_dir = _caller_dir()
+    _stage(options, caller_dir)
 
+    return _run(
+        _Test(
+            options,
+            configure,
+            input_files,
+            extra_args,
+            filters,
+            accepted_errors,
+            timeout,
+            performance,
+            caller_dir,
+            sys.stdout,
+            sys.stderr,
+        )
+    )
+
+
+async def run_async(
+    options,
+    configure,
+    input_files,
+    extra_args=None,
+    filters=None,
+    accepted_errors=None,
+    timeout=None,
+    performance=None,
+):
+    """
+    Like run() but awaits the test instead of blocking, so that many tests
+    can run at the same time from one event loop. Everything which reads or
+    writes files, e.g. configure, the run cache and the verification, runs
+    in the default executor of the loop. Cancelling the task kills the test,
+    and its process group where there are process groups. Where run() exits
+    the test script (missing launcher, unreadable files, bad filters) the
+    test fails.
+
+    The output of the test is written once it is done. The usage in reports
+    has the wall time only.
+
+    Returns:
+        ierr - like run()
+    """
+    caller_dir = _caller_dir()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _stage, options, caller_dir)
+
+    parts = []
+    try:
+        return await _complete_async(
+            _steps(
+                _Test(
+                    options,
+                    configure,
+                    input_files,
+                    extra_args,
+                    filters,
+                    accepted_errors,
+                    timeout,
+                    performance,
+                    caller_dir,
+                    _Buffer(parts, "stdout"),
+                    _Buffer(parts, "stderr"),
+                )
+            )
+        )
+    except _Abort:
+        # the other tests of the loop go on
+        return 1
+    finally:
+        for stream, text in parts:
+            getattr(sys, stream).write(text)
+
+
+def run_many(
+    options,
+    configure,
+    input_combinations,
+    extra_args=None,
+    filters=None,
+    accepted_errors=None,
+    jobs=None,
+    timeout=None,
+    performance=None,
+    cores=None,
+):
+    """
+    Runs several tests concurrently, each of them like run().
+
+    Input:
+        - input_combinations -- list of input_files, an element can also be
+                                a dictionary of run() keyword arguments
+                                (and cores) which override the arguments
+                                given here
+        - jobs -- number of tests running at the same time, by default
+                  options.jobs (--jobs/-j)
+        - timeout, performance -- like for run()
+        - cores -- cores each test occupies, by default the processes of
+                   the launch agent times OMP_NUM_THREADS
+
+    Returns:
+        - sum of the return values of all runs
+
+    Tests only start while the cores they need are free (--cores, by
+    default all cores of the machine). Each test is verified right after
+    it finishes and what it prints is written out in one piece once it is
+    done.
+    """
+    if jobs is None:
+        jobs = getattr(options, "jobs", 1)
+    jobs = max(1, jobs)
+
+    # threads cannot find the test script on their stack and files are
+    # only copied once for all tests
+    caller_dir = _caller_dir()
+    _stage(options, caller_dir)
+
+    tasks = []
+    for combination in input_combinations:
+        kwargs = dict(
+            input_files=combination,
+            extra_args=extra_args,
+            filters=filters,
+            accepted_errors=accepted_errors,
+            timeout=timeout,
+            performance=performance,
+            cores=cores,
+        )
+        if isinstance(combination, dict):
+            kwargs["input_files"] = None
+            kwargs.update(combination)
+        tasks.append(kwargs)
+
+    # the longest tests start first so that short ones fill the gaps at the end
+    history = _history(options)
+    if history is not None:
+        keys = [
+            _history_key(caller_dir, t["input_files"], t.get("extra_args"))
+            for t in tasks
+        ]
+        tasks = [tasks[i] for i in longest_first(keys, history.estimates())]
+
+    pending = []
+    for kwargs in tasks:
+        needed = cores_needed(options.launch_agent, kwargs.pop("cores"))
+        pending.append((kwargs, needed))
+    slots = CoreSlots(_core_budget(options))
+    pinned = getattr(options, "pin", False)
+
+    ierr = 0
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            # every test which fits is started, in order, smaller tests may
+            # overtake one which has to wait for cores
+            for task in list(pending):
+                if len(running) == jobs:
+                    break
+                kwargs, needed = task
+                cpus = slots.try_acquire(needed)
+                if cpus is None:
+                    continue
+                pending.remove(task)
+                future = pool.submit(
+                    _run_buffered,
+                    options,
+                    configure,
+                    caller_dir,
+                    dict(kwargs, cpus=cpus if pinned else None, history=history),
+                )
+                running[future] = cpus
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                slots.release(running.pop(future))
+                parts, result, error = future.result()
+                for stream, text in parts:
+                    getattr(sys, stream).write(text)
+                if error is not None:
+                    # tests which did not start yet never will
+                    raise error
+                ierr += result
+    write_plans()
+    write_reports()
+    return ierr
+
+
+def _core_budget(options):
+    cpus = available_cores()
+    budget = getattr(options, "cores", None)
+    if budget is not None:
+        cpus = cpus[: max(1, budget)]
+    return cpus
+
+
+class _Buffer:
+    """
+    Keeps what one test writes to stdout and stderr in order.
+    """
+
+    def __init__(self, parts, stream):
+        self.parts = parts
+        self.stream = stream
+
+    def write(self, text):
+        self.parts.append((self.stream, text))
+
+
+def _run_buffered(options, configure, caller_dir, kwargs):
+    parts = []
+    try:
+        result = _run(
+            _Test(
+                options,
+                configure,
+                caller_dir=caller_dir,
+                out=_Buffer(parts, "stdout"),
+                err=_Buffer(parts, "stderr"),
+                **kwargs
+            )
+        )
+    except BaseException as e:
+        # also sys.exit() which is re-raised in the main thread
+        return parts, None, e
+    return parts, result, None
+
+
+def _caller_dir():
+    # here we find out where the test script sits: the innermost frame of
+    # __main__, which is the outermost frame unless the runtest suite runner
+    # runs the script inside of one of its workers
+    frame = inspect.currentframe()
+    while frame is not None:
+        if frame.f_globals.get("__name__") == "__main__" and "__file__" in frame.f_globals:
+            caller_file = frame.f_globals["__file__"]
+            break
+        frame = frame.f_back
+    else:
+        frame = inspect.stack()[-1]
+        caller_file = inspect.getmodule(frame[0]).__file__
+    return os.path.dirname(os.path.realpath(caller_file))
+
+
+# artifacts which are copied back from a scratch directory
+default_scratch_keep = ["*.stdout", "*.stderr", "*.filtered", "*.reference", "*.diff"]
+
+# (caller_dir, work_dir) pairs which were already staged in this session
+_staged = set()
+_stage_lock = threading.Lock()
+
+
+def _stage(options, caller_dir):
     # if the work_dir is different from caller_dir
-    # we copy all files under caller_dir to work_dir
-    if options.work_dir != caller_dir:
-        copy_path(caller_dir, options.work_dir)
+    # we bring work_dir up to date with all files under caller_dir,
+    # once per session and not for every test
+    if options.work_dir == caller_dir or getattr(options, "list_tests", None):
+        return
+    with _stage_lock:
+        if (caller_dir, options.work_dir) in _staged:
+            return
+        staged = stage_path(
+            caller_dir, options.work_dir, getattr(options, "stage_mode", "reflink")
+        )
+        _staged.add((caller_dir, options.work_dir))
+    sys.stdout.write(
+        "staged {0} in {1}: {2} copied, {3} cloned, {4} linked, {5} unchanged\n".format(
+            caller_dir,
+            options.work_dir,
+            len(staged.copied),
+            len(staged.cloned),
+            len(staged.linked),
+            len(staged.unchanged),
+        )
+    )
+    if options.verbose:
+        for name in staged.copied:
+            sys.stdout.write("copied {0}\n".format(name))
+
+
+# everything which one test needs, out and err take what it writes
+_Test = namedtuple(
+    "_Test",
+    [
+        "options",
+        "configure",
+        "input_files",
+        "extra_args",
+        "filters",
+        "accepted_errors",
+        "timeout",
+        "performance",
+        "caller_dir",
+        "out",
+        "err",
+        "cpus",
+        "history",
+    ],
+    defaults=[None, None],
+)
+
+
+def _run(test):
+    try:
+        return _complete(_steps(test))
+    except _Abort as e:
+        sys.exit(e.code)
+
+
+class _Abort(Exception):
+    """
+    Stops a test which cannot be run or verified at all, run() exits the
+    test script with code.
+    """
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+def _complete(steps):
+    """
+    Runs the steps of one test in this thread: the steps yield
+    ("execute", arguments of _execute) and ("call", function) and get the
+    result back, and ("cleanup", function) for what has to happen once the
+    steps are done, also if they fail.
+
+    Returns:
+        ierr - what the steps return
+    """
+    cleanups = []
+    try:
+        result, error = None, None
+        while True:
+            try:
+                if error is None:
+                    kind, argument = steps.send(result)
+                else:
+                    kind, argument = steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            try:
+                if kind == "execute":
+                    result, error = _execute(*argument), None
+                elif kind == "cleanup":
+                    cleanups.append(argument)
+                    result, error = None, None
+                else:
+                    result, error = argument(), None
+            except BaseException as e:
+                result, error = None, e
+    finally:
+        _clean_up(cleanups)
+
+
+async def _complete_async(steps):
+    """
+    Like _complete() but awaits the process and calls functions in the
+    default executor.
+    """
+    loop = asyncio.get_running_loop()
+    cleanups = []
+    try:
+        result, error = None, None
+        while True:
+            try:
+                if error is None:
+                    kind, argument = steps.send(result)
+                else:
+                    kind, argument = steps.throw(error)
+            except StopIteration as e:
+                value = e.value
+                break
+            try:
+                if kind == "execute":
+                    result, error = await _execute_async(*argument), None
+                elif kind == "cleanup":
+                    cleanups.append(argument)
+                    result, error = None, None
+                else:
+                    result, error = await loop.run_in_executor(None, argument), None
+            except BaseException as e:
+                # also the cancellation of the task
+                result, error = None, e
+    except GeneratorExit:
+        # the coroutine is closed without finishing, e.g. by a loop which
+        # shuts down, and cannot await anything any more
+        _clean_up(cleanups)
+        raise
+    except BaseException:
+        await loop.run_in_executor(None, _clean_up, cleanups)
+        raise
+    await loop.run_in_executor(None, _clean_up, cleanups)
+    return value
+
+
+def _clean_up(cleanups):
+    for cleanup in reversed(cleanups):
+        cleanup()
+
 
-    launcher, command, output_prefix, relative_reference_path = configure(
-        options, input_files, extra_args
+def _steps(test):
+    """
+    Yields what blocks, see _complete() and _complete_async().
+    """
+    # listing, sharding and planning read and write files
+    if (yield ("call", lambda: _skip(test))):
+        return 0
+
+    options = test.options
+    scratch_dir = getattr(options, "scratch_dir", None)
+    if scratch_dir is None:
+        return (yield from _steps_in(options.work_dir, test))
+
+    # the test runs in its own directory where the staged inputs are linked
+    # and only the artifacts we keep are copied back to the work dir
+    keep = getattr(options, "scratch_keep", default_scratch_keep)
+    run_dir = yield ("call", lambda: _scratch(options.work_dir, scratch_dir, keep))
+    yield ("cleanup", lambda: _unscratch(run_dir, options.work_dir, keep))
+    return (yield from _steps_in(run_dir, test))
+
+
+def _scratch(work_dir, scratch_dir, keep):
+    """
+    Returns:
+        run_dir - new directory below scratch_dir with the staged work dir
+                  linked in
+    """
+    run_dir = tempfile.mkdtemp(prefix="runtest-", dir=scratch_dir)
+    stage_path(work_dir, run_dir, "symlink", exclude=keep)
+    return run_dir
+
+
+def _unscratch(run_dir, work_dir, keep):
+    collect_files(run_dir, work_dir, keep)
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def _skip(test):
+    """
+    Lists or plans the test instead of running it, or leaves it to another
+    shard or selection.
+
+    Returns:
+        skipped - True if the test does not run here
+    """
+    options, input_files, extra_args = test.options, test.input_files, test.extra_args
+    list_file = getattr(options, "list_tests", None)
+    if list_file is not None:
+        _list_test(list_file, input_files, extra_args)
+        return True
+
+    selected = getattr(options, "select", None)
+    if selected is not None and case_key(input_files, extra_args) not in selected:
+        return True
+
+    if not in_shard(options, test.caller_dir, input_files, extra_args):
+        index, count = options.shard
+        test.out.write(
+            "\nskipping test with input files {0} and args {1} (shard {2}/{3})\n".format(
+                input_files, extra_args, index, count
+            )
+        )
+        return True
+
+    plan_file = getattr(options, "plan", None)
+    if plan_file is not None:
+        add_entry(plan_file, plan_entry(test))
+        test.out.write(
+            "\nplanned test with input files {0} and args {1}\n".format(
+                input_files, extra_args
+            )
+        )
+        return True
+
+    return False
+
+
+def _steps_in(run_dir, test):
+    (
+        options,
+        configure,
+        input_files,
+        extra_args,
+        filters,
+        accepted_errors,
+        timeout,
+        performance,
+        caller_dir,
+        out,
+        err,
+        cpus,
+        history,
+    ) = test
+    if timeout is None:
+        timeout = getattr(options, "timeout", None)
+    report_file = getattr(options, "report", None)
+    shard = getattr(options, "shard", None)
+
+    def _finish(status, usage, ierr):
+        result = Result(
+            input_files, extra_args, status, usage, os.path.basename(caller_dir)
+        )
+        add_result(result, report_file, shard)
+        return ierr
+
+    launcher, command, output_prefix, relative_reference_path = yield (
+        "call",
+        lambda: configure(options, input_files, extra_args),
     )
 
     if options.launch_agent is not None:
@@ -35,104 +558,970 @@ def run(
 
     launch_script_path = os.path.normpath(os.path.join(options.binary_dir, launcher))
 
-    if not options.skip_run and not os.path.exists(launch_script_path):
-        sys.stderr.write(
+    if not options.skip_run and not (
+        yield ("call", lambda: os.path.exists(launch_script_path))
+    ):
+        err.write(
             "ERROR: launch script/binary {0} not found in {1}\n".format(
                 launcher, options.binary_dir
             )
         )
-        sys.stderr.write("       have you set the correct --binary-dir (or -b)?\n")
-        sys.stderr.write("       try also --help\n")
-        sys.exit(-1)
+        err.write("       have you set the correct --binary-dir (or -b)?\n")
+        err.write("       try also --help\n")
+        _finish("failed", None, 1)
+        raise _Abort(-1)
 
-    sys.stdout.write(
+    out.write(
         "\nrunning test with input files {0} and args {1}\n".format(
             input_files, extra_args
         )
     )
 
     if options.skip_run:
-        sys.stdout.write("(skipped run with -s|--skip-run)\n")
+        out.write("(skipped run with -s|--skip-run)\n")
+        usage = None
     else:
         if sys.platform != "win32":
             command = shlex.split(command)
 
-        process = subprocess.Popen(
-            command,
-            cwd=options.work_dir,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-        )
-        stdout, stderr = process.communicate()
-
         if output_prefix is None:
-            _output_prefix = os.path.join(options.work_dir, "")
+            _output_prefix = os.path.join(run_dir, "")
         else:
-            _output_prefix = os.path.join(options.work_dir, output_prefix) + "."
-        with open("{0}{1}".format(_output_prefix, "stdout"), "w") as f:
-            try:
-                _s = stdout.decode("UTF-8")
-            except AttributeError:
-                _s = stdout
-            f.write(_s)
+            _output_prefix = os.path.join(run_dir, output_prefix) + "."
+        stdout_name = "{0}{1}".format(_output_prefix, "stdout")
+        stderr_name = "{0}{1}".format(_output_prefix, "stderr")
 
-        with open("{0}{1}".format(_output_prefix, "stderr"), "w") as f:
-            try:
-                _s = stderr.decode("UTF-8")
-            except AttributeError:
-                _s = stderr
-            f.write(_s)
+        # outputs which the filters look at, relative to run_dir
+        output_names = [os.path.basename(stdout_name), os.path.basename(stderr_name)]
+        for suffix in filters or []:
+            if output_prefix is None:
+                output_names.append(suffix)
+            else:
+                output_names.append("{0}.{1}".format(output_prefix, suffix))
+
+        run_cache = _run_cache(options)
+        usage = None
+        if run_cache is not None:
+
+            def _restore():
+                digest = run_digest(
+                    launch_script_path, command, run_dir, [input_files, extra_args]
+                )
+                if getattr(options, "force_run", False):
+                    return digest, None
+                return digest, run_cache.restore(digest, run_dir)
+
+            digest, usage = yield ("call", _restore)
+
+        live_checks = []
+        if getattr(options, "live_verification", False) and filters is not None:
+            for suffix, output in zip(filters, output_names[2:]):
+                live_checks.append(
+                    LiveCheck(
+                        filters[suffix],
+                        os.path.join(run_dir, output),
+                        os.path.join(run_dir, relative_reference_path, output),
+                    )
+                )
+
+        if usage is not None:
+            out.write("(restored from run cache, {0})\n".format(format_usage(usage)))
+            timed_out, returncode = False, 0
+        else:
+            timed_out, returncode, usage = yield (
+                "execute",
+                (command, run_dir, stdout_name, stderr_name, timeout, live_checks, cpus),
+            )
+            out.write("({0})\n".format(format_usage(usage)))
+            # only run_many() reads the history, see there
+            if history is not None:
+                yield (
+                    "call",
+                    lambda: history.record(
+                        _history_key(caller_dir, input_files, extra_args),
+                        usage.wall_time,
+                    ),
+                )
+            failures = [c.failure for c in live_checks if c.failure is not None]
+            if failures:
+                out.write("ERROR: stopped {0} on the first mismatch\n".format(command))
+                err.write(failures[0])
+                return _finish("failed", usage, 1)
+            if run_cache is not None and not timed_out and returncode == 0:
+                yield (
+                    "call",
+                    lambda: run_cache.store(digest, run_dir, output_names, usage),
+                )
+
+        if timed_out:
+            out.write(
+                "ERROR: timeout after {0} s during {1}\n".format(timeout, command)
+            )
+            return _finish("timeout", usage, 1)
 
         found_accepted_errors = False
         if accepted_errors is not None:
-            for error in accepted_errors:
-                if error in stderr:
-                    # we found an error that we expect/accept
-                    sys.stdout.write(
-                        "found error which is expected/accepted: {0}\n".format(error)
-                    )
-                    found_accepted_errors = True
+            found = yield ("call", lambda: _find_in_file(stderr_name, accepted_errors))
+            for error in found:
+                # we found an error that we expect/accept
+                out.write("found error which is expected/accepted: {0}\n".format(error))
+                found_accepted_errors = True
 
-        if process.returncode != 0:
+        if returncode != 0:
             if found_accepted_errors:
-                return 0
+                return _finish("accepted error", usage, 0)
             else:
-                sys.stdout.write("ERROR: crash during {0}\n{1}".format(command, stderr))
-                return 1
+                stderr = yield ("call", lambda: _read_text(stderr_name))
+                out.write("ERROR: crash during {0}\n{1}".format(command, stderr))
+                return _finish("crashed", usage, 1)
 
-    if filters is None:
-        sys.stdout.write("finished (no reference)\n")
-    elif options.no_verification:
-        sys.stdout.write("finished (verification skipped)\n")
-    else:
-        try:
-            for suffix in filters:
-                if output_prefix is None:
-                    output = suffix
-                else:
-                    output = "{0}.{1}".format(output_prefix, suffix)
-                check(
-                    filter_list=filters[suffix],
-                    out_name=os.path.join(options.work_dir, output),
-                    ref_name=os.path.join(
-                        options.work_dir, relative_reference_path, output
+    def _verify():
+        if filters is None:
+            out.write("finished (no reference)\n")
+            status = "not verified"
+        elif options.no_verification:
+            out.write("finished (verification skipped)\n")
+            return _finish("not verified", usage, 0)
+        else:
+            reference_cache = _reference_cache(options)
+            check_server = getattr(options, "check_server", None)
+            try:
+                for suffix in filters:
+                    if output_prefix is None:
+                        output = suffix
+                    else:
+                        output = "{0}.{1}".format(output_prefix, suffix)
+                    if check_server is not None:
+                        remote_check(
+                            check_server,
+                            filters[suffix],
+                            os.path.join(run_dir, output),
+                            os.path.join(run_dir, relative_reference_path, output),
+                            run_dir,
+                            verbose=options.verbose,
+                        )
+                        continue
+                    check(
+                        filter_list=filters[suffix],
+                        out_name=os.path.join(run_dir, output),
+                        ref_name=os.path.join(
+                            run_dir, relative_reference_path, output
+                        ),
+                        log_dir=run_dir,
+                        verbose=options.verbose,
+                        streaming=getattr(options, "streaming", False),
+                        use_mmap=getattr(options, "mmap", False),
+                        processes=getattr(options, "parse_processes", 1),
+                        parallel_threshold=getattr(
+                            options, "parse_threshold", default_parallel_threshold
+                        ),
+                        reference_cache=reference_cache,
+                    )
+                out.write("passed\n")
+            except IOError as e:
+                err.write("ERROR: could not open file {0}\n".format(e.filename))
+                raise _Abort(1)
+            except FailedTestError as e:
+                err.write(str(e))
+                return _finish("failed", usage, 1)
+            except BadFilterError as e:
+                err.write(str(e))
+                raise _Abort(1)
+            except FilterKeywordError as e:
+                err.write(str(e))
+                raise _Abort(1)
+            status = "passed"
+
+        if performance is not None and usage is not None:
+            # baselines are kept with the references and not in the work dir
+            try:
+                check_performance(
+                    performance,
+                    usage,
+                    baseline_name(
+                        os.path.join(caller_dir, relative_reference_path), output_prefix
                     ),
-                    log_dir=options.work_dir,
-                    verbose=options.verbose,
+                    record=getattr(options, "record_baselines", False),
+                    out=out,
                 )
-            sys.stdout.write("passed\n")
-        except IOError as e:
-            sys.stderr.write("ERROR: could not open file {0}\n".format(e.filename))
-            sys.exit(1)
-        except FailedTestError as e:
-            sys.stderr.write(str(e))
-            return 1
-        except BadFilterError as e:
-            sys.stderr.write(str(e))
-            sys.exit(1)
-        except FilterKeywordError as e:
-            sys.stderr.write(str(e))
-            sys.exit(1)
-    return 0
+            except FailedTestError as e:
+                err.write(str(e))
+                return _finish("too slow", usage, 1)
+
+        return _finish(status, usage, 0)
+
+    try:
+        return (yield ("call", _verify))
+    except _Abort:
+        _finish("failed", usage, 1)
+        raise
+
+
+def _execute(
+    command, run_dir, stdout_name, stderr_name, timeout, live_checks, cpus=None
+):
+    """
+    Runs the command, pinned to cpus if given, and stops it early once one
+    of the live checks fails.
+
+    Returns:
+        timed_out - True if the process was killed
+        returncode - exit code of the process
+        usage - report.Usage of the process and its children
+    """
+    # on timeout or mismatch the whole group is killed, including processes
+    # started by the launch agent
+    new_group = (timeout is not None or live_checks != []) and _has_process_groups
+
+    # the output goes straight into the files and is never held in memory,
+    # outputs which were staged as hard links are replaced and not
+    # written through
+    unshare(stdout_name)
+    unshare(stderr_name)
+    with open(stdout_name, "wb") as stdout, open(stderr_name, "wb") as stderr:
+        # this thread is pinned while it starts the launcher so that the
+        # launcher and all it starts inherit the affinity from the start
+        with pinned(cpus):
+            process = subprocess.Popen(
+                command,
+                cwd=run_dir,
+                stdin=subprocess.DEVNULL,
+                stdout=stdout,
+                stderr=stderr,
+                start_new_session=new_group,
+            )
+        watch = None
+        if live_checks:
+            watch = lambda: any(c.poll() for c in live_checks)
+        timed_out, usage = _wait(process, timeout, new_group, watch=watch)
+    return timed_out, process.returncode, usage
+
+
+async def _execute_async(
+    command,
+    run_dir,
+    stdout_name,
+    stderr_name,
+    timeout,
+    live_checks,
+    cpus=None,
+    grace_period=5.0,
+    interval=1.0,
+):
+    """
+    Like _execute() but awaits the process, which is also killed when the
+    awaiting task is cancelled.
+
+    Returns:
+        timed_out - True if the process was killed
+        returncode - exit code of the process
+        usage - report.Usage with the wall time only, asyncio waits for the
+                process and its resource usage is lost
+    """
+    # a cancelled test can always be killed with everything it started
+    new_group = _has_process_groups
+    if isinstance(command, str):
+        command = shlex.split(command, posix=False)
+    # the thread of the event loop starts other processes meanwhile and
+    # cannot be pinned
+    command = taskset_prefix(cpus) + list(command)
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, unshare, stdout_name)
+    await loop.run_in_executor(None, unshare, stderr_name)
+    with open(stdout_name, "wb") as stdout, open(stderr_name, "wb") as stderr:
+        start = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            cwd=run_dir,
+            stdin=subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=stderr,
+            start_new_session=new_group,
+        )
+        watch = None
+        if live_checks:
+            watch = lambda: any(c.poll() for c in live_checks)
+        timed_out = False
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(
+                        process.wait(), _next_wait(start, timeout, watch, interval)
+                    )
+                    break
+                except asyncio.TimeoutError:
+                    timed_out = _expired(start, timeout)
+                    # the live checks read and parse the output
+                    if timed_out or (
+                        watch is not None and await loop.run_in_executor(None, watch)
+                    ):
+                        await _kill_async(process, new_group, grace_period)
+                        break
+        except BaseException:
+            await _kill_async(process, new_group, 0.0)
+            raise
+    usage = Usage(time.monotonic() - start, None, None, None)
+    return timed_out, process.returncode, usage
+
+
+async def _kill_async(process, new_group, grace_period):
+    # like _kill()
+    kill = os.killpg if new_group else os.kill
+    _signal(kill, process.pid, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), grace_period)
+    except asyncio.TimeoutError:
+        pass
+    if new_group or process.returncode is None:
+        _signal(kill, process.pid, signal.SIGKILL)
+    await process.wait()
+
+
+_has_process_groups = hasattr(os, "killpg")
+
+
+def _wait(process, timeout, new_group, grace_period=5.0, watch=None, interval=1.0):
+    """
+    Waits for the process and kills it, and its process group if it leads
+    one, if it runs longer than timeout seconds (None waits forever).
+    If given, watch() is called every interval seconds while the process
+    runs and the process is killed as soon as it returns True.
+
+    Returns:
+        timed_out - True if the process was killed because of the timeout
+        usage - report.Usage of the process and its children
+    """
+    start = time.monotonic()
+
+    if not hasattr(os, "wait4"):
+        # no resource usage and no process groups on this platform
+        timed_out = False
+        while True:
+            try:
+                process.wait(_next_wait(start, timeout, watch, interval))
+                break
+            except subprocess.TimeoutExpired:
+                timed_out = _expired(start, timeout)
+                if timed_out or (watch is not None and watch()):
+                    process.kill()
+                    process.wait()
+                    break
+        return timed_out, Usage(time.monotonic() - start, None, None, None)
+
+    # wait4 blocks so it runs in a thread and we wait for the thread
+    status = []
+    waiter = threading.Thread(
+        target=lambda: status.append(os.wait4(process.pid, 0)), daemon=True
+    )
+    waiter.start()
+    timed_out = False
+    try:
+        while True:
+            waiter.join(_next_wait(start, timeout, watch, interval))
+            if not waiter.is_alive():
+                break
+            timed_out = _expired(start, timeout)
+            if timed_out or (watch is not None and watch()):
+                _kill(process, waiter, new_group, grace_period)
+                break
+    except BaseException:
+        # e.g. Ctrl-C, the process group does not see it
+        _kill(process, waiter, new_group, 0.0)
+        raise
+    wall_time = time.monotonic() - start
+
+    _, wait_status, rusage = status[0]
+    # Popen must not wait for the process again
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    return timed_out, Usage(wall_time, rusage.ru_utime, rusage.ru_stime, _max_rss(rusage))
+
+
+def _next_wait(start, timeout, watch, interval):
+    # how long to block before the timeout or watch need to be looked at
+    if timeout is None:
+        return None if watch is None else interval
+    remaining = max(0.0, start + timeout - time.monotonic())
+    return remaining if watch is None else min(interval, remaining)
+
+
+def _expired(start, timeout):
+    return timeout is not None and time.monotonic() - start >= timeout
+
+
+def _kill(process, waiter, new_group, grace_period):
+    # processes get the chance to clean up before they are killed, what is
+    # left of the group after the leader has exited is killed as well
+    if new_group:
+        _signal(os.killpg, process.pid, signal.SIGTERM)
+        waiter.join(grace_period)
+        _signal(os.killpg, process.pid, signal.SIGKILL)
+    else:
+        # not through Popen which would wait for the process as well
+        _signal(os.kill, process.pid, signal.SIGTERM)
+        waiter.join(grace_period)
+        if waiter.is_alive():
+            _signal(os.kill, process.pid, signal.SIGKILL)
+    waiter.join()
+
+
+def _signal(kill, pid, sig):
+    try:
+        kill(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _max_rss(rusage):
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+
+def _read_text(file_name):
+    with open(file_name) as f:
+        return f.read()
+
+
+def _find_in_file(file_name, patterns, chunk_size=1 << 20):
+    """
+    Finds which of the strings occur in a text file. The file is read in
+    chunks and all strings are searched for with one regular expression.
+
+    Returns:
+        found - the patterns which occur, in the order in which they are given
+    """
+    alternatives = sorted(set(p for p in patterns if p != ""), key=len, reverse=True)
+    found = set()
+    if alternatives:
+        # the lookahead finds overlapping matches, the longest one at each
+        # position, shorter ones are then substrings of what was found
+        matcher = re.compile("(?=(%s))" % "|".join(map(re.escape, alternatives)))
+        overlap = len(alternatives[0]) - 1
+        tail = ""
+        with open(file_name) as f:
+            for chunk in iter(lambda: f.read(chunk_size), ""):
+                text = tail + chunk
+                found.update(m.group(1) for m in matcher.finditer(text))
+                tail = text[-overlap:] if overlap > 0 else ""
+    return [p for p in patterns if p == "" or any(p in m for m in found)]
+
+
+def _reference_cache(options):
+    # options which do not come from cli() leave the cache off
+    directory = getattr(options, "reference_cache_dir", None)
+    if directory is None or getattr(options, "no_reference_cache", False):
+        return None
+    max_bytes = getattr(options, "reference_cache_size", 256) * 1024 * 1024
+    return ReferenceCache(directory, max_bytes)
+
+
+def _list_test(file_name, input_files, extra_args):
+    # one JSON object per line, tests of one script may run in threads
+    line = json.dumps(
+        {
+            "key": case_key(input_files, extra_args),
+            "input_files": input_files,
+            "extra_args": extra_args,
+        },
+        default=str,
+    )
+    with _stage_lock:
+        with open(file_name, "a") as f:
+            f.write(line + "\n")
+
+
+# timing histories by file name, compacted when first opened
+_histories = {}
+_histories_lock = threading.Lock()
+
+
+def _history(options):
+    # kept with the caches and not in the work dir, which usually holds the
+    # test sources
+    directory = getattr(options, "reference_cache_dir", None)
+    if directory is None or getattr(options, "no_timing_history", False):
+        return None
+    file_name = history_file(directory)
+    with _histories_lock:
+        if file_name not in _histories:
+            history = TimingHistory(file_name)
+            history.compact()
+            _histories[file_name] = history
+        return _histories[file_name]
+
+
+def _history_key(caller_dir, input_files, extra_args):
+    # scripts of one project often have tests with the same inputs
+    return script_key(os.path.abspath(caller_dir), case_key(input_files, extra_args))
+
+
+def _run_cache(options):
+    # off unless asked for, restored outputs do not include the other files
+    # a run may write
+    directory = getattr(options, "reference_cache_dir", None)
+    if directory is None or not getattr(options, "run_cache", False):
+        return None
+    max_bytes = getattr(options, "run_cache_size", 1024) * 1024 * 1024
+    return RunCache(directory, max_bytes)
+
+
+def _test_setup(tmpdir, monkeypatch, code):
+    from types import SimpleNamespace
+
+    work_dir = str(tmpdir)
+    monkeypatch.setattr(sys.modules[__name__], "_caller_dir", lambda: work_dir)
+    tmpdir.join("code.py").write(code)
+
+    def configure(options, input_files, extra_args):
+        (x,) = input_files
+        command = "{0} code.py {1}".format(sys.executable, x)
+        return os.path.basename(sys.executable), command, str(x), "reference"
+
+    options = SimpleNamespace(
+        work_dir=work_dir,
+        binary_dir=os.path.dirname(sys.executable),
+        launch_agent=None,
+        skip_run=False,
+        no_verification=False,
+        verbose=False,
+        jobs=3,
+    )
+    return options, configure
+
+
+def test_run_many(tmpdir, monkeypatch, capsys):
+    from .filter_constructor import get_filter
+
+    options, configure = _test_setup(
+        tmpdir,
+        monkeypatch,
+        "import sys, time\n"
+        "x = int(sys.argv[1])\n"
+        "time.sleep(0.05 * (x % 2))\n"
+        "print('result', x, x * 0.5)\n",
+    )
+    work_dir = options.work_dir
+    tmpdir.mkdir("reference")
+    for x in range(4):
+        # the reference of the last test is wrong
+        y = x if x < 3 else 7
+        tmpdir.join("reference", "%i.stdout" % x).write("result %i %s\n" % (y, y * 0.5))
+
+    filters = {"stdout": [get_filter(rel_tolerance=1.0e-8)]}
+    ierr = run_many(options, configure, [[x] for x in range(4)], filters=filters)
+    assert ierr == 1
+
+    captured = capsys.readouterr()
+    blocks = captured.out.split("\nrunning test with input files ")[1:]
+    assert sorted(b.split(" ")[0] for b in blocks) == ["[0]", "[1]", "[2]", "[3]"]
+    for block in blocks:
+        assert block.endswith("passed\n") == (not block.startswith("[3]"))
+    assert "ERROR: test %s failed\n" % os.path.join(work_dir, "3.stdout") in captured.err
+
+    ierr = run_many(
+        options,
+        configure,
+        [[0], dict(input_files=[3], filters=None)],
+        filters=filters,
+        jobs=1,
+    )
+    assert ierr == 0
+
+
+def test_run_accepted_errors(tmpdir, monkeypatch, capsys):
+    options, configure = _test_setup(
+        tmpdir,
+        monkeypatch,
+        "import sys\n"
+        "sys.stdout.write('x' * 100000)\n"
+        "sys.stderr.write('line\\r\\nMPI_ABORT was invoked\\n')\n"
+        "sys.exit(int(sys.argv[1]))\n",
+    )
+
+    assert run(options, configure, [0], accepted_errors=["MPI_ABORT"]) == 0
+    assert tmpdir.join("0.stdout").read() == "x" * 100000
+
+    assert run(options, configure, [1], accepted_errors=["MPI_ABORT", "nope"]) == 0
+    captured = capsys.readouterr()
+    assert "found error which is expected/accepted: MPI_ABORT\n" in captured.out
+    assert "nope" not in captured.out
+
+    assert run(options, configure, [1], accepted_errors=["nope"]) == 1
+    assert "line\nMPI_ABORT was invoked\n" in capsys.readouterr().out
+
+
+def test_find_in_file(tmpdir):
+    file_name = str(tmpdir.join("stderr"))
+    with open(file_name, "w") as f:
+        f.write("abcdef\n" * 3 + "segmentation fault\n")
+
+    patterns = ["fault", "segmentation fault", "cde", "ab", "bc", "x", "", "ab"]
+    for chunk_size in [1, 2, 5, 1 << 20]:
+        assert _find_in_file(file_name, patterns, chunk_size) == [
+            "fault",
+            "segmentation fault",
+            "cde",
+            "ab",
+            "bc",
+            "",
+            "ab",
+        ]
+    assert _find_in_file(file_name, []) == []
+
+
+def test_run_timeout(tmpdir, monkeypatch, capsys):
+    import pytest
+    from . import report
+
+    if not _has_process_groups:
+        pytest.skip("needs process groups")
+
+    options, configure = _test_setup(
+        tmpdir,
+        monkeypatch,
+        "import subprocess, sys, time\n"
+        "child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])\n"
+        "open('child.pid', 'w').write(str(child.pid))\n"
+        "time.sleep(float(sys.argv[1]))\n",
+    )
+    options.report = str(tmpdir.join("report.json"))
+    monkeypatch.setattr(report, "results", [])
+
+    start = time.monotonic()
+    assert run(options, configure, [60], timeout=0.5) == 1
+    assert time.monotonic() - start < 30
+    assert "ERROR: timeout after 0.5 s" in capsys.readouterr().out
+
+    # the child of the test was killed together with it
+    child_pid = int(tmpdir.join("child.pid").read())
+    for _ in range(100):
+        try:
+            os.kill(child_pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.05)
+    else:
+        raise AssertionError("child process survived the timeout")
+
+    assert run(options, configure, [0], timeout=30) == 0
+    report.write_reports()
+    (timed_out, finished) = report.read_report(options.report)
+    assert timed_out.status == "timeout"
+    assert timed_out.usage.wall_time >= 0.5
+    assert finished.status == "not verified"
+    assert finished.usage.user_time >= 0.0
+    assert finished.usage.max_rss > 0
+
+
+def test_run_async(tmpdir, monkeypatch, capsys):
+    import pytest
+    from .filter_constructor import get_filter
+
+    options, configure = _test_setup(
+        tmpdir,
+        monkeypatch,
+        "import os, sys, time\n"
+        "open('%s.pid' % sys.argv[1], 'w').write(str(os.getpid()))\n"
+        "time.sleep(float(sys.argv[1]))\n"
+        "print('slept', sys.argv[1])\n",
+    )
+    filters = {"stdout": [get_filter(string="slept", abs_tolerance=0.1)]}
+    reference = tmpdir.mkdir("reference")
+    for x in ["1.0", "1.5"]:
+        reference.join(x + ".stdout").write("slept 1.0\n")
+
+    async def main():
+        return await asyncio.gather(
+            run_async(options, configure, ["1.0"], filters=filters),
+            run_async(options, configure, ["1.5"], filters=filters),
+            run_async(options, configure, ["60"], timeout=0.5),
+        )
+
+    start = time.monotonic()
+    assert asyncio.run(main()) == [0, 1, 1]
+    assert time.monotonic() - start < 30
+    captured = capsys.readouterr()
+    assert "ERROR: timeout after 0.5 s" in captured.out
+    assert "ERROR: test {0} failed".format(tmpdir.join("1.5.stdout")) in captured.err
+
+    async def cancel():
+        task = asyncio.ensure_future(run_async(options, configure, ["30"]))
+        pid_file = tmpdir.join("30.pid")
+        while not (pid_file.check() and pid_file.read()):
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(tmpdir.join("30.pid").read()), 0)
+
+
+def test_run_async_off_loop(tmpdir, monkeypatch, capsys):
+    from . import report
+    from .filter_constructor import get_filter
+
+    options, configure = _test_setup(tmpdir, monkeypatch, "print('energy 1.0')\n")
+    monkeypatch.setattr(report, "results", [])
+
+    def slow_configure(options, input_files, extra_args):
+        time.sleep(1.0)
+        return configure(options, input_files, extra_args)
+
+    # there is no reference, the verification cannot open it
+    filters = {"stdout": [get_filter(string="energy", abs_tolerance=1.0e-6)]}
+    gaps = []
+
+    async def main():
+        test = asyncio.ensure_future(
+            run_async(options, slow_configure, ["1.0"], filters=filters)
+        )
+        last = time.monotonic()
+        while not test.done():
+            await asyncio.sleep(0.05)
+            gaps.append(time.monotonic() - last)
+            last = time.monotonic()
+        return await test
+
+    assert asyncio.run(main()) == 1
+    # configure did not block the loop
+    assert max(gaps) < 0.5
+    assert "ERROR: could not open file" in capsys.readouterr().err
+    assert [r.status for r in report.results] == ["failed"]
+
+
+def test_complete_cleanup():
+    cleaned = []
+
+    def steps():
+        yield ("cleanup", lambda: cleaned.append("scratch"))
+        yield ("call", lambda: time.sleep(0.1))
+        return 0
+
+    assert _complete(steps()) == 0
+    assert cleaned == ["scratch"]
+
+    async def abandon():
+        # started and then closed like by a loop which shuts down
+        coroutine = _complete_async(steps())
+        coroutine.send(None)
+        coroutine.close()
+
+    asyncio.run(abandon())
+    assert cleaned == ["scratch", "scratch"]
+
+
+def test_run_performance(tmpdir, monkeypatch, capsys):
+    from .performance import get_performance_filter
+
+    options, configure = _test_setup(
+        tmpdir,
+        monkeypatch,
+        "import sys, time\ntime.sleep(float(sys.argv[1]))\n",
+    )
+    tmpdir.mkdir("reference")
+    p = get_performance_filter(abs_tolerance=0.2, metrics=["wall_time"])
+
+    options.record_baselines = True
+    assert run(options, configure, ["0.0"], performance=p) == 0
+    assert tmpdir.join("reference", "0.0.baseline.json").check()
+
+    # the baseline of one test is compared with a slower run of another
+    os.rename(
+        str(tmpdir.join("reference", "0.0.baseline.json")),
+        str(tmpdir.join("reference", "0.5.baseline.json")),
+    )
+    options.record_baselines = False
+    capsys.readouterr()
+    assert run(options, configure, ["0.5"], performance=p) == 1
+    assert "ERROR   wall_time:" in capsys.readouterr().err
+
+
+def test_run_stages_once(tmpdir, monkeypatch, capsys):
+    options, configure = _test_setup(tmpdir, monkeypatch, "print('hello')\n")
+    options.work_dir = str(tmpdir.join("work"))
+    monkeypatch.setattr(sys.modules[__name__], "_staged", set())
+
+    assert run(options, configure, [0]) == 0
+    assert run(options, configure, [1]) == 0
+    captured = capsys.readouterr().out
+    assert captured.count("staged ") == 1
+    assert "1 copied" in captured or "1 cloned" in captured
+    assert tmpdir.join("work", "1.stdout").read() == "hello\n"
+
+
+def test_run_scratch_dir(tmpdir, monkeypatch, capsys):
+    from .filter_constructor import get_filter
+
+    options, configure = _test_setup(
+        tmpdir,
+        monkeypatch,
+        "import os, sys\n"
+        "print('result', sys.argv[1], os.getcwd() != %r)\n" % str(tmpdir),
+    )
+    options.scratch_dir = str(tmpdir.mkdir("scratch"))
+    options.scratch_keep = default_scratch_keep
+    tmpdir.mkdir("reference").join("1.stdout").write("result 1 True\n")
+    # a stale output is not written through
+    tmpdir.join("1.stdout").write("old")
+    os.link(str(tmpdir.join("1.stdout")), str(tmpdir.join("other")))
+
+    filters = {"stdout": [get_filter(rel_tolerance=1.0e-8)]}
+    assert run_many(options, configure, [[1], [1]], filters=filters) == 0
+    assert tmpdir.join("1.stdout").read() == "result 1 True\n"
+    assert tmpdir.join("1.stdout.diff").check()
+    assert tmpdir.join("other").read() == "old"
+    assert tmpdir.join("scratch").listdir() == []
+
+
+def test_run_cache(tmpdir, monkeypatch, capsys):
+    from .filter_constructor import get_filter
+
+    options, configure = _test_setup(
+        tmpdir,
+        monkeypatch,
+        "import sys\n"
+        "open('runs', 'a').write('x')\n"
+        "print('result', open(sys.argv[1]).read())\n",
+    )
+    options.run_cache = True
+    options.reference_cache_dir = str(tmpdir.join("cache"))
+    tmpdir.join("a.inp").write("1.0")
+    tmpdir.mkdir("reference").join("a.inp.stdout").write("result 1.0\n")
+    filters = {"stdout": [get_filter(rel_tolerance=1.0e-8)]}
+
+    assert run(options, configure, ["a.inp"], filters=filters) == 0
+    tmpdir.join("a.inp.stdout").remove()
+    assert run(options, configure, ["a.inp"], filters=filters) == 0
+    assert tmpdir.join("runs").read() == "x"
+    assert "(restored from run cache, wall" in capsys.readouterr().out
+
+    # changed inputs and --force-run run again
+    tmpdir.join("a.inp").write("2.0")
+    assert run(options, configure, ["a.inp"], filters=filters) == 1
+    options.force_run = True
+    tmpdir.join("a.inp").write("1.0")
+    assert run(options, configure, ["a.inp"], filters=filters) == 0
+    assert tmpdir.join("runs").read() == "xxx"
+
+
+def test_run_check_server(tmpdir, monkeypatch, capsys):
+    import pytest
+    import socket
+    from .daemon import CheckServer, request, _test_address
+    from .filter_constructor import get_filter
+
+    if not hasattr(socket, "AF_UNIX"):
+        pytest.skip("no Unix sockets")
+    options, configure = _test_setup(
+        tmpdir, monkeypatch, "import sys\nprint('energy', sys.argv[1])\n"
+    )
+    options.check_server = _test_address()
+    server = CheckServer(options.check_server)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    try:
+        tmpdir.mkdir("reference").join("1.0.stdout").write("energy 1.0\n")
+        tmpdir.join("reference", "2.0.stdout").write("energy 1.0\n")
+        filters = {"stdout": [get_filter(string="energy", abs_tolerance=1.0e-6)]}
+        assert run(options, configure, ["1.0"], filters=filters) == 0
+        assert run(options, configure, ["2.0"], filters=filters) == 1
+        assert "ERROR: test {0} failed\n".format(
+            tmpdir.join("2.0.stdout")
+        ) in capsys.readouterr().err
+    finally:
+        request(options.check_server, {"type": "stop"})
+        thread.join(10.0)
+        shutil.rmtree(os.path.dirname(options.check_server))
+
+
+def test_run_live_verification(tmpdir, monkeypatch, capsys):
+    from .filter_constructor import get_filter
+
+    options, configure = _test_setup(
+        tmpdir,
+        monkeypatch,
+        "import sys, time\n"
+        "print('energy', sys.argv[1], flush=True)\n"
+        "time.sleep(60)\n"
+        "print('done')\n",
+    )
+    options.live_verification = True
+    tmpdir.mkdir("reference").join("2.0.stdout").write("energy 1.0\ndone\n")
+    filters = {"stdout": [get_filter(string="energy", rel_tolerance=1.0e-8, early=True)]}
+
+    start = time.monotonic()
+    assert run(options, configure, ["2.0"], filters=filters) == 1
+    assert time.monotonic() - start < 30.0
+    captured = capsys.readouterr()
+    assert "on the first mismatch\n" in captured.out
+    assert "ERROR: section 1 of" in captured.err
+
+
+def test_run_shard(tmpdir, monkeypatch, capsys):
+    from . import report
+
+    options, configure = _test_setup(tmpdir, monkeypatch, "print('hello')\n")
+    ran = []
+    for index in [1, 2]:
+        monkeypatch.setattr(report, "results", [])
+        options.shard = (index, 2)
+        options.report = str(tmpdir.join("shard-%i.json" % index))
+        assert run_many(options, configure, [[x] for x in range(8)]) == 0
+        ran.append(sorted(r.input_files[0] for r in report.read_report(options.report)))
+    assert sorted(ran[0] + ran[1]) == list(range(8))
+    assert ran[0] != [] and ran[1] != []
+    assert "(shard 2/2)\n" in capsys.readouterr().out
+
+
+def test_run_many_longest_first(tmpdir, monkeypatch, capsys):
+    options, configure = _test_setup(tmpdir, monkeypatch, "print('hello')\n")
+    options.jobs = 1
+    options.reference_cache_dir = str(tmpdir.join("cache"))
+    # run() does not schedule and leaves no history behind
+    assert run(options, configure, [0]) == 0
+    assert not tmpdir.join("cache", "history.sqlite").check()
+    capsys.readouterr()
+
+    history = _history(options)
+    for x, wall_time in [(0, 1.0), (1, 5.0), (3, 10.0)]:
+        history.record(_history_key(str(tmpdir), [x], None), wall_time)
+    # another script with the same inputs does not count
+    history.record(_history_key(str(tmpdir.join("other")), [2], None), 100.0)
+
+    assert run_many(options, configure, [[x] for x in range(4)]) == 0
+    blocks = capsys.readouterr().out.split("\nrunning test with input files ")[1:]
+    # the unknown test is expected to take as long as the median
+    assert [b.split(" ")[0] for b in blocks] == ["[3]", "[1]", "[2]", "[0]"]
+    assert len(history.estimates()) == 5
+
+
+def test_run_many_cores(tmpdir, monkeypatch):
+    options, configure = _test_setup(
+        tmpdir,
+        monkeypatch,
+        "import sys, time\n"
+        "start = time.time()\n"
+        "time.sleep(0.3)\n"
+        "open('log', 'a').write('%s %f %f\\n' % (sys.argv[1], start, time.time()))\n",
+    )
+    monkeypatch.setattr(sys.modules[__name__], "available_cores", lambda: [0, 1, 2, 3])
+    options.jobs = 4
+    options.no_timing_history = True
+
+    combinations = [{"input_files": [0], "cores": 3}] + [[x] for x in range(1, 4)]
+    assert run_many(options, configure, combinations, cores=1) == 0
+
+    runs = {}
+    for line in tmpdir.join("log").readlines():
+        x, start, end = line.split()
+        runs[int(x)] = (float(start), float(end))
+    needed = {0: 3, 1: 1, 2: 1, 3: 1}
+    for t, _ in runs.values():
+        in_use = sum(needed[x] for x, (start, end) in runs.items() if start <= t < end)
+        assert in_use <= 4
+    # not all small tests fitted next to the large one
+    assert any(start >= min(runs[0][1], runs[1][1]) for start, _ in runs.values())
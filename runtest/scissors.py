@@ -3,6 +3,13 @@
 # SPDX-License-Identifier: MPL-2.0
 
 import re
+from bisect import bisect_right
+from collections import namedtuple, deque
+from itertools import accumulate, islice
+
+_anchors = namedtuple(
+    "_anchors", ["from_string", "from_is_re", "to_string", "to_is_re", "num_lines"]
+)
 
 
 def cut_sections(
@@ -19,39 +26,252 @@ def cut_sections(
     Returns:
         output - list of remaining lines
     """
-    output = []
+    if from_string is None:
+        # we are comparing entire file
+        return text
+
+    anchors = _anchors(from_string, from_is_re, to_string, to_is_re, num_lines)
+    (bounds,) = section_bounds(text, [anchors])
+
+    return join_sections(text, bounds)
+
+
+def section_bounds(text, filter_list):
+    """
+    Finds the sections of all filters in a single pass over the text.
+
+    Returns:
+        bounds - for each filter a list of (first line, last line + 1) pairs
+                 in the order in which cut_sections would emit them
+    """
+    all_lines = range(len(text))
+    plain_hits = _plain_hits(text, plain_anchors(filter_list))
+
+    def _hits(anchor, is_re):
+        if is_re:
+            return _re_hits(text, all_lines, anchor)
+        if anchor is None:
+            # without an end anchor this fails with a TypeError as before
+            return [i for i in all_lines if anchor in text[i]]
+        return plain_hits[anchor]
+
+    return section_bounds_from_hits(filter_list, len(text), _hits)
+
+
+def plain_anchors(filter_list):
+    """
+    Collects the anchors of all filters which are not regular expressions.
+
+    Returns:
+        anchors - set of strings
+    """
+    anchors = set()
+    for f in filter_list:
+        if f.from_string is not None and not f.from_is_re:
+            anchors.add(f.from_string)
+        if f.num_lines == 0 and f.to_string is not None and not f.to_is_re:
+            anchors.add(f.to_string)
+    return anchors
+
+
+def section_bounds_from_hits(filter_list, num_lines, hits):
+    """
+    Pairs anchor hits into sections, hits(anchor, is_re) returns the sorted
+    line numbers on which the anchor is found.
+
+    Returns:
+        bounds - for each filter a list of (first line, last line + 1) pairs
+    """
+    bounds = []
+    for f in filter_list:
+        if f.from_string is None:
+            # we are comparing entire file
+            bounds.append([(0, num_lines)])
+            continue
 
-    for i, _ in enumerate(text):
-        start_line_matches = False
-        if from_is_re:
-            start_line_matches = re.match(r".*{0}".format(from_string), text[i])
+        starts = hits(f.from_string, f.from_is_re)
+
+        if f.num_lines > 0:
+            bounds.append([(i, i + f.num_lines) for i in starts])
+            continue
+
+        if starts == []:
+            ends = []
         else:
-            if from_string is None:
-                # we are comparing entire file
-                return text
-            else:
-                start_line_matches = from_string in text[i]
+            ends = hits(f.to_string, f.to_is_re)
+        bounds.append(_pair(starts, ends))
+
+    return bounds
 
-        if start_line_matches:
-            if num_lines > 0:
-                for n in range(i, i + num_lines):
-                    output.append(text[n])
-            else:
-                for j in range(i, len(text)):
-                    end_line_matches = False
-                    if to_is_re:
-                        end_line_matches = re.match(r".*{0}".format(to_string), text[j])
-                    else:
-                        end_line_matches = to_string in text[j]
-
-                    if end_line_matches:
-                        for n in range(i, j + 1):
-                            output.append(text[n])
-                        break
 
+def anchor_lines(blob, line_ends, anchor):
+    """
+    Finds the lines containing anchor in the joined text blob, line_ends
+    holds the offset one past the end of each line.
+
+    Returns:
+        lines - sorted line numbers, each line at most once
+    """
+    found = []
+    pos = blob.find(anchor)
+    while pos != -1:
+        i = bisect_right(line_ends, pos)
+        if pos + len(anchor) <= line_ends[i]:
+            found.append(i)
+            pos = blob.find(anchor, line_ends[i])
+        else:
+            # the match spans two lines
+            pos = blob.find(anchor, pos + 1)
+    return found
+
+
+def _re_hits(text, lines, anchor):
+    # anchors may appear anywhere in the line
+    search = _matcher(anchor, True)
+    return [i for i in lines if search(text[i])]
+
+
+def _plain_hits(text, anchors):
+    # plain anchors are searched for in the joined text so that the cost
+    # grows with the number of hits and not with the number of lines
+    if not anchors:
+        return {}
+    blob = "".join(text)
+    line_ends = list(accumulate(map(len, text)))
+    hits = {}
+    for anchor in anchors:
+        if anchor == "":
+            hits[anchor] = list(range(len(text)))
+        else:
+            hits[anchor] = anchor_lines(blob, line_ends, anchor)
+    return hits
+
+
+def _pair(starts, ends):
+    # every section ends on the first end anchor at or after its start line,
+    # both lists are sorted so we walk them once in lockstep
+    pairs = []
+    k = 0
+    for i in starts:
+        while k < len(ends) and ends[k] < i:
+            k += 1
+        if k == len(ends):
+            break
+        pairs.append((i, ends[k] + 1))
+    return pairs
+
+
+def join_sections(text, bounds):
+    """
+    Concatenates the sections given by section_bounds.
+
+    Returns:
+        output - list of lines
+    """
+    output = []
+    for start, stop in bounds:
+        if stop > len(text):
+            # same as indexing past the end of the text
+            raise IndexError("list index out of range")
+        output.extend(text[start:stop])
     return output
 
 
+def stream_sections(
+    lines,
+    from_string=None,
+    from_is_re=False,
+    to_string=None,
+    to_is_re=False,
+    num_lines=0,
+    chunk_lines=1000,
+):
+    """
+    Yields the lines which cut_sections would return while reading the lines
+    only once. Only lines of sections which are still open are kept.
+    """
+    if from_string is None:
+        # we are comparing entire file
+        yield from lines
+        return
+
+    cutter = SectionCutter(from_string, from_is_re, to_string, to_is_re, num_lines)
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, chunk_lines))
+        if chunk == []:
+            break
+        for section in cutter.feed(chunk):
+            yield from section
+
+    if cutter.is_open() and num_lines > 0:
+        # same as indexing past the end of the text
+        raise IndexError("list index out of range")
+
+
+class SectionCutter:
+    """
+    Cuts the sections of one filter out of lines which arrive piece by
+    piece. Only lines of sections which are still open are kept.
+    """
+
+    def __init__(
+        self, from_string, from_is_re=False, to_string=None, to_is_re=False, num_lines=0
+    ):
+        self._start_matches = _matcher(from_string, from_is_re)
+        self._num_lines = num_lines
+        if num_lines == 0:
+            self._end_matches = _matcher(to_string, to_is_re)
+        self._buffer = []
+        self._buffer_start = 0
+        self._starts = deque()
+        self._line = 0
+
+    def is_open(self):
+        return len(self._starts) > 0
+
+    def feed(self, lines):
+        """
+        Returns:
+            sections - the sections which lines completed, each a list of
+                       lines, in the order in which cut_sections emits them
+        """
+        sections = []
+        num_lines = self._num_lines
+        starts = self._starts
+        for line in lines:
+            i = self._line
+            self._line += 1
+            if self._start_matches(line):
+                if not starts:
+                    self._buffer = []
+                    self._buffer_start = i
+                starts.append(i)
+            if not starts:
+                continue
+            self._buffer.append(line)
+
+            if num_lines > 0:
+                while starts and starts[0] + num_lines - 1 == i:
+                    first = starts.popleft() - self._buffer_start
+                    sections.append(self._buffer[first : first + num_lines])
+                if starts:
+                    del self._buffer[: starts[0] - self._buffer_start]
+                    self._buffer_start = starts[0]
+            elif self._end_matches(line):
+                for start in starts:
+                    sections.append(self._buffer[start - self._buffer_start :])
+                starts.clear()
+                self._buffer = []
+        return sections
+
+
+def _matcher(anchor, is_re):
+    if is_re:
+        return re.compile(anchor).search
+    return lambda line: anchor in line
+
+
 def test_cut_sections():
     text = """
 1.0 2.0 3.0
@@ -183,3 +403,125 @@ last line"""
         "  raboof2",
         "  raboof2",
     ]
+
+
+def test_section_bounds():
+    from .filter_constructor import get_filter
+
+    text = """first line
+1.0 2.0 3.0
+start
+0.1234
+end
+start
+  raboof
+1.2345
+end
+  raboof2
+last line""".splitlines()
+
+    filter_list = [
+        get_filter(from_string="start", to_string="end"),
+        get_filter(from_re="r.*f", to_re="r.*f2"),
+        get_filter(string="start"),
+        get_filter(from_string="1.0", num_lines=2),
+        get_filter(),
+    ]
+
+    bounds = section_bounds(text, filter_list)
+
+    assert bounds == [
+        [(2, 5), (5, 9)],
+        [(6, 10), (9, 10)],
+        [(2, 3), (5, 6)],
+        [(1, 3)],
+        [(0, 11)],
+    ]
+    for f, b in zip(filter_list, bounds):
+        assert join_sections(text, b) == cut_sections(
+            text,
+            from_string=f.from_string,
+            from_is_re=f.from_is_re,
+            to_string=f.to_string,
+            to_is_re=f.to_is_re,
+            num_lines=f.num_lines,
+        )
+
+
+def test_cut_sections_repeated_anchors():
+    text = """start 1
+start 2
+1.0
+end
+start 3
+2.0
+end
+start 4"""
+
+    res = cut_sections(
+        text=text.splitlines(),
+        from_string="start",
+        to_string="end",
+    )
+
+    assert res == [
+        "start 1",
+        "start 2",
+        "1.0",
+        "end",
+        "start 2",
+        "1.0",
+        "end",
+        "start 3",
+        "2.0",
+        "end",
+    ]
+
+
+def test_cut_sections_re_flags():
+    text = """first line
+Electronic energy: -1.0
+ELECTRONIC ENERGY: -2.0
+last line"""
+
+    res = cut_sections(
+        text=text.splitlines(),
+        from_string=r"(?i)electronic energy",
+        from_is_re=True,
+        num_lines=1,
+    )
+
+    assert res == ["Electronic energy: -1.0", "ELECTRONIC ENERGY: -2.0"]
+
+
+def test_stream_sections():
+    text = """start 1
+start 2
+1.0
+end
+start 3
+2.0
+end
+start 4
+3.0""".splitlines()
+
+    for kwargs in [
+        dict(from_string="start", to_string="end"),
+        dict(from_string="start", num_lines=2),
+        dict(from_string="t [0-9]", from_is_re=True, to_string="^e", to_is_re=True),
+        dict(),
+    ]:
+        assert list(stream_sections(iter(text), **kwargs)) == cut_sections(
+            text, **kwargs
+        )
+
+
+def test_section_cutter():
+    cutter = SectionCutter("start", to_string="end")
+    assert cutter.feed(["x\n", "start 1\n", "1.0\n"]) == []
+    assert cutter.is_open()
+    assert cutter.feed(["end\n", "start 2\n"]) == [["start 1\n", "1.0\n", "end\n"]]
+    assert cutter.feed(["end\n"]) == [["start 2\n", "end\n"]]
+    assert not cutter.is_open()
+    # consumed lines are not kept
+    assert cutter._buffer == []
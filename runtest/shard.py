@@ -0,0 +1,268 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Splits tests across several runtest processes (e.g. batch nodes) and
+merges their partial reports.
+
+Usage: python -m runtest.shard [--report MERGED] PARTIAL [PARTIAL ...]
+"""
+
+import hashlib
+import json
+import os
+import sys
+from optparse import OptionParser
+from .report import read_report, write_report, format_usage
+
+
+# statuses which make the merged run fail
+failed_statuses = ["failed", "crashed", "timeout", "too slow"]
+
+# assignments by recorded durations, computed once per process
+_assignments = {}
+
+
+def parse_shard(text):
+    """
+    Returns:
+        shard - (index, count) from "INDEX/COUNT", index counts from 1
+
+    Raises:
+        - ValueError
+    """
+    index, _, count = text.partition("/")
+    index, count = int(index), int(count)
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError("shard {0} is not between 1/{1} and {1}/{1}".format(text, count))
+    return index, count
+
+
+def case_key(input_files, extra_args):
+    """
+    Returns:
+        key - identifies a test in reports across processes and machines
+    """
+    # the round trip makes tuples and lists compare equal
+    return json.dumps(
+        json.loads(json.dumps([input_files, extra_args], default=str)), sort_keys=True
+    )
+
+
+def script_key(name, key):
+    """
+    Returns:
+        key - identifies a test of the test script in directory name, tests
+              of different scripts may have the same case_key
+    """
+    return name + "\0" + key
+
+
+def read_durations(file_name):
+    """
+    Returns:
+        durations - wall time by script_key, from a (merged) report
+    """
+    durations = {}
+    for result in read_report(file_name):
+        if result.usage is not None:
+            key = case_key(result.input_files, result.extra_args)
+            durations[script_key(result.script or "", key)] = result.usage.wall_time
+    return durations
+
+
+def assign_by_durations(durations, count):
+    """
+    Gives the longest tests out first, each to the shard with the least
+    work so far. All processes which read the same durations compute the
+    same assignment.
+
+    Returns:
+        assignment - shard index by script_key
+    """
+    loads = [0.0] * count
+    assignment = {}
+    for key, duration in sorted(durations.items(), key=lambda d: (-d[1], d[0])):
+        k = loads.index(min(loads))
+        loads[k] += duration
+        assignment[key] = k + 1
+    return assignment
+
+
+def shard_of(key, count, name="", assignment=None):
+    """
+    Returns:
+        index - shard which runs the test, from the assignment if it knows
+                the test and from a hash of name and key otherwise
+    """
+    key = script_key(name, key)
+    if assignment is not None and key in assignment:
+        return assignment[key]
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return int(digest, 16) % count + 1
+
+
+def in_shard(options, caller_dir, input_files, extra_args):
+    """
+    Returns:
+        selected - True if the shard in options (if any) runs the test
+    """
+    shard = getattr(options, "shard", None)
+    if shard is None:
+        return True
+    index, count = shard
+    assignment = None
+    durations_file = getattr(options, "shard_durations", None)
+    if durations_file is not None:
+        if (durations_file, count) not in _assignments:
+            _assignments[(durations_file, count)] = assign_by_durations(
+                read_durations(durations_file), count
+            )
+        assignment = _assignments[(durations_file, count)]
+    # the name of the test directory and not its path which may differ
+    # between machines
+    key = case_key(input_files, extra_args)
+    return shard_of(key, count, os.path.basename(caller_dir), assignment) == index
+
+
+def merge(file_names, out=None):
+    """
+    Combines partial reports and writes a summary.
+
+    Returns:
+        results - all results
+        ierr - 0 if all tests passed and no shard is missing, 1 otherwise
+    """
+    if out is None:
+        out = sys.stdout
+    results = []
+    shards = set()
+    count = None
+    for file_name in file_names:
+        with open(file_name) as f:
+            report = json.load(f)
+        if report.get("shard") is not None:
+            index, count = report["shard"]
+            shards.add(index)
+        results.extend(read_report(file_name))
+
+    ierr = 0
+    statuses = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+        if result.status in failed_statuses:
+            ierr = 1
+            usage = "" if result.usage is None else " ({0})".format(
+                format_usage(result.usage)
+            )
+            out.write(
+                "{0}: input files {1} and args {2}{3}\n".format(
+                    result.status, result.input_files, result.extra_args, usage
+                )
+            )
+
+    out.write(
+        "{0} tests: {1}\n".format(
+            len(results),
+            ", ".join(
+                "{0} {1}".format(n, status) for status, n in sorted(statuses.items())
+            ),
+        )
+    )
+    if count is not None:
+        missing = sorted(set(range(1, count + 1)) - shards)
+        if missing:
+            ierr = 1
+            out.write(
+                "ERROR: no report of shard(s) {0} of {1}\n".format(
+                    ", ".join(map(str, missing)), count
+                )
+            )
+    return results, ierr
+
+
+def main(args=None):
+    parser = OptionParser(
+        usage="%prog [--report MERGED] PARTIAL [PARTIAL ...]",
+        description="Merges the reports written by runtest with --shard.",
+    )
+    parser.add_option(
+        "--report",
+        action="store",
+        default=None,
+        help="write all results to this JSON file [default: %default]",
+    )
+    (options, file_names) = parser.parse_args(args=args)
+    if file_names == []:
+        parser.error("no reports given")
+    results, ierr = merge(file_names)
+    if options.report is not None:
+        write_report(options.report, results)
+    return ierr
+
+
+def test_parse_shard():
+    import pytest
+
+    assert parse_shard("2/4") == (2, 4)
+    for text in ["0/4", "5/4", "1/0", "x/2", "1"]:
+        with pytest.raises(ValueError):
+            parse_shard(text)
+
+
+def test_shard_of():
+    keys = [case_key(["%i.inp" % i, "x.mol"], None) for i in range(100)]
+    shards = [shard_of(key, 3, "test_dir") for key in keys]
+    assert shards == [shard_of(key, 3, "test_dir") for key in keys]
+    assert set(shards) == {1, 2, 3}
+    assert case_key(("a.inp", "x.mol"), None) == case_key(["a.inp", "x.mol"], None)
+
+    durations = {
+        script_key("t", k): d for k, d in [("a", 10.0), ("b", 6.0), ("c", 5.0), ("d", 1.0)]
+    }
+    assignment = assign_by_durations(durations, 2)
+    assert [assignment[script_key("t", k)] for k in "abcd"] == [1, 2, 2, 1]
+    assert shard_of("c", 2, "t", assignment) == 2
+
+
+def test_merge(tmpdir):
+    from io import StringIO
+    from .report import Result, Usage
+
+    first = Result(["a.inp"], None, "passed", Usage(1.0, None, None, None), "dir_a")
+    second = Result(["b.inp"], None, "failed", Usage(2.0, None, None, None))
+    write_report(str(tmpdir.join("1.json")), [first], shard=(1, 3))
+    write_report(str(tmpdir.join("2.json")), [second], shard=(2, 3))
+
+    out = StringIO()
+    results, ierr = merge([str(tmpdir.join("1.json"))], out)
+    assert (results, ierr) == ([first], 1)
+    assert "1 tests: 1 passed\n" in out.getvalue()
+    assert "ERROR: no report of shard(s) 2, 3 of 3\n" in out.getvalue()
+
+    write_report(str(tmpdir.join("3.json")), [], shard=(3, 3))
+    out = StringIO()
+    names = [str(tmpdir.join("%i.json" % i)) for i in [1, 2, 3]]
+    results, ierr = merge(names, out)
+    assert (results, ierr) == ([first, second], 1)
+    assert out.getvalue() == (
+        "failed: input files ['b.inp'] and args None (wall 2.00 s)\n"
+        "2 tests: 1 failed, 1 passed\n"
+    )
+
+    assert main(["--report", str(tmpdir.join("all.json"))] + names[:1] + names[2:]) == 1
+    key = case_key(["a.inp"], None)
+    assert read_durations(str(tmpdir.join("all.json"))) == {script_key("dir_a", key): 1.0}
+
+    # the same inputs in another test script are another test
+    other = first._replace(usage=Usage(5.0, None, None, None), script="dir_b")
+    write_report(str(tmpdir.join("both.json")), [first, other])
+    assert read_durations(str(tmpdir.join("both.json"))) == {
+        script_key("dir_a", key): 1.0,
+        script_key("dir_b", key): 5.0,
+    }
+
+
+if __name__ == "__main__":
+    sys.exit(main())
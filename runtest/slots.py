@@ -0,0 +1,189 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import os
+import shlex
+import shutil
+import threading
+from contextlib import contextmanager
+
+
+# options which give the number of processes of common MPI launchers
+_rank_options = ["-np", "-n", "--np", "--ntasks"]
+
+
+def ranks_from_launch_agent(launch_agent):
+    """
+    Returns:
+        ranks - number of processes the launch agent starts, 1 if it does
+                not say (e.g. "valgrind")
+    """
+    if launch_agent is None:
+        return 1
+    words = shlex.split(launch_agent)
+    for i, word in enumerate(words):
+        name, equals, value = word.partition("=")
+        if name not in _rank_options:
+            continue
+        if not equals:
+            if i + 1 == len(words):
+                continue
+            value = words[i + 1]
+        try:
+            return max(1, int(value))
+        except ValueError:
+            continue
+    return 1
+
+
+def threads_from_environment(environment=None):
+    """
+    Returns:
+        threads - threads per process from OMP_NUM_THREADS, 1 if unset
+    """
+    if environment is None:
+        environment = os.environ
+    # nested parallelism is given as a list, the outer level counts
+    value = environment.get("OMP_NUM_THREADS", "").split(",")[0]
+    try:
+        return max(1, int(value))
+    except ValueError:
+        return 1
+
+
+def cores_needed(launch_agent, cores=None, environment=None):
+    """
+    Returns:
+        cores - cores one test occupies, as declared or else processes of
+                the launch agent times threads per process
+    """
+    if cores is not None:
+        return cores
+    return ranks_from_launch_agent(launch_agent) * threads_from_environment(
+        environment
+    )
+
+
+def available_cores():
+    """
+    Returns:
+        cpus - sorted ids of the CPUs this process may run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class CoreSlots:
+    """
+    Hands out disjoint sets of CPUs. A test which needs more cores than
+    there are gets all of them and runs alone.
+    """
+
+    def __init__(self, cpus):
+        self.cpus = list(cpus)
+        self._free = list(cpus)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, cores):
+        """
+        Returns:
+            cpus - the acquired CPUs or None if not enough are free
+        """
+        cores = min(max(1, cores), len(self.cpus))
+        with self._lock:
+            if len(self._free) < cores:
+                return None
+            # neighbouring CPUs tend to share caches
+            cpus = self._free[:cores]
+            self._free = self._free[cores:]
+            return cpus
+
+    def release(self, cpus):
+        with self._lock:
+            self._free = sorted(self._free + list(cpus))
+
+
+@contextmanager
+def pinned(cpus):
+    """
+    Restricts the calling thread to cpus while the block runs, processes
+    started in the block (and everything they start, e.g. MPI ranks)
+    inherit the affinity. Without cpus or where the platform cannot do it
+    nothing changes.
+    """
+    if cpus is None or not hasattr(os, "sched_setaffinity"):
+        yield
+        return
+    # 0 is the calling thread and not the whole process
+    previous = os.sched_getaffinity(0)
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError:
+        yield
+        return
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+def taskset_prefix(cpus):
+    """
+    Returns:
+        prefix - command words which run a command on cpus only, [] if cpus
+                 is None or there is no taskset
+    """
+    if cpus is None or shutil.which("taskset") is None:
+        return []
+    return ["taskset", "-c", ",".join(str(cpu) for cpu in cpus)]
+
+
+def test_cores_needed():
+    assert ranks_from_launch_agent(None) == 1
+    assert ranks_from_launch_agent("mpirun -np 8") == 8
+    assert ranks_from_launch_agent("mpiexec -n 4 --bind-to core") == 4
+    assert ranks_from_launch_agent("srun --ntasks=6") == 6
+    assert ranks_from_launch_agent("valgrind --leak-check=yes") == 1
+    assert ranks_from_launch_agent("mpirun -np") == 1
+
+    assert threads_from_environment({}) == 1
+    assert threads_from_environment({"OMP_NUM_THREADS": "4,2"}) == 4
+    assert threads_from_environment({"OMP_NUM_THREADS": "many"}) == 1
+
+    assert cores_needed("mpirun -np 2", environment={"OMP_NUM_THREADS": "3"}) == 6
+    assert cores_needed("mpirun -np 2", cores=1) == 1
+
+
+def test_core_slots():
+    slots = CoreSlots([0, 1, 2, 3])
+    first = slots.try_acquire(3)
+    assert first == [0, 1, 2]
+    assert slots.try_acquire(2) is None
+    assert slots.try_acquire(1) == [3]
+    slots.release(first)
+    # more than there are means all of them
+    assert slots.try_acquire(8) is None
+    assert slots.try_acquire(3) == [0, 1, 2]
+
+
+def test_pinned():
+    import subprocess
+    import sys
+
+    command = [sys.executable, "-c", "import os; print(sorted(os.sched_getaffinity(0)))"]
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    before = os.sched_getaffinity(0)
+    cpu = available_cores()[0]
+    with pinned([cpu]):
+        output = subprocess.check_output(command)
+    assert output.decode().strip() == str([cpu])
+    assert os.sched_getaffinity(0) == before
+
+    prefix = taskset_prefix([cpu])
+    if prefix:
+        output = subprocess.check_output(prefix + command)
+        assert output.decode().strip() == str([cpu])
+    assert taskset_prefix(None) == []
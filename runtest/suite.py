@@ -0,0 +1,456 @@
+# SPDX-FileCopyrightText: 2023 Radovan Bast <radovan.bast@uit.no>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+"""
+Finds the test scripts below one or more directories, runs them in a pool
+of worker processes and summarizes the results.
+
+Usage: runtest [-j JOBS] [--script-args ARGS] [--report FILE] [PATH ...]
+
+Python test scripts run inside of the workers, one after the other, so
+that the interpreter and the modules it imported (runtest, numpy, ...)
+are reused. Other scripts, and all scripts with --isolated, run in their
+own process.
+"""
+
+import importlib
+import io
+import os
+import runpy
+import shlex
+import subprocess
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+from fnmatch import fnmatch
+from optparse import OptionParser
+from . import cache, plan, report, shard
+from .history import TimingHistory, history_file, longest_first
+from .report import result_from_dict, result_to_dict, write_report
+from .run import _histories, _histories_lock, _stage_lock, _staged
+from .shard import failed_statuses
+
+
+default_patterns = ["test", "test.py"]
+
+
+def discover(paths, patterns=None):
+    """
+    Returns:
+        scripts - sorted absolute paths of the files below paths whose name
+                  matches one of the patterns and which use runtest, paths
+                  which are files are taken as they are
+    """
+    if patterns is None:
+        patterns = default_patterns
+    scripts = set()
+    for path in paths:
+        if os.path.isfile(path):
+            scripts.add(os.path.abspath(path))
+            continue
+        for directory, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not d.startswith(".") and d != "__pycache__"]
+            for f in files:
+                file_name = os.path.abspath(os.path.join(directory, f))
+                if any(fnmatch(f, p) for p in patterns) and _uses_runtest(file_name):
+                    scripts.add(file_name)
+    return sorted(scripts)
+
+
+def _uses_runtest(file_name):
+    try:
+        with open(file_name, "rb") as f:
+            return b"runtest" in f.read()
+    except OSError:
+        return False
+
+
+def _is_python(file_name):
+    if file_name.endswith(".py"):
+        return True
+    with open(file_name, "rb") as f:
+        first_line = f.readline()
+    return first_line.startswith(b"#!") and b"python" in first_line
+
+
+def run_script(script, args=None, isolated=False):
+    """
+    Runs one test script, in this process if it is a Python script and
+    isolated is False.
+
+    Returns:
+        outcome - dictionary with the script, its returncode, wall_time and
+                  output and the results of its tests as far as known
+    """
+    if args is None:
+        args = []
+    start = time.monotonic()
+    if isolated or not _is_python(script):
+        command = [script] + args
+        if _is_python(script):
+            command = [sys.executable] + command
+        process = subprocess.run(
+            command,
+            cwd=os.path.dirname(script),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        returncode = process.returncode
+        output = process.stdout.decode("utf-8", errors="replace")
+        results = []
+    else:
+        returncode, output, results = _run_in_process(script, args)
+    return {
+        "script": script,
+        "returncode": returncode,
+        "wall_time": time.monotonic() - start,
+        "output": output,
+        "results": [result_to_dict(r) for r in results],
+    }
+
+
+def _run_in_process(script, args):
+    directory = os.path.dirname(script)
+    saved_argv = sys.argv
+    saved_path = list(sys.path)
+    saved_cwd = os.getcwd()
+    saved_modules = set(sys.modules)
+    _reset_state()
+
+    sys.argv = [script] + args
+    sys.path.insert(0, directory)
+    os.chdir(directory)
+    output = io.StringIO()
+    returncode = 0
+    try:
+        with redirect_stdout(output), redirect_stderr(output):
+            try:
+                runpy.run_path(script, run_name="__main__")
+            except SystemExit as e:
+                returncode = _exit_code(e.code)
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+            try:
+                # the --report and --plan of the script, before the next
+                # script runs
+                report.write_reports()
+                plan.write_plans()
+            except OSError:
+                traceback.print_exc()
+                returncode = 1
+    finally:
+        # modules which the script imported from its own directories, e.g.
+        # runtest_config, can differ from script to script
+        local_dirs = [os.path.abspath(p) for p in sys.path if p not in saved_path]
+        for name in set(sys.modules) - saved_modules:
+            module_file = getattr(sys.modules[name], "__file__", None)
+            if module_file is not None and any(
+                os.path.abspath(module_file).startswith(d + os.sep) for d in local_dirs
+            ):
+                del sys.modules[name]
+        importlib.invalidate_caches()
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+        os.chdir(saved_cwd)
+    with report._lock:
+        results = list(report.results)
+    return returncode, output.getvalue(), results
+
+
+def _reset_state():
+    """
+    Forgets what an earlier script left in the modules of runtest in this
+    worker: its results, reports and plans (which were written), the work
+    dirs it staged, its timing histories, shard assignments and file
+    digests. They could belong to a script with the same work dir but
+    other options.
+    """
+    with report._lock:
+        del report.results[:]
+        report._reports.clear()
+    with plan._lock:
+        plan._plans.clear()
+        plan._unwritten.clear()
+    # runtest.run is the function run() in the package
+    with _stage_lock:
+        _staged.clear()
+    with _histories_lock:
+        _histories.clear()
+    shard._assignments.clear()
+    cache._digests.clear()
+
+
+def _exit_code(code):
+    # like the interpreter does when it exits
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write("{0}\n".format(code))
+    return 1
+
+
+def _preload(modules):
+    for name in modules:
+        importlib.import_module(name)
+
+
+def run_suite(
+    scripts, args=None, jobs=1, isolated=False, preload=None, history=None, out=None
+):
+    """
+    Runs the scripts, the longest first if the history knows them, and
+    writes one line per script as it finishes.
+
+    Returns:
+        outcomes - list of outcomes of run_script in the order of scripts
+    """
+    if out is None:
+        out = sys.stdout
+    order = list(range(len(scripts)))
+    if history is not None:
+        order = longest_first(scripts, history.estimates())
+
+    outcomes = [None] * len(scripts)
+    with ProcessPoolExecutor(
+        max_workers=max(1, jobs), initializer=_preload, initargs=(preload or [],)
+    ) as pool:
+        futures = {
+            pool.submit(run_script, scripts[i], args, isolated): i for i in order
+        }
+        for future in as_completed(futures):
+            outcome = future.result()
+            outcomes[futures[future]] = outcome
+            status = "passed" if outcome["returncode"] == 0 else "FAILED"
+            out.write(
+                "{0:6s} {1} ({2:.2f} s)\n".format(
+                    status, outcome["script"], outcome["wall_time"]
+                )
+            )
+            out.flush()
+            if history is not None:
+                history.record(outcome["script"], outcome["wall_time"])
+    return outcomes
+
+
+def summarize(outcomes, out=None, verbose=False):
+    """
+    Writes the output of the scripts which failed (of all with verbose), the
+    tests which failed and counts.
+
+    Returns:
+        ierr - 0 if all scripts passed, 1 otherwise
+    """
+    if out is None:
+        out = sys.stdout
+    failed = [o for o in outcomes if o["returncode"] != 0]
+    for outcome in outcomes if verbose else failed:
+        out.write(
+            "\n==== {0} (exit code {1}) ====\n{2}".format(
+                outcome["script"], outcome["returncode"], outcome["output"]
+            )
+        )
+
+    statuses = {}
+    for outcome in outcomes:
+        for result in map(result_from_dict, outcome["results"]):
+            statuses[result.status] = statuses.get(result.status, 0) + 1
+            if result.status in failed_statuses:
+                out.write(
+                    "{0}: {1} with input files {2} and args {3}\n".format(
+                        result.status,
+                        outcome["script"],
+                        result.input_files,
+                        result.extra_args,
+                    )
+                )
+
+    out.write(
+        "\n{0} scripts in {1:.2f} s: {2} passed, {3} failed\n".format(
+            len(outcomes),
+            sum(o["wall_time"] for o in outcomes),
+            len(outcomes) - len(failed),
+            len(failed),
+        )
+    )
+    if statuses:
+        out.write(
+            "{0} tests: {1}\n".format(
+                sum(statuses.values()),
+                ", ".join(
+                    "{0} {1}".format(n, status) for status, n in sorted(statuses.items())
+                ),
+            )
+        )
+    return 0 if failed == [] else 1
+
+
+def main(args=None):
+    parser = OptionParser(
+        usage="%prog [options] [PATH ...]",
+        description="Runs all test scripts below PATH (by default the current directory).",
+    )
+    parser.add_option(
+        "--jobs",
+        "-j",
+        action="store",
+        type="int",
+        default=1,
+        help="number of test scripts which run at the same time [default: %default]",
+    )
+    parser.add_option(
+        "--pattern",
+        action="append",
+        default=None,
+        help="file name pattern of test scripts, can be given several times [default: {0}]".format(
+            ", ".join(default_patterns)
+        ),
+    )
+    parser.add_option(
+        "--script-args",
+        action="store",
+        default="",
+        help='arguments for every script (e.g. "-b build") [default: none]',
+    )
+    parser.add_option(
+        "--isolated",
+        action="store_true",
+        default=False,
+        help="run every script in its own interpreter [default: %default]",
+    )
+    parser.add_option(
+        "--preload",
+        action="append",
+        default=None,
+        help="import this module once in every worker, can be given several times [default: none]",
+    )
+    parser.add_option(
+        "--report",
+        action="store",
+        default=None,
+        help="write the results of all tests to this JSON file [default: %default]",
+    )
+    parser.add_option(
+        "--no-timing-history",
+        action="store_true",
+        default=False,
+        help="do not record script run times and do not start the longest scripts first [default: %default]",
+    )
+    parser.add_option(
+        "--verbose",
+        "-v",
+        action="store_true",
+        default=False,
+        help="also show the output of scripts which passed [default: %default]",
+    )
+    (options, paths) = parser.parse_args(args=args)
+    if paths == []:
+        paths = [os.getcwd()]
+
+    scripts = discover(paths, options.pattern)
+    if scripts == []:
+        sys.stderr.write("ERROR: no test scripts found in {0}\n".format(", ".join(paths)))
+        return 1
+
+    history = None
+    if not options.no_timing_history:
+        # scripts are known by their absolute path
+        history = TimingHistory(history_file())
+
+    outcomes = run_suite(
+        scripts,
+        shlex.split(options.script_args),
+        jobs=options.jobs,
+        isolated=options.isolated,
+        preload=options.preload,
+        history=history,
+    )
+    if options.report is not None:
+        write_report(
+            options.report,
+            [result_from_dict(d) for o in outcomes for d in o["results"]],
+        )
+    return summarize(outcomes, verbose=options.verbose)
+
+
+def _write_suite(tmpdir):
+    # two tests with their own runtest_config which differ in what they print
+    for name, energy in [("a", "1.0"), ("b", "2.0")]:
+        directory = tmpdir.mkdir(name)
+        directory.join("runtest_config.py").write(
+            "import sys\n"
+            "def configure(options, input_files, extra_args):\n"
+            "    command = '{0} -c \"print(\\'energy {1}\\')\"'\n"
+            "    return '{2}', command, 'x', 'reference'\n".format(
+                sys.executable, energy, os.path.basename(sys.executable)
+            )
+        )
+        directory.mkdir("reference").join("x.stdout").write("energy 1.0\n")
+        directory.join("test").write(
+            "#!/usr/bin/env python\n"
+            "import sys\n"
+            "from runtest import cli, run, get_filter\n"
+            "from runtest_config import configure\n"
+            "options = cli()\n"
+            "f = [get_filter(string='energy', abs_tolerance=1.0e-6)]\n"
+            "sys.exit(run(options, configure, ['x'], filters={'stdout': f}))\n"
+        )
+    tmpdir.join("a", "notes.txt").write("runtest")
+
+
+def test_discover(tmpdir):
+    _write_suite(tmpdir)
+    tmpdir.join("test.py").write("print('not a test script')\n")
+    assert discover([str(tmpdir)]) == [
+        str(tmpdir.join("a", "test")),
+        str(tmpdir.join("b", "test")),
+    ]
+
+
+def test_suite(tmpdir, monkeypatch, capsys):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("cache")))
+    _write_suite(tmpdir)
+    binary_dir = os.path.dirname(sys.executable)
+    report_file = str(tmpdir.join("report.json"))
+    args = ["-j", "1", "--script-args", "-b " + binary_dir, "--report", report_file]
+    assert main(args + [str(tmpdir)]) == 1
+    out = capsys.readouterr().out
+    assert "passed " + str(tmpdir.join("a", "test")) in out
+    assert "FAILED " + str(tmpdir.join("b", "test")) in out
+    assert "==== {0} (exit code 1) ====\n".format(tmpdir.join("b", "test")) in out
+    assert "2 scripts in" in out and ": 1 passed, 1 failed\n" in out
+    assert "2 tests: 1 failed, 1 passed\n" in out
+    assert [r.status for r in report.read_report(report_file)] == ["passed", "failed"]
+    assert tmpdir.join("cache", "runtest", "history.sqlite").check()
+
+    # the isolated interpreter has to find this runtest
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(os.path.dirname(__file__)))
+    outcome = run_script(str(tmpdir.join("a", "test")), ["-b", binary_dir], isolated=True)
+    assert outcome["returncode"] == 0
+    assert "passed" in outcome["output"]
+
+
+def test_reset_state(tmpdir, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("cache")))
+    _write_suite(tmpdir)
+    binary_dir = os.path.dirname(sys.executable)
+    run_script(str(tmpdir.join("a", "test")), ["-b", binary_dir])
+    # as if script a had left all of it behind
+    _staged.add(("a", "work"))
+    _histories["history"] = None
+    shard._assignments["durations"] = {}
+    cache._digests["launcher"] = "digest"
+    plan._plans["plan.json"] = [{}]
+
+    outcome = run_script(str(tmpdir.join("b", "test")), ["-b", binary_dir])
+    assert len(outcome["results"]) == 1
+    assert _staged == set() and _histories == {}
+    assert shard._assignments == {} and cache._digests == {} and plan._plans == {}
+
+
+if __name__ == "__main__":
+    sys.exit(main())
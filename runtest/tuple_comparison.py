@@ -4,6 +4,14 @@
 
 from sys import float_info
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# integers below this size and their differences are exact as doubles
+_exact_limit = 2**52
+
 
 def tuple_matches(
     t,
@@ -54,6 +62,78 @@ def tuple_matches(
         return (False, error_message)
 
 
+def find_mismatches(
+    numbers,
+    ref_numbers,
+    tolerance=1.0e-8,
+    error_definition="relative",
+    ignore_sign=False,
+    skip_below=float_info.min,
+    skip_above=float_info.max,
+):
+    """
+    Compares numbers with reference numbers pair by pair using the same rules
+    as tuple_matches. With NumPy the comparison is done on whole arrays and
+    only pairs which may fail are passed on to tuple_matches.
+
+    Returns:
+        mismatches - list of (index, error message) of pairs which do not match
+    """
+    kwargs = dict(
+        tolerance=tolerance,
+        error_definition=error_definition,
+        ignore_sign=ignore_sign,
+        skip_below=skip_below,
+        skip_above=skip_above,
+    )
+
+    if np is None or isinstance(tolerance, int) and error_definition == "relative":
+        indices = range(min(len(numbers), len(ref_numbers)))
+    else:
+        try:
+            indices = _candidates(numbers, ref_numbers, **kwargs)
+        except (OverflowError, TypeError, ValueError):
+            # numbers which do not fit into doubles
+            indices = range(min(len(numbers), len(ref_numbers)))
+
+    mismatches = []
+    for i in indices:
+        matches, error_message = tuple_matches((numbers[i], ref_numbers[i]), **kwargs)
+        if not matches:
+            mismatches.append((i, error_message))
+    return mismatches
+
+
+def _candidates(
+    numbers, ref_numbers, tolerance, error_definition, ignore_sign, skip_below, skip_above
+):
+    x = _doubles(numbers)
+    x_ref = _doubles(ref_numbers)
+    abs_ref = np.abs(x_ref)
+
+    compared = ~(abs_ref < skip_below) & ~(abs_ref > skip_above)
+
+    with np.errstate(all="ignore"):
+        error = x - x_ref
+        if error_definition == "relative":
+            error /= x_ref
+        fails = ~(np.abs(error) <= tolerance)
+
+    # for these the doubles may differ from the Python arithmetic
+    # (large integers, division by zero) so tuple_matches decides
+    unsure = (np.abs(x) >= _exact_limit) | (abs_ref >= _exact_limit)
+    if error_definition == "relative":
+        unsure |= x_ref == 0.0
+
+    return np.flatnonzero(compared & (fails | unsure)).tolist()
+
+
+def _doubles(numbers):
+    # extracted numbers already keep their values in an array of doubles
+    values = getattr(numbers, "values", numbers)
+    return np.asarray(values, dtype=float)
+
+
 def test_tuple_matches():
     assert tuple_matches((13, 13)) == (True, None)
     assert tuple_matches((13, 13), tolerance=1.0e-10, error_definition="absolute") == (
@@ -104,3 +184,48 @@ def test_tuple_matches():
         False,
         "expected: 18 (abs diff: 1)",
     )
+
+
+def _mismatches_one_by_one(numbers, ref_numbers, **kwargs):
+    mismatches = []
+    for i, t in enumerate(zip(numbers, ref_numbers)):
+        matches, error_message = tuple_matches(t, **kwargs)
+        if not matches:
+            mismatches.append((i, error_message))
+    return mismatches
+
+
+def _test_find_mismatches():
+    import random
+
+    random.seed(11)
+    values = [0, 1, 17, -18, 2**60, 2**60 + 1, 0.0, 1.0e-9, 3.45, -3.46, 1.0e300]
+    for _ in range(200):
+        numbers = [random.choice(values) for _ in range(20)]
+        ref_numbers = [random.choice(values) for _ in range(20)]
+        for kwargs in [
+            dict(),
+            dict(tolerance=0.01, error_definition="absolute"),
+            dict(tolerance=1, error_definition="absolute"),
+            dict(tolerance=1, error_definition="relative"),
+            dict(tolerance=1.0e-2, skip_below=1.0e-3, skip_above=1.0e3),
+            dict(error_definition="absolute", ignore_sign=True),
+        ]:
+            expected = _mismatches_one_by_one(numbers, ref_numbers, **kwargs)
+            assert find_mismatches(numbers, ref_numbers, **kwargs) == expected
+
+
+def test_find_mismatches():
+    _test_find_mismatches()
+
+
+def test_find_mismatches_without_numpy(monkeypatch):
+    monkeypatch.setattr("runtest.tuple_comparison.np", None)
+    _test_find_mismatches()
+
+
+def test_find_mismatches_zero_reference():
+    import pytest
+
+    with pytest.raises(ZeroDivisionError):
+        find_mismatches([1.0], [0.0], skip_below=0.0)